@@ -0,0 +1,332 @@
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from loguru import logger
+
+from caption_cache import CaptionCache
+from captioning import CaptionClient
+from frame_encoding import FrameEncoder
+from frames import extract_encoded_frames, save_encoded_frames, save_captions_to_json
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+STAGES = ('decode', 'caption', 'kg', 'index')
+
+
+def list_videos(source):
+    """Video paths from a directory or from a manifest (a JSON list or one path per line)."""
+    if os.path.isdir(source):
+        return [os.path.join(source, video_file) for video_file in sorted(os.listdir(source))
+                if video_file.lower().endswith(VIDEO_EXTENSIONS)]
+
+    with open(source) as manifest:
+        if source.endswith('.json'):
+            entries = [entry['path'] if isinstance(entry, dict) else entry for entry in json.load(manifest)]
+        else:
+            entries = [line.strip() for line in manifest if line.strip() and not line.startswith('#')]
+    # relative paths in a manifest are relative to the manifest
+    base = os.path.dirname(os.path.abspath(source))
+    return [os.path.join(base, entry) for entry in entries]
+
+
+class VideoJob:
+    """One video and its output folder: frames/, captions.json, kg_output/ and frames_index/."""
+
+    def __init__(self, video_path, cluster_id, output_dir):
+        self.video_path = video_path
+        self.cluster_id = cluster_id
+        self.output_dir = output_dir
+        self.frames_dir = os.path.join(output_dir, 'frames')
+        self.index_dir = os.path.join(output_dir, 'frames_index')
+        self.captions_path = os.path.join(output_dir, 'captions.json')
+        self.kg_dir = os.path.join(output_dir, 'kg_output')
+        self.frames = []
+
+
+def make_jobs(video_paths, output_root):
+    # the cluster id and output folder are named after the video, made unique if names repeat;
+    # '-' is replaced too, as the KG splits its node variables ('<cluster>-<doc>-<sentence>-...') on it
+    jobs = []
+    used = set()
+    for video_path in video_paths:
+        cluster_id = re.sub(r'[^\w.]', '_', os.path.splitext(os.path.basename(video_path))[0])
+        name, n = cluster_id, 1
+        while name in used:
+            name, n = '{}_{}'.format(cluster_id, n), n + 1
+        used.add(name)
+        jobs.append(VideoJob(video_path, name, os.path.join(output_root, name)))
+    return jobs
+
+
+def decode_video(video_path, frames_dir, num_frames, sampling, image_format, max_side, quality):
+    # runs in a worker process; returns the encoded frames so captioning does not re-read them
+    start = time.perf_counter()
+    encoder = FrameEncoder(image_format=image_format, max_side=max_side, quality=quality)
+    frames = extract_encoded_frames(video_path, num_frames, encoder, sampling=sampling)
+    save_encoded_frames(frames, frames_dir)
+    return frames, time.perf_counter() - start
+
+
+class StageStats:
+    """Videos, frames and sentences a pipeline step got through, and its busy time."""
+
+    name = None
+
+    def __init__(self, name=None):
+        if name is not None:
+            self.name = name
+        self.videos = 0
+        self.frames = 0
+        self.sentences = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def record(self, seconds, frames=0, sentences=0):
+        self.videos += 1
+        self.frames += frames
+        self.sentences += sentences
+        self.seconds += seconds
+
+    def report(self):
+        # rates are per second of stage busy time
+        rate = lambda count: count / self.seconds if self.seconds else 0.0
+        return {
+            'videos': self.videos,
+            'failed': self.failed,
+            'frames': self.frames,
+            'sentences': self.sentences,
+            'seconds': round(self.seconds, 3),
+            'videos_per_s': round(rate(self.videos), 3),
+            'frames_per_s': round(rate(self.frames), 3),
+            'sentences_per_s': round(rate(self.sentences), 3),
+        }
+
+
+class Stage(StageStats, ABC):
+    """A pipeline stage run by one worker thread that loads its models once."""
+
+    def load(self):
+        pass
+
+    @abstractmethod
+    def process(self, job):
+        """Process one VideoJob and return the (frames, sentences) it handled."""
+
+
+class CaptionStage(Stage):
+    name = 'caption'
+
+    def __init__(self, api_key, cache_path=None, max_workers=8, requests_per_minute=None, tokens_per_minute=None):
+        super().__init__()
+        self.api_key = api_key
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.client = None
+
+    def load(self):
+        # one client (connection pool, rate limits, cache) for all videos
+        cache = CaptionCache(self.cache_path) if self.cache_path else None
+        self.client = CaptionClient(self.api_key, max_workers=self.max_workers,
+                                    requests_per_minute=self.requests_per_minute,
+                                    tokens_per_minute=self.tokens_per_minute, cache=cache)
+
+    def process(self, job):
+        results = self.client.caption_all([frame.base64 for frame in job.frames], job.frames[0].mime_type)
+        captions = [{'frame': frame.name, 'caption': caption} for frame, caption in zip(job.frames, results)]
+        save_captions_to_json(captions, job.captions_path)
+        return len(captions), 0
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            if self.client.cache is not None:
+                logger.info('caption cache: {}', self.client.cache.stats())
+                self.client.cache.close()
+
+
+class KGStage(Stage):
+    name = 'kg'
+
+    def __init__(self, append=True, parse_cache_path='.cache/amr_parses.sqlite', coref_window_size=None):
+        super().__init__()
+        self.append = append
+        self.parse_cache_path = parse_cache_path
+        self.coref_window_size = coref_window_size
+
+    def load(self):
+        # imported here: the KG dependencies are only needed when this stage runs
+        from kg.amr_cache import AMRParseCache
+        from kg.construct import EntityCoreference, KGCreator, PathProcess
+
+        self.path_process = PathProcess
+        defaults = PathProcess()
+        parser_model = defaults.PARSER_MODEL
+        parse_cache = AMRParseCache(self.parse_cache_path, parser_model) if self.parse_cache_path else None
+        # the AMR parser and FCoref are loaded on first use and shared by all videos
+        self.kg_creator = KGCreator(BATCH_SIZE=32, parse_cache=parse_cache, parser_model=parser_model)
+        window_size = self.coref_window_size
+        if window_size is None and self.append:
+            # as in PathProcess.constructKG: appends are windowed, full builds resolve the whole text
+            window_size = defaults.APPEND_COREF_WINDOW_SIZE
+        self.entity_coreference = EntityCoreference(window_size=window_size)
+
+    def process(self, job):
+        path_process = self.path_process(job.captions_path, job.kg_dir, job.cluster_id)
+        multiDocKG = path_process.constructKG(self.append, self.kg_creator, self.entity_coreference)
+        doc_ids = multiDocKG.metadata['doc_ids']
+        return len(doc_ids), sum(len(multiDocKG.metadata[doc_id]['sentences']) for doc_id in doc_ids)
+
+
+class IndexStage(Stage):
+    name = 'index'
+
+    def __init__(self, clip_model=None):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def load(self):
+        from clip_index import CLIP_MODEL, FrameIndex, load_clip_model, load_clip_processor
+
+        self.frame_index = FrameIndex
+        self.clip_model = self.clip_model or CLIP_MODEL
+        self.model = load_clip_model(self.clip_model)
+        self.processor = load_clip_processor(self.clip_model)
+
+    def process(self, job):
+        frame_index = self.frame_index(job.frames_dir, job.index_dir, model=self.model, processor=self.processor,
+                                       model_name=self.clip_model)
+        frame_index.build()
+        return len(frame_index.entries), 0
+
+
+def run_stage(stage, inbox, outboxes):
+    # the downstream stages get their None even if this one fails to load; its jobs are
+    # still taken off the inbox, so the stages feeding it do not block, and count as failed
+    try:
+        try:
+            stage.load()
+        except Exception:
+            logger.exception('{} failed to load', stage.name)
+            while inbox.get() is not None:
+                stage.failed += 1
+            return
+        while True:
+            job = inbox.get()
+            if job is None:
+                break
+            start = time.perf_counter()
+            try:
+                frames, sentences = stage.process(job)
+            except Exception:
+                logger.exception('{} failed for {}', stage.name, job.video_path)
+                stage.failed += 1
+                continue
+            stage.record(time.perf_counter() - start, frames, sentences)
+            logger.info('{} done: {}', stage.name, job.cluster_id)
+            for outbox in outboxes:
+                outbox.put(job)
+    finally:
+        for outbox in outboxes:
+            outbox.put(None)
+
+
+def run_batch(jobs, stages, decode_workers=4, num_frames=8, sampling='uniform', image_format='jpeg',
+              max_side=768, quality=85, queue_size=8):
+    """Decode every video in a process pool and stream the results through the stage workers.
+
+    `stages` maps 'caption', 'kg' and 'index' to Stage instances (any may be
+    missing). Captioning feeds KG construction; the CLIP index only needs the
+    frames. Bounded queues keep decoding from running far ahead of the models.
+    Returns the per-stage throughput report.
+    """
+    start = time.perf_counter()
+    inboxes = {name: queue.Queue(maxsize=queue_size) for name in stages}
+    routes = {'decode': [inboxes[name] for name in ('caption', 'index') if name in stages],
+              'caption': [inboxes['kg']] if 'kg' in stages else [], 'kg': [], 'index': []}
+    if 'kg' in stages and 'caption' not in stages:
+        # captions.json already exists in the output folders
+        routes['decode'].append(inboxes['kg'])
+
+    threads = [threading.Thread(target=run_stage, args=(stage, inboxes[name], routes[name]), name=name)
+               for name, stage in stages.items()]
+    for thread in threads:
+        thread.start()
+
+    decode = StageStats('decode')
+    with ProcessPoolExecutor(max_workers=decode_workers) as executor:
+        futures = {}
+        for job in jobs:
+            futures[executor.submit(decode_video, job.video_path, job.frames_dir, num_frames, sampling,
+                                    image_format, max_side, quality)] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                job.frames, seconds = future.result()
+            except Exception:
+                logger.exception('decode failed for {}', job.video_path)
+                decode.failed += 1
+                continue
+            decode.record(seconds, len(job.frames))
+            for inbox in routes['decode']:
+                inbox.put(job)
+    for inbox in routes['decode']:
+        inbox.put(None)
+
+    for thread in threads:
+        thread.join()
+    for stage in stages.values():
+        if hasattr(stage, 'close'):
+            stage.close()
+
+    wall = time.perf_counter() - start
+    report = {'decode': decode.report()}
+    report.update({name: stage.report() for name, stage in stages.items()})
+    report['total'] = {'videos': len(jobs), 'seconds': round(wall, 3),
+                       'videos_per_s': round(len(jobs) / wall, 3) if wall else 0.0}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run frames.py, kg/construct.py and the CLIP index over many videos')
+    parser.add_argument('source', help='a directory of videos or a manifest (JSON list or one path per line)')
+    parser.add_argument('--output', default='batch_output')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma-separated subset of {}; decode always runs'.format(','.join(STAGES)))
+    parser.add_argument('--decode-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--num-frames', type=int, default=8)
+    parser.add_argument('--sampling', default='uniform', choices=('uniform', 'scene'))
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', ''))
+    parser.add_argument('--caption-cache', default='.cache/captions.sqlite')
+    parser.add_argument('--requests-per-minute', type=float)
+    parser.add_argument('--tokens-per-minute', type=float)
+    parser.add_argument('--parse-cache', default='.cache/amr_parses.sqlite')
+    parser.add_argument('--report', help='also write the throughput report to this JSON file')
+    args = parser.parse_args()
+
+    selected = set(args.stages.split(','))
+    stages = {}
+    if 'caption' in selected:
+        stages['caption'] = CaptionStage(args.api_key, args.caption_cache,
+                                         requests_per_minute=args.requests_per_minute,
+                                         tokens_per_minute=args.tokens_per_minute)
+    if 'kg' in selected:
+        stages['kg'] = KGStage(parse_cache_path=args.parse_cache)
+    if 'index' in selected:
+        stages['index'] = IndexStage()
+
+    jobs = make_jobs(list_videos(args.source), args.output)
+    logger.info('{} videos, stages: decode, {}', len(jobs), ', '.join(stages))
+    report = run_batch(jobs, stages, args.decode_workers, args.num_frames, args.sampling)
+    for name, stage_report in report.items():
+        logger.info('{}: {}', name, stage_report)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
@@ -0,0 +1,39 @@
+# Caption wall time against a local stub server, sequential vs. concurrent.
+# Run from the repository root: python -m benchmarks.bench_captioning
+import argparse
+import base64
+import os
+import time
+
+from benchmarks.stub_openai import start_stub_server
+from captioning import CaptionClient
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--fail-every', type=int, default=10)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    server, api_base = start_stub_server(latency=args.latency, fail_every=args.fail_every)
+    images = [base64.b64encode(os.urandom(20000 + 3 * i)).decode('utf-8') for i in range(args.frames)]
+
+    try:
+        print('{:>8} {:>10} {:>10}'.format('workers', 'wall (s)', 'frames/s'))
+        for workers in args.workers:
+            with CaptionClient("stub-key", max_workers=workers, backoff=0.01, api_base=api_base) as client:
+                start = time.perf_counter()
+                captions = client.caption_all(images)
+                elapsed = time.perf_counter() - start
+            assert len(captions) == len(images)
+            assert all('{}-byte'.format(len(image) + len('data:image/jpeg;base64,')) in caption
+                       for image, caption in zip(images, captions)), 'captions out of order'
+            print('{:>8} {:>10.2f} {:>10.1f}'.format(workers, elapsed, len(images) / elapsed))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
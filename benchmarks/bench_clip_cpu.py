@@ -0,0 +1,143 @@
+# CLIP scoring on CPU: fp32 eager (the default path) vs. clip_index.CPUCLIPModel with
+# inference_mode, int8 dynamic quantization and traced towers, at several thread
+# counts. Reports image/text tower latency and throughput and how often the top-k
+# frames per question match the fp32 ranking. Runs on a frames directory (`--frames-dir
+# frames`, as written by frames.py) with the real CLIP weights; `--tiny` swaps in the
+# random-weight model from benchmarks/tiny_clip.py for offline runs, where only the
+# timings are meaningful.
+# Run from the repository root: python -m benchmarks.bench_clip_cpu
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from clip_index import CLIP_MODEL, CPUCLIPModel, IMAGE_EXTENSIONS, _features, _normalize, set_cpu_threads
+
+QUESTIONS = [
+    'Where are the cars parked?', 'How many people are walking?', 'Is there a bench near the trees?',
+    'What color is the building?', 'Is the street busy?', 'Are there any bicycles?', 'Is it daytime?',
+    'What is next to the lamp post?',
+]
+
+
+def synthetic_frames(directory, count, size=(640, 360)):
+    rng = np.random.default_rng(0)
+    width, height = size
+    for i in range(count):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = rng.integers(0, 256, 3)
+        x, y = rng.integers(0, width - 100), rng.integers(0, height - 100)
+        cv2.rectangle(frame, (int(x), int(y)), (int(x) + 100, int(y) + 100), rng.integers(0, 256, 3).tolist(), -1)
+        cv2.imwrite(os.path.join(directory, f'frame_{i}.png'), frame)
+
+
+def load(args):
+    if args.tiny:
+        from benchmarks.tiny_clip import tiny_clip
+
+        return tiny_clip(image_size=224)
+    from transformers import CLIPModel, CLIPProcessor
+
+    return CLIPModel.from_pretrained(args.model), CLIPProcessor.from_pretrained(args.model)
+
+
+def run(model, pixel_batches, text_inputs, repeat, no_grad):
+    # returns (image features, text features, seconds per pass over the frames, seconds per text call)
+    context = torch.no_grad if no_grad else torch.inference_mode
+    with context():
+        # the first call warms up allocators and, for traced models, traces
+        model.get_image_features(pixel_values=pixel_batches[0])
+        model.get_text_features(**text_inputs)
+        image_seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            image_features = np.concatenate([_features(model.get_image_features(pixel_values=batch)).numpy()
+                                             for batch in pixel_batches])
+            image_seconds.append(time.perf_counter() - start)
+        text_seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            text_features = _features(model.get_text_features(**text_inputs)).numpy()
+            text_seconds.append(time.perf_counter() - start)
+    return _normalize(image_features), _normalize(text_features), min(image_seconds), min(text_seconds)
+
+
+def top_k_agreement(scores, reference, top_k):
+    # share of the reference top-k frames that are also in the top-k, and exact top-1 matches
+    ranked = np.argsort(-scores, axis=1)[:, :top_k]
+    expected = np.argsort(-reference, axis=1)[:, :top_k]
+    overlap = np.mean([len(set(row) & set(ref)) / top_k for row, ref in zip(ranked, expected)])
+    return overlap, np.mean(ranked[:, 0] == expected[:, 0])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames-dir', default='frames')
+    parser.add_argument('--model', default=CLIP_MODEL)
+    parser.add_argument('--tiny', action='store_true', help='random-weight tiny CLIP, no download needed')
+    parser.add_argument('--synthetic-frames', type=int, default=64,
+                        help='frames to generate when --frames-dir has none')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument('--interop-threads', type=int, default=1)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    set_cpu_threads(interop_threads=args.interop_threads)
+    temp_dir = None
+    frames_dir = args.frames_dir
+    if not os.path.isdir(frames_dir) or not any(name.lower().endswith(IMAGE_EXTENSIONS)
+                                                for name in os.listdir(frames_dir)):
+        temp_dir = frames_dir = tempfile.mkdtemp(prefix='bench_clip_cpu_')
+        synthetic_frames(frames_dir, args.synthetic_frames)
+        print('no frames in {}, using {} synthetic frames'.format(args.frames_dir, args.synthetic_frames))
+
+    try:
+        paths = sorted(os.path.join(frames_dir, name) for name in os.listdir(frames_dir)
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        model, processor = load(args)
+        model.eval()
+        # preprocessing is shared by every setting, only the towers are timed
+        pixel_batches = [processor(images=[Image.open(path).convert('RGB') for path in paths[start:start + args.batch_size]],
+                                   return_tensors="pt")['pixel_values']
+                         for start in range(0, len(paths), args.batch_size)]
+        text_inputs = dict(processor(text=QUESTIONS, return_tensors="pt", padding=True))
+
+        settings = [
+            ('fp32 eager', lambda: model, True),
+            ('fp32 inference_mode', lambda: CPUCLIPModel(model, quantize=False), False),
+            ('fp32 traced', lambda: CPUCLIPModel(model, quantize=False, trace=True), False),
+            ('int8', lambda: CPUCLIPModel(model), False),
+            ('int8 traced', lambda: CPUCLIPModel(model, trace=True), False),
+        ]
+        print('{} frames, {} questions, batch size {}'.format(len(paths), len(QUESTIONS), args.batch_size))
+        print('{:>20} {:>8} {:>12} {:>11} {:>13} {:>12} {:>7}'.format(
+            'setting', 'threads', 'ms/batch', 'images/s', 'ms/questions', 'top-{} overlap'.format(args.top_k),
+            'top-1'))
+        reference = None
+        for threads in args.threads:
+            set_cpu_threads(threads)
+            for name, build, no_grad in settings:
+                image_features, text_features, image_seconds, text_seconds = run(
+                    build(), pixel_batches, text_inputs, args.repeat, no_grad)
+                scores = text_features @ image_features.T
+                if reference is None:
+                    reference = scores
+                overlap, top1 = top_k_agreement(scores, reference, min(args.top_k, len(paths)))
+                print('{:>20} {:>8} {:>12.1f} {:>11.1f} {:>13.1f} {:>12.3f} {:>7.3f}'.format(
+                    name, threads, image_seconds / len(pixel_batches) * 1000, len(paths) / image_seconds,
+                    text_seconds * 1000, overlap, top1))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Compare the per-frame seek loop with the single-pass decoder on synthetic videos.
+# Run from the repository root: python -m benchmarks.bench_decode
+import argparse
+import os
+import struct
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from frames import iter_video_frames
+
+
+def synthetic_frame(i, size):
+    width, height = size
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, :, 0] = (i * 3) % 256
+    cv2.rectangle(frame, ((i * 4) % width, 40), ((i * 4) % width + 40, 80), (0, 255, 255), -1)
+    cv2.putText(frame, str(i), (10, height - 20), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return frame
+
+
+def write_synthetic_video(path, num_frames, size=(320, 240), fps=30, fourcc='XVID'):
+    # OpenCV's FFmpeg writer always uses a 12-frame GOP, so seeks here are cheap
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+    for i in range(num_frames):
+        writer.write(synthetic_frame(i, size))
+    writer.release()
+
+
+def _chunk(tag, data):
+    return tag + struct.pack('<I', len(data)) + data + (b'\0' if len(data) % 2 else b'')
+
+
+def _list(tag, body):
+    return b'LIST' + struct.pack('<I', len(body) + 4) + tag + body
+
+
+def write_long_gop_video(path, num_frames, keyframe_interval=250, size=(320, 240), fps=30):
+    # An MJPEG AVI whose index only marks every keyframe_interval-th frame as a keyframe.
+    # No long-GOP encoder is reachable through cv2.VideoWriter, but FFmpeg seeks to the
+    # previous indexed keyframe and decodes forward, which is the cost of a seek in a
+    # long-GOP H.264 capture (x264 defaults to a keyframe every 250 frames).
+    width, height = size
+    movi, index, offset = [], [], 4
+    for i in range(num_frames):
+        data = cv2.imencode('.jpg', synthetic_frame(i, size))[1].tobytes()
+        flags = 0x10 if i % keyframe_interval == 0 else 0
+        index.append(struct.pack('<4sIII', b'00dc', flags, offset, len(data)))
+        movi.append(_chunk(b'00dc', data))
+        offset += len(movi[-1])
+
+    avih = struct.pack('<14I', 1000000 // fps, 0, 0, 0x10, num_frames, 0, 1, 0, width, height, 0, 0, 0, 0)
+    strh = struct.pack('<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0, 1, fps, 0, num_frames,
+                       0, 0xFFFFFFFF, 0, 0, 0, width, height)
+    strf = struct.pack('<IiiHH4sIiiII', 40, width, height, 1, 24, b'MJPG', width * height * 3, 0, 0, 0, 0)
+    header = _list(b'hdrl', _chunk(b'avih', avih) + _list(b'strl', _chunk(b'strh', strh) + _chunk(b'strf', strf)))
+    body = header + _list(b'movi', b''.join(movi)) + _chunk(b'idx1', b''.join(index))
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body) + 4) + b'AVI ' + body)
+
+
+def seek_loop(video_path, num_frames):
+    # the original split_video_into_frames loop, without writing PNGs
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_interval = total_frames // num_frames
+
+    frames = []
+    for i in range(num_frames):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i * frame_interval)
+        ret, frame = cap.read()
+        if ret:
+            frames.append(frame)
+
+    cap.release()
+    return frames
+
+
+def decoder(video_path, num_frames, mode):
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    frame_interval = total_frames // num_frames
+    indices = [i * frame_interval for i in range(num_frames)]
+    return [frame for _, frame in iter_video_frames(video_path, indices, mode=mode)]
+
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[300, 1500, 6000])
+    parser.add_argument('--num-frames', type=int, nargs='+', default=[8, 64])
+    parser.add_argument('--keyframe-interval', type=int, default=250,
+                        help='keyframe interval of the long-GOP video')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>8} {:>10} {:>12} {:>10} {:>8}'.format(
+        'gop', 'length', 'samples', 'seek (s)', 'sequential', 'auto', 'speedup'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for length in args.lengths:
+            short_gop = os.path.join(tmp_dir, 'synthetic_{}.avi'.format(length))
+            write_synthetic_video(short_gop, length)
+            long_gop = os.path.join(tmp_dir, 'long_gop_{}.avi'.format(length))
+            write_long_gop_video(long_gop, length, args.keyframe_interval)
+            for gop, video_path in ((12, short_gop), (args.keyframe_interval, long_gop)):
+                for num_frames in args.num_frames:
+                    seek = timed(seek_loop, video_path, num_frames, repeat=args.repeat)
+                    sequential = timed(decoder, video_path, num_frames, 'sequential', repeat=args.repeat)
+                    auto = timed(decoder, video_path, num_frames, 'auto', repeat=args.repeat)
+                    print('{:>10} {:>8} {:>8} {:>10.3f} {:>12.3f} {:>10.3f} {:>7.2f}x'.format(
+                        gop, length, num_frames, seek, sequential, auto, seek / auto))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# Upload payload per frame: base64 of the PNG file (previous path) vs. in-memory JPEG/WebP.
+# Run from the repository root: python -m benchmarks.bench_encoding [--frames-dir frames]
+import argparse
+import base64
+import glob
+import os
+import time
+
+import cv2
+
+from frame_encoding import FrameEncoder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames-dir', default='frames')
+    parser.add_argument('--max-side', type=int, nargs='+', default=[0, 1024, 768, 512])
+    parser.add_argument('--quality', type=int, nargs='+', default=[90, 80])
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.frames_dir, '*.png')))
+    if not paths:
+        raise SystemExit('No PNG frames found in {}'.format(args.frames_dir))
+    frames = [cv2.imread(path) for path in paths]
+
+    png_payload = sum(len(base64.b64encode(open(path, 'rb').read())) for path in paths) / len(paths)
+    print('{:>6} {:>9} {:>8} {:>14} {:>8} {:>10}'.format(
+        'format', 'max_side', 'quality', 'payload (KiB)', 'vs png', 'ms/frame'))
+    print('{:>6} {:>9} {:>8} {:>14.1f} {:>8} {:>10}'.format('png', '-', '-', png_payload / 1024, '1.00', '-'))
+
+    for image_format in ('jpeg', 'webp'):
+        for max_side in args.max_side:
+            for quality in args.quality:
+                encoder = FrameEncoder(image_format=image_format, max_side=max_side, quality=quality)
+                start = time.perf_counter()
+                encoded = [encoder.encode(frame, 'frame') for frame in frames]
+                elapsed = (time.perf_counter() - start) / len(frames)
+                payload = sum(len(frame.base64) for frame in encoded) / len(encoded)
+                print('{:>6} {:>9} {:>8} {:>14.1f} {:>8.2f} {:>10.1f}'.format(
+                    image_format, max_side or 'full', quality, payload / 1024, payload / png_payload, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
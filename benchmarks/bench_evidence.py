@@ -0,0 +1,129 @@
+# Prompt size per question with every coreferenced frame attached (the previous
+# query path) vs. EvidenceSelector at several token/latency budgets. Frames are
+# full-size synthetic PNGs, the KG comes from the fake AMR parser and coreference
+# model and CLIP is the tiny random-weight model, so only the sizes are meaningful.
+# Run from the repository root: python -m benchmarks.bench_evidence
+import argparse
+import random
+import shutil
+import tempfile
+import os
+
+import cv2
+import numpy as np
+
+from benchmarks.fake_amr import FakeAMRParser, synthetic_captions
+from benchmarks.fake_coref import FakeCoref
+from benchmarks.tiny_clip import tiny_clip
+from evidence import EvidenceSelector
+from kg.construct import EntityCoreference, GraphExporter, KGCreator
+from service import QueryService
+
+QUESTION_WORDS = ['car', 'person', 'building', 'bench', 'tree', 'street', 'lamp', 'park', 'window', 'people']
+
+
+def build_fixture(work_dir, num_frames, sentences_per_caption, size=(1280, 720), pending_frames=0):
+    # the last `pending_frames` frames are written but left out of the KG, like frames
+    # indexed while the KG is still being rebuilt
+    frames_dir = os.path.join(work_dir, 'frames')
+    os.makedirs(frames_dir)
+    rng = np.random.default_rng(0)
+    width, height = size
+    for i in range(num_frames + pending_frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = rng.integers(0, 256, 3)
+        # noise keeps the PNGs close to the size of real frames
+        frame[::4, ::4] = rng.integers(0, 256, (height // 4, width // 4, 3), dtype=np.uint8)
+        cv2.imwrite(os.path.join(frames_dir, f'frame_{i}.png'), frame)
+
+    sentence_lists = synthetic_captions(num_frames, sentences_per_caption)
+    creator = KGCreator(parser=FakeAMRParser())
+    graph = creator.create_graph('777')
+    for doc_id, (sentences, amr_graphs) in enumerate(zip(sentence_lists, creator.parse_corpus(sentence_lists))):
+        graph = creator.add_document(graph, doc_id)
+        graph = creator.createKGFromSentence(sentences, graph, '777', doc_id, modal='image', amr_graphs=amr_graphs)
+    graph = creator.finalize(graph)
+
+    coreference = EntityCoreference(window_size=512)
+    coreference.coref_model = FakeCoref(max_mentions=8)
+    graph = coreference.resolve(graph)
+    kg_dir = os.path.join(work_dir, 'kg_output')
+    GraphExporter(graph, kg_dir).export(('graph_no_quotes',), ('graph_no_quotes',))
+    return frames_dir, os.path.join(kg_dir, 'graph_no_quotes.json')
+
+
+def request_sizes(service, questions):
+    rows = []
+    for question in questions:
+        rankings, retrieved_doc_ids, frame_scores = service.retrieve(question)
+        images, evidence = service.select_evidence(question, retrieved_doc_ids, frame_scores)
+        messages = service.build_messages(question, images)
+        payload_bytes = sum(len(part['text'] if part['type'] == 'text' else part['image_url']['url'])
+                            for message in messages for part in message['content'])
+        rows.append((evidence['tokens'], evidence['images'], evidence['captions'], payload_bytes,
+                     evidence['estimated_latency']))
+    return np.array(rows, dtype=np.float64)
+
+
+def check_pending_frames(service, questions, pending_ids):
+    # seeding every question with frames missing from the KG must not fail it
+    attached = 0
+    for question in questions:
+        rankings, retrieved_doc_ids, frame_scores = service.retrieve(question)
+        images, evidence = service.select_evidence(question, retrieved_doc_ids + pending_ids, frame_scores)
+        service.build_messages(question, images)
+        pending = [image for image in images if image['frame_id'] in pending_ids]
+        assert all(image['caption'] is None and image['image'] for image in pending), pending
+        attached += len(pending)
+    return attached
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=64)
+    parser.add_argument('--sentences', type=int, default=4)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--top-k', type=int, default=2)
+    parser.add_argument('--pending', type=int, default=2, help='indexed frames not in the KG yet')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    questions = ['Is there a {} near the {}?'.format(*rng.sample(QUESTION_WORDS, 2)) for _ in range(args.questions)]
+    unbounded = 10 ** 9
+    selectors = [
+        # every retrieved frame and coreference neighbour with its image, as before the selector
+        ('all coreferences', EvidenceSelector(max_tokens=unbounded, max_images=unbounded, min_images=unbounded)),
+        ('4000 tokens', EvidenceSelector(max_tokens=4000)),
+        ('2000 tokens', EvidenceSelector(max_tokens=2000)),
+        ('1000 tokens', EvidenceSelector(max_tokens=1000)),
+        ('4000 tokens, 2.5s', EvidenceSelector(max_tokens=4000, max_latency=2.5)),
+    ]
+
+    work_dir = tempfile.mkdtemp(prefix='bench_evidence_')
+    try:
+        frames_dir, kg_path = build_fixture(work_dir, args.frames, args.sentences, pending_frames=args.pending)
+        model, processor = tiny_clip()
+        service = QueryService("stub-key", frames_dir=frames_dir, kg_path=kg_path, model=model,
+                               processor=processor, client=object(), top_k=args.top_k)
+
+        print('{:>18} {:>15} {:>11} {:>11} {:>17} {:>15}'.format(
+            'selector', 'tokens mean/max', 'images', 'captions', 'payload KB', 'est. latency'))
+        for name, selector in selectors:
+            service.selector = selector
+            rows = request_sizes(service, questions)
+            mean, peak = rows.mean(axis=0), rows.max(axis=0)
+            print('{:>18} {:>15} {:>11} {:>11} {:>17} {:>15}'.format(
+                name, '{:.0f}/{:.0f}'.format(mean[0], peak[0]), '{:.1f}/{:.0f}'.format(mean[1], peak[1]),
+                '{:.1f}/{:.0f}'.format(mean[2], peak[2]), '{:.0f}/{:.0f}'.format(mean[3] / 1024, peak[3] / 1024),
+                '{:.2f}/{:.2f}s'.format(mean[4], peak[4])))
+
+        pending_ids = [str(i) for i in range(args.frames, args.frames + args.pending)]
+        attached = check_pending_frames(service, questions, pending_ids)
+        print('{} frames not in the KG: attached {} times as images over {} questions'.format(
+            len(pending_ids), attached, len(questions)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# GraphConverter on a synthetic KG of tens of thousands of triples: list scans and
+# per-instance doc_info rebuilds (the previous behaviour) vs. hashed per-document indexes.
+# Run from the repository root: python -m benchmarks.bench_graph_convert
+import argparse
+import time
+
+import networkx as nx
+
+from benchmarks.fake_amr import FakeAMRParser, synthetic_captions
+from kg.construct import GraphConverter, KGCreator
+
+
+class ListScanGraphConverter(GraphConverter):
+    def assign_group_id(self, doc_id, instance):
+        if (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['video_triples']:
+            return "{}-{}".format(doc_id, "video")
+        elif (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['audio_triples']:
+            return "{}-{}".format(doc_id, "audio")
+        elif (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['image_triples']:
+            return "{}-{}".format(doc_id, "image")
+        return "{}-{}".format(doc_id, "text")
+
+    def update_doc_info(self, G, doc_id):
+        G.graph['doc_info'].pop(doc_id, None)
+        super().update_doc_info(G, doc_id)
+
+
+def synthetic_kg(num_frames, sentences_per_caption):
+    creator = KGCreator(BATCH_SIZE=64, parser=FakeAMRParser())
+    multiDocKG = creator.create_graph('777')
+    captions = synthetic_captions(num_frames, sentences_per_caption)
+    for doc_id in range(num_frames):
+        creator.add_document(multiDocKG, doc_id)
+    # every sentence is an image caption, so the modality lists are as long as they get
+    documents = [(doc_id, 'image', [sentence]) for doc_id, sentences in enumerate(captions) for sentence in sentences]
+    multiDocKG = creator.createKGFromCorpus(documents, multiDocKG, '777')
+    multiDocKG = creator.finalize(multiDocKG)
+    multiDocKG.metadata['kg_penman'] = ''
+    multiDocKG.metadata['coreferences'] = {}
+    return multiDocKG
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--sentences', type=int, nargs='+', default=[6, 60, 240])
+    args = parser.parse_args()
+
+    # the list scans cost O(instances x triples per document), so grow the documents
+    print('{:>10} {:>10} {:>12} {:>10} {:>8}'.format('sentences', 'triples', 'list scan', 'indexed', 'speedup'))
+    for sentences in args.sentences:
+        multiDocKG = synthetic_kg(args.frames, sentences)
+
+        start = time.perf_counter()
+        G = GraphConverter(multiDocKG).convert()
+        indexed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        legacy_G = ListScanGraphConverter(multiDocKG).convert()
+        list_scan = time.perf_counter() - start
+
+        assert nx.node_link_data(G) == nx.node_link_data(legacy_G)
+        print('{:>10} {:>10} {:>11.2f}s {:>9.2f}s {:>7.1f}x'.format(
+            sentences, len(multiDocKG.triples), list_scan, indexed, list_scan / indexed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Scaling of KG construction: re-laying out the whole graph after every sentence
+# (the previous behaviour) vs. appending and laying out once in KGCreator.finalize.
+# Run from the repository root: python -m benchmarks.bench_kg_build
+import argparse
+import time
+
+from benchmarks.fake_amr import FakeAMRParser, synthetic_captions
+from kg.construct import KGCreator
+
+
+def build(captions, relayout_every_sentence):
+    creator = KGCreator(BATCH_SIZE=32, parser=FakeAMRParser())
+    multiDocKG = creator.create_graph('777')
+    for doc_id, sentences in enumerate(captions):
+        multiDocKG = creator.add_document(multiDocKG, doc_id)
+        if relayout_every_sentence:
+            for sentence in sentences:
+                multiDocKG = creator.createKGFromSentence([sentence], multiDocKG, '777', doc_id, modal='image')
+                multiDocKG = creator.finalize(multiDocKG)
+        else:
+            multiDocKG = creator.createKGFromSentence(sentences, multiDocKG, '777', doc_id, modal='image')
+    return creator.finalize(multiDocKG)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, nargs='+', default=[8, 32, 128, 256])
+    parser.add_argument('--sentences', type=int, default=6)
+    parser.add_argument('--skip-legacy-above', type=int, default=256)
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>10} {:>14} {:>14}'.format(
+        'frames', 'sentences', 'triples', 'per-sentence', 'incremental'))
+    for num_frames in args.frames:
+        captions = synthetic_captions(num_frames, args.sentences)
+
+        start = time.perf_counter()
+        graph = build(captions, relayout_every_sentence=False)
+        incremental = time.perf_counter() - start
+
+        legacy = float('nan')
+        if num_frames <= args.skip_legacy_above:
+            start = time.perf_counter()
+            legacy_graph = build(captions, relayout_every_sentence=True)
+            legacy = time.perf_counter() - start
+            assert set(legacy_graph.triples) == set(graph.triples)
+
+        print('{:>8} {:>10} {:>10} {:>13.2f}s {:>13.2f}s'.format(
+            num_frames, num_frames * args.sentences, len(graph.triples), legacy, incremental))
+
+
+if __name__ == '__main__':
+    main()
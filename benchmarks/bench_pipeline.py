@@ -0,0 +1,243 @@
+# Offline end-to-end benchmark: synthetic video -> split_video_into_frames -> captions
+# from the stub server -> KGCreator with the fake AMR parser -> EntityCoreference with
+# the fake coreference model -> GraphConverter / export -> the demo.py query path
+# (QueryService) with a tiny random CLIP. Sweeps frames x sentences per caption,
+# records time and Python heap peak per stage and flags scaling regressions.
+# Run from the repository root: python -m benchmarks.bench_pipeline
+import argparse
+import gc
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import openai
+
+import profiling
+from benchmarks.bench_decode import write_synthetic_video
+from benchmarks.fake_amr import FakeAMRParser, synthetic_captions
+from benchmarks.fake_coref import FakeCoref
+from benchmarks.stub_openai import start_stub_server
+from benchmarks.tiny_clip import tiny_clip
+from captioning import CaptionClient
+from frames import encode_image, split_video_into_frames
+from kg.construct import EntityCoreference, GraphExporter, KGCreator
+from service import QueryService
+
+STAGES = ('decode', 'caption', 'kg_build', 'coref', 'penman_encode', 'graph_convert', 'json_dump', 'clip_index',
+          'query')
+# timed inside GraphExporter.export by its profiling spans
+EXPORT_STAGES = ('penman_encode', 'graph_convert', 'json_dump')
+# time is expected to grow at most linearly in the number of frames for every stage;
+# a log-log slope above this between the two largest sweep points is flagged
+MAX_SCALING_EXPONENT = 1.3
+QUESTIONS = ['What is the person doing?', 'Is there a car near the building?', 'Where is the bench?']
+
+
+class StageTimer:
+    def __init__(self, track_memory):
+        self.track_memory = track_memory
+        self.results = {}
+
+    def run(self, name, function, *args, **kwargs):
+        # garbage left by the previous stage is not charged to this one, and the objects that
+        # survive it (torch, transformers, earlier stages) are frozen so that a full collection
+        # inside the stage only rescans what the stage allocated
+        gc.collect()
+        gc.freeze()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            gc.unfreeze()
+        peak_mb = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20 if self.track_memory else None
+        self.results[name] = {'seconds': seconds, 'peak_mb': peak_mb}
+        return result
+
+
+def run_pipeline(work_dir, api_base, num_frames, track_memory, video_frames_per_frame=10):
+    timer = StageTimer(track_memory)
+    video_path = os.path.join(work_dir, 'video.avi')
+    write_synthetic_video(video_path, num_frames * video_frames_per_frame)
+
+    # split_video_into_frames writes to frames/ in the working directory
+    os.makedirs(os.path.join(work_dir, 'frames'))
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        frame_paths = timer.run('decode', split_video_into_frames, video_path, num_frames)
+    finally:
+        os.chdir(cwd)
+    frame_paths = [os.path.join(work_dir, frame_path) for frame_path in frame_paths]
+
+    with CaptionClient("stub-key", api_base=api_base) as client:
+        captions = timer.run('caption', client.caption_all, [encode_image(path) for path in frame_paths], 'image/png')
+    assert len(captions) == num_frames
+
+    # doc ids are frame indices, as in PathProcess.constructKG; stub captions are plain '. '-separated
+    # sentences, so a regex split stands in for nltk's punkt tokenizer
+    doc_ids = [int(os.path.basename(path).split('.')[0].split('_')[1]) for path in frame_paths]
+    sentence_lists = [re.split(r'(?<=\.)\s+', caption.strip()) for caption in captions]
+
+    def build():
+        creator = KGCreator(BATCH_SIZE=32, parser=FakeAMRParser())
+        graph = creator.create_graph('777')
+        parsed = creator.parse_corpus(sentence_lists)
+        for doc_id, sentences, amr_graphs in zip(doc_ids, sentence_lists, parsed):
+            graph = creator.add_document(graph, doc_id)
+            graph = creator.createKGFromSentence(sentences, graph, '777', doc_id, modal='image', amr_graphs=amr_graphs)
+        return creator.finalize(graph)
+
+    graph = timer.run('kg_build', build)
+
+    coreference = EntityCoreference(window_size=512)
+    # real coreference clusters are small; unbounded fake clusters would link every repeated word
+    coreference.coref_model = FakeCoref(max_mentions=8)
+    graph = timer.run('coref', coreference.resolve, graph)
+
+    kg_dir = os.path.join(work_dir, 'kg_output')
+    profiling.PROFILER.reset()
+    timer.run('export', GraphExporter(graph, kg_dir).export, ('graph_no_quotes',), ('graph_no_quotes',))
+    summary = profiling.PROFILER.summary()
+    for name in EXPORT_STAGES:
+        timer.results[name] = {'seconds': summary[name]['wall_s'], 'peak_mb': None}
+
+    model, processor = tiny_clip()
+    service = timer.run('clip_index', QueryService, "stub-key", frames_dir=os.path.join(work_dir, 'frames'),
+                        kg_path=os.path.join(kg_dir, 'graph_no_quotes.json'), model=model, processor=processor,
+                        client=openai.Client(api_key="stub-key", base_url=api_base), top_k=2)
+
+    def query():
+        for question in QUESTIONS:
+            service.answer(question)
+
+    timer.run('query', query)
+    timer.results['query']['seconds'] /= len(QUESTIONS)
+    return timer.results
+
+
+def scaling_exponents(results):
+    # log-log slope of time over frames between the two largest frame counts, per stage and sentences;
+    # the smallest runs are dominated by fixed costs and would hide superlinear growth
+    exponents = {}
+    for sentences in sorted({row['sentences'] for row in results}):
+        rows = sorted((row for row in results if row['sentences'] == sentences), key=lambda row: row['frames'])
+        if len(rows) < 2:
+            continue
+        first, last = rows[-2], rows[-1]
+        for stage in STAGES:
+            low, high = first['stages'][stage]['seconds'], last['stages'][stage]['seconds']
+            if low > 0 and high > 0:
+                exponents[(stage, sentences)] = math.log(high / low) / math.log(last['frames'] / first['frames'])
+    return exponents
+
+
+def compare_to_baseline(results, baseline, tolerance, min_seconds):
+    # slower than the baseline by more than `tolerance` (and by at least min_seconds) is a regression
+    baseline_rows = {(row['frames'], row['sentences']): row for row in baseline['results']}
+    regressions = []
+    for row in results:
+        base = baseline_rows.get((row['frames'], row['sentences']))
+        if base is None:
+            continue
+        for stage in STAGES:
+            now, before = row['stages'][stage]['seconds'], base['stages'][stage]['seconds']
+            if now > before * tolerance and now - before > min_seconds:
+                regressions.append((stage, row['frames'], row['sentences'], before, now))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--sentences', type=int, nargs='+', default=[3, 6])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per sweep point, the fastest is reported')
+    parser.add_argument('--latency', type=float, default=0.01, help='stub chat-completions latency in seconds')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows every stage down')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='a JSON file written by --save to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--min-seconds', type=float, default=0.05)
+    parser.add_argument('--max-exponent', type=float, default=MAX_SCALING_EXPONENT)
+    args = parser.parse_args()
+
+    profiling.enable()
+    track_memory = not args.no_memory
+    if track_memory:
+        tracemalloc.start()
+
+    # the stub answers every caption request with synthetic sentences of the current sweep point
+    counter = iter(range(10 ** 9))
+    replies = {sentences: [' '.join(caption) for caption in synthetic_captions(256, sentences)]
+               for sentences in args.sentences}
+    current = {'sentences': args.sentences[0]}
+    reply = lambda payload: replies[current['sentences']][next(counter) % 256]
+    server, api_base = start_stub_server(latency=args.latency, reply=reply)
+
+    results = []
+    try:
+        print('{:>7} {:>10} '.format('frames', 'sentences') + ' '.join('{:>13}'.format(stage) for stage in STAGES))
+        for sentences in args.sentences:
+            current['sentences'] = sentences
+            for num_frames in args.frames:
+                runs = []
+                for _ in range(args.repeat):
+                    work_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+                    try:
+                        runs.append(run_pipeline(work_dir, api_base, num_frames, track_memory))
+                    finally:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                # the fastest run per stage is the least disturbed by the machine
+                stages = {name: min((run[name] for run in runs), key=lambda result: result['seconds'])
+                          for name in runs[0]}
+                results.append({'frames': num_frames, 'sentences': sentences, 'stages': stages})
+                print('{:>7} {:>10} '.format(num_frames, sentences) + ' '.join(
+                    '{:>13}'.format('{:.3f}s'.format(stages[stage]['seconds']) + (
+                        '/{:.0f}M'.format(stages[stage]['peak_mb']) if stages[stage]['peak_mb'] is not None else ''))
+                    for stage in STAGES))
+        if track_memory:
+            print('(time / Python heap peak per stage; export sub-stages share the export peak of {:.0f}M)'.format(
+                results[-1]['stages']['export']['peak_mb']))
+    finally:
+        server.shutdown()
+
+    flagged = []
+    print('\nscaling exponent of time over frames (flagged above {}):'.format(args.max_exponent))
+    for (stage, sentences), exponent in sorted(scaling_exponents(results).items()):
+        flag = exponent > args.max_exponent
+        print('{:>13} sentences={} {:6.2f}{}'.format(stage, sentences, exponent, '  REGRESSION' if flag else ''))
+        if flag:
+            flagged.append('{} scales as frames^{:.2f} at {} sentences per caption'.format(stage, exponent, sentences))
+
+    report = {'track_memory': track_memory, 'latency': args.latency, 'results': results}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('track_memory') != track_memory:
+            print('warning: the baseline was recorded with track_memory={}'.format(baseline.get('track_memory')))
+        for stage, num_frames, sentences, before, now in compare_to_baseline(
+                results, baseline, args.tolerance, args.min_seconds):
+            flagged.append('{} at {} frames x {} sentences: {:.3f}s -> {:.3f}s'.format(
+                stage, num_frames, sentences, before, now))
+
+    if args.save:
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+    if flagged:
+        print('\nregressions:\n  ' + '\n  '.join(flagged))
+        sys.exit(1)
+    print('\nno regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Startup cost of each entry point, every run in a fresh interpreter: the import time of
+# its module with the heavy libraries (torch, transformers, openai, nltk, the AMR
+# parser, fastcoref) the import pulled in, and the time from launch to the first
+# result: frames written by the frames.py path, a KG written by kg/construct.py's
+# PathProcess with the fake AMR parser and coreference model, and the first answer of
+# the service.py / demo.py query path with the tiny random CLIP and the stub OpenAI
+# server. Loading the real models is not included, as it needs their weights.
+# Run from the repository root: python -m benchmarks.bench_startup
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_decode import write_synthetic_video
+from benchmarks.bench_evidence import build_fixture
+from benchmarks.fake_amr import synthetic_captions
+from benchmarks.stub_openai import start_stub_server
+
+MODULES = ('service', 'clip_index', 'evidence', 'vector_index', 'kg.construct', 'kg.kg_store', 'frames', 'batch',
+           'streaming', 'resources')
+HEAVY = ('torch', 'transformers', 'openai', 'nltk', 'transition_amr_parser', 'fastcoref')
+
+IMPORT_SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                  'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+FRAMES_SNIPPET = '''
+from frame_encoding import FrameEncoder
+from frames import extract_encoded_frames, save_encoded_frames
+frames = extract_encoded_frames({video!r}, 8, FrameEncoder(image_format='jpeg', max_side=768, quality=85))
+save_encoded_frames(frames, {output!r})
+'''
+
+KG_SNIPPET = '''
+import re
+import kg.construct as construct
+from benchmarks.fake_amr import FakeAMRParser
+from benchmarks.fake_coref import FakeCoref
+# the synthetic captions are '. '-separated; nltk's punkt tables may not be installed offline
+construct.sent_tokenize = lambda text: re.split(r'(?<=\\.)\\s+', text.strip())
+coreference = construct.EntityCoreference(window_size=512)
+coreference.coref_model = FakeCoref(max_mentions=8)
+construct.PathProcess({captions!r}, {output!r}, '777', None).constructKG(
+    kg_creator=construct.KGCreator(BATCH_SIZE=32, parser=FakeAMRParser()), entity_coreference=coreference)
+'''
+
+QUERY_SNIPPET = '''
+import openai
+from benchmarks.tiny_clip import tiny_clip
+from service import QueryService
+model, processor = tiny_clip()
+service = QueryService('stub-key', frames_dir={frames_dir!r}, kg_path={kg_path!r}, model=model, processor=processor,
+                       client=openai.Client(api_key='stub-key', base_url={api_base!r}))
+service.answer('Is there a car near the building?')
+'''
+
+
+def run_child(code):
+    # seconds from launch until the child exits, and the last line it printed
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(result.stderr[-2000:])
+    lines = result.stdout.strip().splitlines()
+    return seconds, lines[-1] if lines else ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=8)
+    parser.add_argument('--sentences', type=int, default=3)
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    args = parser.parse_args()
+
+    interpreter = min(run_child('pass')[0] for _ in range(args.repeat))
+    print('interpreter startup: {:.0f} ms\n'.format(interpreter * 1000))
+
+    print('{:>14} {:>16} {:>10}  {}'.format('module', 'import ms min/med', 'process ms', 'heavy modules imported'))
+    for module in args.modules:
+        runs = [run_child(IMPORT_SNIPPET.format(module=module, heavy=HEAVY)) for _ in range(args.repeat)]
+        imports = [json.loads(line)['seconds'] for _, line in runs]
+        print('{:>14} {:>16} {:>10.0f}  {}'.format(
+            module, '{:.0f}/{:.0f}'.format(min(imports) * 1000, statistics.median(imports) * 1000),
+            min(seconds for seconds, _ in runs) * 1000, ', '.join(json.loads(runs[0][1])['heavy']) or '-'))
+
+    work_dir = tempfile.mkdtemp(prefix='bench_startup_')
+    server, api_base = start_stub_server(latency=0.0)
+    try:
+        video_path = os.path.join(work_dir, 'video.avi')
+        write_synthetic_video(video_path, args.frames * 10)
+        frames_dir, kg_path = build_fixture(work_dir, args.frames, args.sentences)
+        captions_path = os.path.join(work_dir, 'captions.json')
+        with open(captions_path, 'w') as captions_file:
+            json.dump([{'frame': 'frames/frame_{}.png'.format(i), 'caption': ' '.join(sentences)}
+                       for i, sentences in enumerate(synthetic_captions(args.frames, args.sentences))], captions_file)
+
+        entry_points = [
+            ('frames.py', FRAMES_SNIPPET.format(video=video_path, output=os.path.join(work_dir, 'decoded'))),
+            ('kg/construct.py', KG_SNIPPET.format(captions=captions_path, output=os.path.join(work_dir, 'kg_run'))),
+            ('service.py', QUERY_SNIPPET.format(frames_dir=frames_dir, kg_path=kg_path, api_base=api_base)),
+        ]
+        print('\n{:>16} {:>20}'.format('entry point', 'first result s min/med'))
+        for name, code in entry_points:
+            # the first run also writes caches (the CLIP frame index), later runs start warm
+            run_child(code)
+            seconds = [run_child(code)[0] for _ in range(args.repeat)]
+            print('{:>16} {:>20}'.format(name, '{:.2f}/{:.2f}'.format(min(seconds), statistics.median(seconds))))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Streaming ingestion over a long synthetic stream fed by a local generator, with
+# captions from the stub server and the fake AMR parser / coreference model.
+# The KG is rolled into segments, so update time and resident memory (sampled per
+# batch) should stay flat as the stream grows.
+# Run from the repository root: python -m benchmarks.bench_streaming
+import argparse
+import os
+import re
+import resource
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from batch import KGStage
+from benchmarks.fake_amr import FakeAMRParser, synthetic_captions
+from benchmarks.fake_coref import FakeCoref
+from benchmarks.stub_openai import start_stub_server
+from captioning import CaptionClient
+from streaming import StreamPipeline, StreamSampler
+
+
+def synthetic_stream(num_frames, size=(640, 360), scene_length=60, fps=30.0, realtime=False, seed=0):
+    # a new flat-coloured scene every scene_length frames, with a moving box in between
+    rng = np.random.default_rng(seed)
+    width, height = size
+    color = rng.integers(0, 256, 3)
+    start = time.perf_counter()
+    for i in range(num_frames):
+        if i % scene_length == 0:
+            color = rng.integers(0, 256, 3)
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = color
+        x = (i * 7) % (width - 40)
+        cv2.rectangle(frame, (x, 40), (x + 40, 80), (255, 255, 255), -1)
+        if realtime:
+            time.sleep(max(0.0, start + i / fps - time.perf_counter()))
+        yield frame
+
+
+def resident_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        # peak instead of current outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class FakeKGStage(KGStage):
+    def load(self):
+        super().load()
+        import kg.construct as construct
+
+        # the synthetic captions are '. '-separated; nltk's punkt tables may not be installed offline
+        construct.sent_tokenize = lambda text: re.split(r'(?<=\.)\s+', text.strip())
+        self.kg_creator.parser = FakeAMRParser()
+        # real coreference clusters are small; unbounded fake clusters would link every repeated word
+        self.entity_coreference.coref_model = FakeCoref(max_mentions=8)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=18000, help='stream length, 10 minutes at 30 fps by default')
+    parser.add_argument('--interval', type=float, default=5.0)
+    parser.add_argument('--change-threshold', type=float, default=0.2)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--caption-batch', type=int, default=8)
+    parser.add_argument('--kg-every', type=int, default=32)
+    parser.add_argument('--segment-frames', type=int, default=128, help='captioned frames per KG segment')
+    parser.add_argument('--realtime', action='store_true', help='feed frames at 30 fps; slow stages then drop frames')
+    args = parser.parse_args()
+
+    captions = [' '.join(sentences) for sentences in synthetic_captions(256, 3)]
+    counter = iter(range(10 ** 9))
+    reply = lambda payload: captions[next(counter) % len(captions)]
+    server, api_base = start_stub_server(latency=args.latency, reply=reply)
+    output_dir = tempfile.mkdtemp(prefix='bench_streaming_')
+
+    try:
+        client = CaptionClient("stub-key", api_base=api_base)
+        pipeline = StreamPipeline(output_dir, caption_client=client, caption_batch=args.caption_batch,
+                                  kg_every=args.kg_every, segment_frames=args.segment_frames, kg_stage=FakeKGStage(parse_cache_path=None, coref_window_size=512))
+        sampler = StreamSampler(args.interval, args.change_threshold, min_interval=0.5)
+
+        print('{:>9} {:>9} {:>10} {:>10} {:>10} {:>8} {:>9}'.format(
+            'elapsed', 'captions', 'segment', 'kg (s)', 'RSS (MB)', 'dropped', 'buffered'))
+        start = time.perf_counter()
+        memory = []
+        stream = synthetic_stream(args.frames, realtime=args.realtime)
+        # a realtime source cannot be paused, so frames are dropped instead of blocking the generator
+        for event in pipeline.run(stream, sampler, ring_capacity=64, drop_oldest=args.realtime):
+            memory.append(resident_mb())
+            if event['kg_seconds'] is not None:
+                print('{:>9.1f} {:>9} {:>10} {:>10.3f} {:>10.1f} {:>8} {:>9}'.format(
+                    time.perf_counter() - start, event['captions'], event['segment'], event['kg_seconds'], memory[-1],
+                    event['dropped'], event['buffered']))
+        elapsed = time.perf_counter() - start
+        client.close()
+
+        quarter = memory[len(memory) // 4] if memory else 0.0
+        print('{} frames in {:.1f}s ({:.0f} frames/s), {} captions, RSS {:.1f} MB after the first quarter, '
+              '{:.1f} MB at the end'.format(args.frames, elapsed, args.frames / elapsed, pipeline.caption_count,
+                                           quarter, memory[-1] if memory else 0.0))
+    finally:
+        server.shutdown()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# IVF-PQ vector index (vector_index.py) vs. brute-force inner product on synthetic
+# CLIP-sized embeddings (see SyntheticEmbeddings), 10k to 1M vectors. Reports
+# build time, bytes per vector, latency and recall@k per nprobe/refine setting,
+# including a cluster-filtered query. Vectors are generated chunk by chunk from a
+# seed, so the brute-force pass never holds the whole float32 matrix.
+# Run from the repository root: python -m benchmarks.bench_vector_index
+import argparse
+import math
+import time
+
+import numpy as np
+
+from vector_index import IVFPQIndex, _top_k
+
+CHUNK = 50000
+VIDEOS = 100
+
+
+def unit(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+class SyntheticEmbeddings:
+    """Unit vectors with CLIP-like statistics: a direction shared by all vectors,
+    a topic and subtopic each, some low-rank variation and noise. Random pairs
+    have a cosine of about 0.47, nearest neighbours about 0.94."""
+
+    def __init__(self, dim=512, topics=200, subtopics=4000, rank=32, weights=(1.0, 0.8, 0.6, 0.3, 0.25), seed=0):
+        rng = np.random.default_rng(seed)
+        self.dim = dim
+        self.common = unit(rng.normal(size=dim))
+        self.topics = unit(rng.normal(size=(topics, dim)))
+        self.subtopics = unit(rng.normal(size=(subtopics, dim)))
+        self.basis = rng.normal(size=(rank, dim))
+        self.weights = weights
+        self.seed = seed
+
+    def chunk(self, start, size):
+        rng = np.random.default_rng((self.seed, start))
+        subtopic = rng.integers(0, len(self.subtopics), size)
+        common, topic, sub, low_rank, noise = self.weights
+        vectors = common * self.common + topic * self.topics[subtopic % len(self.topics)]
+        vectors += sub * self.subtopics[subtopic]
+        vectors += low_rank * unit(rng.normal(size=(size, len(self.basis))) @ self.basis)
+        vectors += noise * unit(rng.normal(size=(size, self.dim)))
+        return unit(vectors).astype(np.float32)
+
+    def chunks(self, count):
+        for start in range(0, count, CHUNK):
+            yield start, self.chunk(start, min(CHUNK, count - start))
+
+
+def records(start, size):
+    # every vector belongs to one of VIDEOS clusters and a doc within it
+    rows = np.arange(start, start + size)
+    kinds = ('image', 'caption', 'node')
+    return [{'kind': kinds[row % 3], 'cluster_id': 'video_{}'.format(row % VIDEOS), 'doc_id': int(row // VIDEOS % 500),
+             'row': int(row)} for row in rows]
+
+
+def brute_force(data, count, queries, k, cluster=None):
+    # exact top-k by a running merge over chunks; also returns the time per query
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    seconds = 0.0
+    for start, vectors in data.chunks(count):
+        rows = np.arange(start, start + len(vectors))
+        if cluster is not None:
+            keep = rows % VIDEOS == cluster
+            rows, vectors = rows[keep], vectors[keep]
+        begin = time.perf_counter()
+        scores = np.concatenate([best_scores, queries @ vectors.T], axis=1)
+        candidates = np.concatenate([np.broadcast_to(best_rows, (len(queries), best_rows.shape[1])),
+                                     np.broadcast_to(rows, (len(queries), len(rows)))], axis=1)
+        top = np.stack([_top_k(row, k) for row in scores])
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(candidates, top, axis=1)
+        seconds += time.perf_counter() - begin
+    return best_rows, seconds / len(queries)
+
+
+def recall(results, truth):
+    return np.mean([len({record['row'] for record, _ in result} & set(rows)) / len(rows)
+                    for result, rows in zip(results, truth)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--m', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--refine', type=int, nargs='+', default=[0, 4, 16])
+    parser.add_argument('--train-iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    data = SyntheticEmbeddings(args.dim)
+    rng = np.random.default_rng(1)
+    for count in args.sizes:
+        # queries are perturbed copies of indexed vectors, like a caption close to one frame
+        picked = rng.integers(0, count, args.queries)
+        queries = np.empty((args.queries, args.dim), dtype=np.float32)
+        for chunk_start in np.unique(picked // CHUNK * CHUNK):
+            in_chunk = picked // CHUNK * CHUNK == chunk_start
+            queries[in_chunk] = data.chunk(chunk_start, min(CHUNK, count - chunk_start))[picked[in_chunk] - chunk_start]
+        queries += 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        nlist = min(1024, 2 ** round(math.log2(4 * math.sqrt(count))))
+        index = IVFPQIndex(args.dim, nlist=nlist, m=args.m, refine=max(args.refine))
+        start = time.perf_counter()
+        index.train(data.chunk(0, min(count, 64 * nlist)), iterations=args.train_iterations)
+        train_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for chunk_start, vectors in data.chunks(count):
+            # one add per chunk, as videos are added one by one
+            index.add(vectors, records(chunk_start, len(vectors)))
+        index.compact()
+        add_seconds = time.perf_counter() - start
+
+        truth, exact_seconds = brute_force(data, count, queries, args.k)
+        filtered_truth, _ = brute_force(data, count, queries, args.k, cluster=0)
+        # the float16 refinement copy is memory-mapped once saved, the rest stays resident
+        refine_bytes = 2 * args.dim if index.refine else 0
+        print('\n{} vectors, nlist={}, m={}: train {:.1f}s, add {:.0f} vectors/s, {:.0f} bytes/vector '
+              '+ {} for refinement, brute force {:.2f} ms/query'.format(
+                  count, nlist, args.m, train_seconds, count / add_seconds, index.nbytes() / count - refine_bytes,
+                  refine_bytes, exact_seconds * 1000))
+        print('{:>7} {:>7} {:>10} {:>10} {:>16}'.format('nprobe', 'refine', 'recall@{}'.format(args.k), 'ms/query',
+                                                        'filtered recall'))
+        for refine in args.refine:
+            index.refine = refine
+            for nprobe in args.nprobe:
+                start = time.perf_counter()
+                results = index.search(queries, args.k, nprobe=nprobe)
+                seconds = (time.perf_counter() - start) / len(queries)
+                filtered = index.search(queries, args.k, nprobe=nprobe, cluster_ids=['video_0'])
+                print('{:>7} {:>7} {:>10.3f} {:>10.2f} {:>16.3f}'.format(
+                    nprobe, refine, recall(results, truth), seconds * 1000, recall(filtered, filtered_truth)))
+        del index
+
+
+if __name__ == '__main__':
+    main()
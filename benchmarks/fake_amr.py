@@ -0,0 +1,81 @@
+# Deterministic stand-in for transition_amr_parser's AMRParser. It emits a valid
+# penman tree with alignments for every sentence, so KG construction can be
+# benchmarked without the AMR3-structbart-L checkpoint.
+import re
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+ROLES = (':ARG0', ':ARG1', ':mod', ':location')
+
+
+class FakeAMR:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.nodes = {}
+        self.alignments = {}
+
+        content = [(i, token.lower()) for i, token in enumerate(tokens) if token.isalnum()]
+        if not content:
+            content = [(0, 'thing')]
+
+        self.children = {}
+        self.attributes = []
+        for position, (token_index, token) in enumerate(content):
+            variable = 'z{}'.format(position)
+            if token.isdigit():
+                # numbers become attributes of the previous concept, like AMR :quant
+                self.attributes.append(('z{}'.format(max(position - 1, 0)), ':quant', token))
+                continue
+            self.nodes[variable] = token
+            self.alignments[variable] = [token_index]
+            if position:
+                parent = 'z{}'.format((position - 1) // 2)
+                while parent not in self.nodes:
+                    parent = 'z{}'.format((int(parent[1:]) - 1) // 2)
+                self.children.setdefault(parent, []).append((ROLES[position % len(ROLES)], variable))
+
+    def to_penman(self, isi=False):
+        return self.render(next(iter(self.nodes)))
+
+    def render(self, variable):
+        parts = ['({} / {}'.format(variable, self.nodes[variable])]
+        for role, child in self.children.get(variable, []):
+            parts.append('{} {}'.format(role, self.render(child)))
+        for source, role, value in self.attributes:
+            if source == variable:
+                parts.append('{} {}'.format(role, value))
+        return ' '.join(parts) + ')'
+
+
+class FakeDecodingData:
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def get_amr(self):
+        return FakeAMR(self.tokens)
+
+
+class FakeAMRParser:
+    def tokenize(self, sentence):
+        tokens = TOKEN_PATTERN.findall(sentence)
+        return tokens, list(range(len(tokens)))
+
+    def parse_sentences(self, batch):
+        return [None] * len(batch), [FakeDecodingData(tokens) for tokens in batch]
+
+
+def synthetic_captions(num_captions, sentences_per_caption, words_per_sentence=12, seed=0):
+    import random
+
+    rng = random.Random(seed)
+    vocabulary = ['image', 'scene', 'building', 'tree', 'car', 'person', 'road', 'sidewalk', 'campus',
+                  'window', 'bench', 'sky', 'shade', 'street', 'lamp', 'people', 'walk', 'park', 'green', 'large']
+    captions = []
+    for _ in range(num_captions):
+        sentences = []
+        for _ in range(sentences_per_caption):
+            words = [rng.choice(vocabulary) for _ in range(words_per_sentence)]
+            if rng.random() < 0.3:
+                words.insert(rng.randrange(1, len(words)), str(rng.randrange(2, 9)))
+            sentences.append(' '.join(words).capitalize() + '.')
+        captions.append(sentences)
+    return captions
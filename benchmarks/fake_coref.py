@@ -0,0 +1,32 @@
+# Deterministic stand-in for fastcoref's FCoref: every repeated content word forms a
+# cluster of single-token mentions, which gives realistic cluster sizes for the
+# synthetic captions in benchmarks/fake_amr.py.
+
+
+class FakeCorefResult:
+    def __init__(self, tokens, clusters):
+        self.tokens = tokens
+        self.clusters = clusters
+
+    def get_clusters(self, as_strings=True):
+        if as_strings:
+            return [[' '.join(self.tokens[start:end]) for start, end in cluster] for cluster in self.clusters]
+        return self.clusters
+
+
+class FakeCoref:
+    def __init__(self, max_mentions=None, device='cpu'):
+        self.max_mentions = max_mentions
+        self.device = device
+
+    def predict(self, texts, is_split_into_words=False, max_tokens_in_batch=10000):
+        results = []
+        for text in texts:
+            tokens = text if is_split_into_words else text.split()
+            mentions = {}
+            for index, token in enumerate(tokens):
+                if token.isalpha() and len(token) > 3:
+                    mentions.setdefault(token.lower(), []).append((index, index + 1))
+            clusters = [spans[:self.max_mentions] for spans in mentions.values() if len(spans) > 1]
+            results.append(FakeCorefResult(tokens, clusters))
+        return results
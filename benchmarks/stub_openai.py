@@ -0,0 +1,63 @@
+# Local stand-in for the chat completions endpoint with artificial latency and
+# optional transient failures, for exercising CaptionClient without the network.
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        payload = json.loads(body)
+
+        with server.lock:
+            server.request_count += 1
+            request_number = server.request_count
+
+        time.sleep(server.latency)
+
+        if server.fail_every and request_number % server.fail_every == 0:
+            self.send_json(429 if request_number % 2 else 503, {"error": {"message": "stub failure"}},
+                           headers={"Retry-After": "0"})
+            return
+
+        text = " ".join(
+            part["text"] for part in payload["messages"][-1]["content"] if part["type"] == "text")
+        image_bytes = sum(
+            len(part["image_url"]["url"]) for part in payload["messages"][-1]["content"] if part["type"] == "image_url")
+        content = server.reply(payload) if server.reply else \
+            "Stub caption for a {}-byte image ({}).".format(image_bytes, text)
+        self.send_json(200, {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        })
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency=0.1, fail_every=0, reply=None, port=0):
+    """Start the stub on a background thread and return (server, api_base)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubChatHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_every = fail_every
+    server.reply = reply
+    server.lock = threading.Lock()
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/v1".format(server.server_address[1])
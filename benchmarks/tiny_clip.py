@@ -0,0 +1,46 @@
+# Random-weight CLIP with the same interface as openai/clip-vit-base-patch32 but a
+# few layers of width 32, and a processor that needs no downloaded tokenizer files.
+# Scores are meaningless; shapes, batching and the code paths around them are real.
+import torch
+from transformers import CLIPConfig, CLIPImageProcessor, CLIPModel
+
+VOCAB_SIZE = 1000
+MAX_TEXT_LENGTH = 32
+
+
+class TinyCLIPProcessor:
+    def __init__(self, image_size=64):
+        self.image_processor = CLIPImageProcessor(size={"shortest_edge": image_size},
+                                                  crop_size={"height": image_size, "width": image_size})
+
+    def tokenize(self, text):
+        # byte ids folded into the vocabulary, ending with the highest id so CLIP's argmax pooling finds it
+        ids = [byte % (VOCAB_SIZE - 2) + 1 for byte in text.encode('utf-8')][:MAX_TEXT_LENGTH - 1]
+        return ids + [VOCAB_SIZE - 1]
+
+    def __call__(self, text=None, images=None, return_tensors="pt", padding=True, truncation=True, max_length=None):
+        # text is always truncated to MAX_TEXT_LENGTH tokens
+        inputs = {}
+        if images is not None:
+            inputs.update(self.image_processor(images=images, return_tensors=return_tensors))
+        if text is not None:
+            ids = [self.tokenize(t) for t in ([text] if isinstance(text, str) else text)]
+            length = max(len(i) for i in ids)
+            inputs['input_ids'] = torch.tensor([i + [0] * (length - len(i)) for i in ids])
+            inputs['attention_mask'] = torch.tensor([[1] * len(i) + [0] * (length - len(i)) for i in ids])
+        return inputs
+
+
+def tiny_clip(image_size=64, seed=0):
+    """Return (model, processor) for a randomly initialised CLIP small enough for CPU benchmarks."""
+    torch.manual_seed(seed)
+    config = CLIPConfig(
+        text_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                         vocab_size=VOCAB_SIZE, max_position_embeddings=MAX_TEXT_LENGTH,
+                         bos_token_id=0, pad_token_id=0, eos_token_id=2),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=image_size, patch_size=16),
+        projection_dim=16)
+    model = CLIPModel(config)
+    model.eval()
+    return model, TinyCLIPProcessor(image_size)
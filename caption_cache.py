@@ -0,0 +1,85 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+class CaptionCache:
+    """Disk-backed caption cache keyed by the frame content and the request settings.
+
+    Entries are evicted least-recently-used first once the stored captions
+    exceed `max_bytes`. Hit/miss counters cover the lifetime of this object.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS captions ('
+            'key TEXT PRIMARY KEY, caption TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS captions_last_access ON captions (last_access)')
+        self.connection.commit()
+
+    @staticmethod
+    def key(frame_bytes, model, prompt, max_tokens):
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(frame_bytes).digest())
+        for part in (model, prompt, str(max_tokens)):
+            digest.update(b'\0' + part.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT caption FROM captions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE captions SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, caption):
+        size = len(caption.encode('utf-8'))
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO captions (key, caption, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, caption, size, time.time()))
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM captions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.connection.execute(
+                'SELECT key, size FROM captions ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM captions WHERE key = ?', (key,))
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            entries, total = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM captions').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': total,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,191 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from profiling import stage
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+CAPTION_PROMPT = "What’s in this image?"
+
+# a high-detail image is billed as 85 base tokens plus 170 per 512px tile;
+# assume four tiles when the size is unknown
+IMAGE_TOKEN_ESTIMATE = 85 + 170 * 4
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Token buckets for requests per minute and tokens per minute, shared across threads."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.request_budget = float(requests_per_minute or 0)
+        self.token_budget = float(tokens_per_minute or 0)
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.request_budget = min(self.requests_per_minute,
+                                      self.request_budget + elapsed * self.requests_per_minute / 60.0)
+        if self.tokens_per_minute:
+            self.token_budget = min(self.tokens_per_minute,
+                                    self.token_budget + elapsed * self.tokens_per_minute / 60.0)
+
+    def acquire(self, tokens=0):
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return
+        # a single request larger than the whole bucket would otherwise wait forever
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self.lock:
+                self.refill()
+                wait = 0.0
+                if self.requests_per_minute and self.request_budget < 1:
+                    wait = max(wait, (1 - self.request_budget) * 60.0 / self.requests_per_minute)
+                if self.tokens_per_minute and self.token_budget < tokens:
+                    wait = max(wait, (tokens - self.token_budget) * 60.0 / self.tokens_per_minute)
+                if wait == 0.0:
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    return
+            time.sleep(wait)
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        # correct the token bucket once the API reports the real usage
+        if self.tokens_per_minute and actual_tokens is not None:
+            with self.lock:
+                self.token_budget += estimated_tokens - actual_tokens
+
+
+class CaptionClient:
+    """Caption images through the chat completions API with a pooled session.
+
+    Requests run on a bounded thread pool, share one keep-alive session, are
+    rate limited per minute and retried with exponential backoff on 429/5xx.
+    """
+
+    def __init__(self, api_key, model="gpt-4o", prompt=CAPTION_PROMPT, max_tokens=300,
+                 max_workers=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, backoff=1.0, max_backoff=60.0, timeout=120, api_base=OPENAI_API_BASE,
+                 cache=None):
+        self.model = model
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.url = "{}/chat/completions".format(api_base.rstrip('/'))
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        })
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def build_payload(self, base64_image, mime_type="image/jpeg"):
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                "role": "user",
+                "content": [
+                    {
+                    "type": "text",
+                    "text": self.prompt
+                    },
+                    {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{base64_image}"
+                    }
+                    }
+                ]
+                }
+            ],
+            "max_tokens": self.max_tokens
+        }
+
+    def estimate_tokens(self):
+        return len(self.prompt) // 4 + IMAGE_TOKEN_ESTIMATE + self.max_tokens
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return min(float(response.headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * (0.5 + random.random() / 2)
+
+    def request_caption(self, base64_image, mime_type="image/jpeg"):
+        payload = self.build_payload(base64_image, mime_type)
+        estimated_tokens = self.estimate_tokens()
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                # one span per HTTP attempt: API latency and uploaded base64 bytes
+                with stage('caption_request', items=1, nbytes=len(base64_image), attempt=attempt):
+                    response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                logger.warning('Caption request failed ({}), retrying in {:.1f}s', e, delay)
+                time.sleep(delay)
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = self.retry_delay(attempt, response)
+                logger.warning('Caption request returned {}, retrying in {:.1f}s', response.status_code, delay)
+                time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            result = response.json()
+            self.rate_limiter.reconcile(estimated_tokens, result.get('usage', {}).get('total_tokens'))
+            return result['choices'][0]['message']['content']
+
+    def caption(self, base64_image, mime_type="image/jpeg"):
+        if self.cache is None:
+            return self.request_caption(base64_image, mime_type)
+
+        key = self.cache.key(base64_image.encode('ascii'), self.model, self.prompt, self.max_tokens)
+        caption = self.cache.get(key)
+        if caption is None:
+            caption = self.request_caption(base64_image, mime_type)
+            self.cache.put(key, caption)
+        return caption
+
+    def caption_all(self, base64_images, mime_type="image/jpeg"):
+        # results come back in the order of the input images
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda image: self.caption(image, mime_type), base64_images))
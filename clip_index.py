@@ -0,0 +1,310 @@
+import json
+import os
+import threading
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from profiling import stage
+from resources import pretrained
+
+CLIP_MODEL = "openai/clip-vit-base-patch32"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def _features(output):
+    # older transformers return the projected features, newer ones a model output
+    return output.pooler_output if hasattr(output, 'pooler_output') else output
+
+
+def _tower(model, method):
+    # one CLIP tower as a module, for tracing
+    import torch
+
+    class Tower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return _features(getattr(self.model, method)(*inputs))
+
+    return Tower().eval()
+
+
+def set_cpu_threads(threads=None, interop_threads=None):
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # only possible before the first inter-op parallel work in the process
+            logger.warning('Could not set inter-op threads, keeping {}', torch.get_num_interop_threads())
+
+
+class CPUCLIPModel:
+    """CLIPModel for CPU-only hosts.
+
+    The linear layers are dynamically quantized to int8 (`quantize`), intra-
+    and inter-op thread counts are pinned and both towers run under
+    `torch.inference_mode`. With `trace=True` each tower is traced and frozen
+    on its first call; traced text inputs are padded to the full context
+    length, since the position embeddings are fixed at trace time. Provides
+    the part of the CLIPModel interface that FrameIndex, score_frames and
+    QueryService use.
+    """
+
+    def __init__(self, model, quantize=True, trace=False, threads=None, interop_threads=None):
+        import torch
+
+        set_cpu_threads(threads, interop_threads)
+        model.eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.config = model.config
+        self.logit_scale = model.logit_scale
+        self.trace = trace
+        self.context_length = model.config.text_config.max_position_embeddings
+        self.towers = {}
+
+    def eval(self):
+        return self
+
+    def run(self, method, *inputs):
+        import torch
+
+        with torch.inference_mode():
+            if not self.trace:
+                return _features(getattr(self.model, method)(*inputs))
+            if method not in self.towers:
+                tower = _tower(self.model, method)
+                self.towers[method] = torch.jit.freeze(torch.jit.trace(tower, inputs, check_trace=False))
+            return self.towers[method](*inputs)
+
+    def get_image_features(self, pixel_values, **kwargs):
+        return self.run('get_image_features', pixel_values)
+
+    def get_text_features(self, input_ids, attention_mask=None, **kwargs):
+        import torch
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if self.trace:
+            # padding is masked out and after the end token, so it does not change the features
+            padding = self.context_length - input_ids.shape[1]
+            input_ids = torch.nn.functional.pad(input_ids, (0, padding))
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, padding))
+        return self.run('get_text_features', input_ids, attention_mask)
+
+
+def load_clip_model(model_name=CLIP_MODEL, cpu_optimized=False, **cpu_options):
+    """Load CLIP in eval mode from the local cache (see resources.py), wrapped in CPUCLIPModel if `cpu_optimized`."""
+    from transformers import CLIPModel
+
+    model = pretrained(CLIPModel, model_name)
+    model.eval()
+    return CPUCLIPModel(model, **cpu_options) if cpu_optimized else model
+
+
+def load_clip_processor(model_name=CLIP_MODEL):
+    from transformers import CLIPProcessor
+
+    return pretrained(CLIPProcessor, model_name)
+
+
+def _normalize(features):
+    return features / np.linalg.norm(features, axis=-1, keepdims=True).clip(min=1e-12)
+
+
+def top_k_scores(scores, top_k):
+    # per-row indices of the top_k scores in descending order, without a full sort
+    top_k = min(top_k, scores.shape[1])
+    if top_k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def encode_image_batches(model, processor, image_paths, batch_size=16):
+    # normalized image embeddings, running the vision tower batch_size images at a time
+    import torch
+
+    features = []
+    for start in range(0, len(image_paths), batch_size):
+        with stage('clip_scoring', items=min(batch_size, len(image_paths) - start), tower='image'):
+            images = [Image.open(path).convert('RGB') for path in image_paths[start:start + batch_size]]
+            inputs = processor(images=images, return_tensors="pt")
+            with torch.inference_mode():
+                features.append(_features(model.get_image_features(**inputs)).numpy())
+    return _normalize(np.concatenate(features)).astype(np.float32)
+
+
+def score_frames(model, processor, image_paths, questions, batch_size=16, top_k=1):
+    """Score every question against every image in one pass over the images.
+
+    Images go through the vision tower `batch_size` at a time and all questions
+    through the text tower once. Returns, per question, the top_k
+    (image_path, score) pairs with scores on the `logits_per_image` scale.
+    """
+    import torch
+
+    with stage('clip_scoring', items=len(questions), tower='text'):
+        text_inputs = processor(text=questions, return_tensors="pt", padding=True)
+        with torch.inference_mode():
+            text_features = _normalize(_features(model.get_text_features(**text_inputs)).numpy())
+
+    image_features = encode_image_batches(model, processor, image_paths, batch_size)
+
+    scores = text_features @ image_features.T * model.logit_scale.exp().item()
+    return [[(image_paths[col], float(scores[row, col])) for col in cols]
+            for row, cols in enumerate(top_k_scores(scores, top_k))]
+
+
+class FrameIndex:
+    """Normalized CLIP image embeddings of a frames directory.
+
+    The embeddings are stored in `index_dir/embeddings.npy` (memory-mapped when
+    loaded) with an `ids.json` sidecar listing the id, path, size and mtime of
+    each row. `build` only re-encodes frames that were added or changed.
+    """
+
+    def __init__(self, frames_dir='frames', index_dir=None, model=None, processor=None,
+                 model_name=CLIP_MODEL, batch_size=16, model_options=None):
+        self.frames_dir = frames_dir
+        self.index_dir = index_dir or frames_dir.rstrip('/\\') + '_index'
+        self.model_name = model_name
+        self.batch_size = batch_size
+        # CLIP is loaded on first use with load_clip_model(model_name, **model_options)
+        self.model = model
+        self.processor = processor
+        self.model_options = model_options or {}
+        self.model_lock = threading.Lock()
+        self.entries = []
+        self.embeddings = None
+
+    @property
+    def embeddings_path(self):
+        return os.path.join(self.index_dir, 'embeddings.npy')
+
+    @property
+    def sidecar_path(self):
+        return os.path.join(self.index_dir, 'ids.json')
+
+    def load_model(self):
+        # concurrent first questions load CLIP once
+        with self.model_lock:
+            if self.model is None:
+                self.model = load_clip_model(self.model_name, **self.model_options)
+            if self.processor is None:
+                self.processor = load_clip_processor(self.model_name)
+
+    def scan(self):
+        entries = []
+        for image_file in sorted(os.listdir(self.frames_dir)):
+            if not image_file.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            image_path = os.path.join(self.frames_dir, image_file)
+            stat = os.stat(image_path)
+            entries.append({
+                'id': os.path.splitext(image_file)[0],
+                'path': image_path,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+            })
+        return entries
+
+    def load(self):
+        if not os.path.exists(self.sidecar_path) or not os.path.exists(self.embeddings_path):
+            return False
+        with open(self.sidecar_path) as sidecar:
+            sidecar = json.load(sidecar)
+        if sidecar['model'] != self.model_name:
+            return False
+        self.entries = sidecar['entries']
+        self.embeddings = np.load(self.embeddings_path, mmap_mode='r')
+        return True
+
+    def encode_images(self, image_paths):
+        self.load_model()
+        return encode_image_batches(self.model, self.processor, image_paths, self.batch_size)
+
+    def encode_text(self, texts):
+        import torch
+
+        self.load_model()
+        with stage('clip_scoring', items=len(texts), tower='text'):
+            inputs = self.processor(text=texts, return_tensors="pt", padding=True)
+            with torch.inference_mode():
+                features = _features(self.model.get_text_features(**inputs)).numpy()
+        return _normalize(features).astype(np.float32)
+
+    def build(self):
+        """Bring the index up to date with the frames directory; returns the number of frames encoded."""
+        self.load()
+        previous = {(entry['path'], entry['size'], entry['mtime_ns']): row for row, entry in enumerate(self.entries)}
+        entries = self.scan()
+        stale = [entry for entry in entries if (entry['path'], entry['size'], entry['mtime_ns']) not in previous]
+
+        if not entries and self.embeddings is None:
+            # no frames and no saved index; the embedding width is unknown until a frame is encoded
+            self.entries = []
+            self.embeddings = np.empty((0, 0), dtype=np.float32)
+            return 0
+        if not stale and len(entries) == len(self.entries):
+            return 0
+
+        logger.info('Encoding {} of {} frames into {}', len(stale), len(entries), self.index_dir)
+        encoded = dict(zip((entry['path'] for entry in stale),
+                           self.encode_images([entry['path'] for entry in stale]))) if stale else {}
+
+        dim = next(iter(encoded.values())).shape[0] if encoded else self.embeddings.shape[1]
+        embeddings = np.empty((len(entries), dim), dtype=np.float32)
+        for row, entry in enumerate(entries):
+            key = (entry['path'], entry['size'], entry['mtime_ns'])
+            embeddings[row] = encoded[entry['path']] if key not in previous else self.embeddings[previous[key]]
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        # write to temporary files first so a crash never leaves a half-written index
+        with open(self.embeddings_path + '.tmp', 'wb') as embeddings_file:
+            np.save(embeddings_file, embeddings)
+        with open(self.sidecar_path + '.tmp', 'w') as sidecar:
+            json.dump({'model': self.model_name, 'entries': entries}, sidecar)
+        os.replace(self.embeddings_path + '.tmp', self.embeddings_path)
+        os.replace(self.sidecar_path + '.tmp', self.sidecar_path)
+
+        self.load()
+        return len(stale)
+
+    def score_many(self, questions, embeddings=None):
+        """Return the (questions, entries) score matrix on the `logits_per_image` scale.
+
+        `embeddings` defaults to the index's own; QueryService passes the rows it read
+        together with their entries, as a refresh may replace both in between.
+        """
+        if embeddings is None:
+            if self.embeddings is None and not self.load():
+                raise ValueError("Index {} has not been built".format(self.index_dir))
+            embeddings = self.embeddings
+        if len(embeddings) == 0:
+            return np.empty((len(questions), 0), dtype=np.float32)
+        self.load_model()
+
+        text_features = self.encode_text(questions)
+        with stage('clip_scoring', items=len(embeddings), tower='similarity'):
+            scores = text_features @ np.asarray(embeddings).T
+            return scores * self.model.logit_scale.exp().item()
+
+    def search_many(self, questions, top_k=1):
+        """Return, per question, the top_k (entry, score) pairs; scores are on the `logits_per_image` scale."""
+        scores = self.score_many(questions)
+        return [[(self.entries[col], float(scores[row, col])) for col in cols]
+                for row, cols in enumerate(top_k_scores(scores, top_k))]
+
+    def search(self, question, top_k=1):
+        return self.search_many([question], top_k)[0]
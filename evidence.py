@@ -0,0 +1,210 @@
+import math
+import re
+
+from PIL import Image
+
+# rough prompt-side estimates, in the spirit of CaptionClient.estimate_tokens:
+# ~4 characters per text token and a few tokens of framing per message part
+CHARS_PER_TOKEN = 4
+PART_OVERHEAD_TOKENS = 4
+
+STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'of', 'in', 'on', 'at', 'to', 'for', 'with', 'by', 'from', 'is', 'are', 'was',
+    'were', 'be', 'been', 'do', 'does', 'did', 'there', 'this', 'that', 'these', 'those', 'it', 'its', 'what',
+    'which', 'who', 'whom', 'where', 'when', 'how', 'many', 'much', 'any', 'some', 'can', 'could', 'you', 'i',
+}
+
+
+def text_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) + PART_OVERHEAD_TOKENS
+
+
+def image_tokens(width, height, detail='high'):
+    """Prompt tokens of one image as billed by the OpenAI vision models.
+
+    Low detail is a flat 85 tokens. High detail fits the image into 2048x2048,
+    scales its shortest side down to 768 and adds 170 tokens per 512px tile.
+    """
+    if detail == 'low':
+        return 85 + PART_OVERHEAD_TOKENS
+    if max(width, height) > 2048:
+        width, height = (side * 2048 / max(width, height) for side in (width, height))
+    if min(width, height) > 768:
+        width, height = (side * 768 / min(width, height) for side in (width, height))
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles + PART_OVERHEAD_TOKENS
+
+
+def caption_text(doc_id, caption):
+    # the prompt line of one piece of evidence; frames not in the KG yet have no caption
+    if caption is None:
+        return f"Image ID[{doc_id}]"
+    return f"Image ID[{doc_id}]: {caption}"
+
+
+def content_words(text):
+    return {word for word in re.findall(r'[a-z0-9]+', text.lower()) if word not in STOPWORDS}
+
+
+def caption_coverage(question, caption):
+    # share of the question's content words that the caption mentions
+    words = content_words(question)
+    if not words:
+        return 1.0
+    return len(words & content_words(caption)) / len(words)
+
+
+class LatencyModel:
+    """Estimated LLM request latency from prompt tokens and image count.
+
+    `observe` rescales the estimate towards measured latencies, so the latency
+    budget tracks how fast the endpoint actually is.
+    """
+
+    def __init__(self, base=1.5, per_1k_tokens=0.3, per_image=0.3, smoothing=0.2):
+        self.base = base
+        self.per_1k_tokens = per_1k_tokens
+        self.per_image = per_image
+        self.smoothing = smoothing
+        self.scale = 1.0
+
+    def estimate(self, tokens, images):
+        return self.scale * (self.base + tokens / 1000 * self.per_1k_tokens + images * self.per_image)
+
+    def observe(self, tokens, images, seconds):
+        raw = self.estimate(tokens, images) / self.scale
+        self.scale = (1 - self.smoothing) * self.scale + self.smoothing * seconds / raw
+
+
+class EvidenceSelector:
+    """Pick the captions and frames sent to the LLM within a token and latency budget.
+
+    Candidates are the frames CLIP retrieved (0 hops) and their coreference
+    neighbours in the KG up to `max_hops`. Each is scored by
+    `clip_weight * clip + (1 - clip_weight) * 1 / (1 + hops)`, where `clip` is
+    the frame's best CLIP score scaled to [0, 1] over the candidates, and
+    candidates are added greedily in score order. A caption is added if it
+    fits. The frame itself is only attached when the caption covers fewer
+    than `caption_sufficient` of the question's content words, or for the
+    `min_images` best frames; a high-detail image that does not fit falls
+    back to low detail.
+    """
+
+    def __init__(self, max_tokens=4000, max_latency=None, max_images=4, min_images=1, max_hops=1,
+                 clip_weight=0.7, caption_sufficient=0.6, latency_model=None):
+        self.max_tokens = max_tokens
+        self.max_latency = max_latency
+        self.max_images = max_images
+        self.min_images = min_images
+        self.max_hops = max_hops
+        self.clip_weight = clip_weight
+        self.caption_sufficient = caption_sufficient
+        self.latency_model = latency_model or LatencyModel()
+
+    def candidates(self, kg, seed_doc_ids):
+        # breadth-first over coreference links; returns {doc_id: hops}
+        hops = {str(doc_id): 0 for doc_id in seed_doc_ids}
+        frontier = list(hops)
+        for hop in range(1, self.max_hops + 1):
+            next_frontier = []
+            for doc_id in frontier:
+                for neighbour in kg.coreferences(doc_id):
+                    if str(neighbour) not in hops:
+                        hops[str(neighbour)] = hop
+                        next_frontier.append(str(neighbour))
+            frontier = next_frontier
+        return hops
+
+    def rank(self, hops, clip_scores):
+        # clip_scores: {doc_id: score}; frames without an index entry cannot be shown
+        doc_ids = [doc_id for doc_id in hops if doc_id in clip_scores]
+        if not doc_ids:
+            return []
+        low = min(clip_scores[doc_id] for doc_id in doc_ids)
+        high = max(clip_scores[doc_id] for doc_id in doc_ids)
+        ranked = []
+        for doc_id in doc_ids:
+            clip = (clip_scores[doc_id] - low) / (high - low) if high > low else 1.0
+            score = self.clip_weight * clip + (1 - self.clip_weight) / (1 + hops[doc_id])
+            ranked.append((score, doc_id))
+        # ties go to the closer and then the better CLIP match
+        ranked.sort(key=lambda item: (-item[0], hops[item[1]], -clip_scores[item[1]]))
+        return ranked
+
+    def fits(self, tokens, images):
+        if tokens > self.max_tokens:
+            return False
+        return self.max_latency is None or self.latency_model.estimate(tokens, images) <= self.max_latency
+
+    def select(self, question, kg, seed_doc_ids, clip_scores, frame_locations, image_size, base_tokens=0,
+               max_side=None):
+        """Return (evidence, summary).
+
+        `evidence` lists dicts with frame_id, location, caption, score, hops,
+        clip_score, tokens and `image` (None, 'high' or 'low'); `image_size`
+        maps a frame path to its (width, height) and `max_side` is the
+        downscale applied before upload. The best candidate's caption is
+        always included so the LLM has something to go on. Frames indexed
+        but not yet in the KG have no caption (None) and are only kept when
+        their image fits.
+        """
+        hops = self.candidates(kg, seed_doc_ids)
+        tokens = base_tokens
+        images = 0
+        evidence = []
+        skipped = 0
+        for rank, (score, doc_id) in enumerate(self.rank(hops, clip_scores)):
+            try:
+                caption = kg.doc_info(doc_id)['image']
+            except KeyError:
+                # indexed but not in the KG yet: ranked by CLIP alone and only usable as an image
+                caption = None
+            caption_cost = text_tokens(caption_text(doc_id, caption))
+            if rank > 0 and not self.fits(tokens + caption_cost, images):
+                skipped += 1
+                continue
+            item = {
+                'frame_id': doc_id,
+                'location': frame_locations[doc_id],
+                'caption': caption,
+                'score': score,
+                'hops': hops[doc_id],
+                'clip_score': clip_scores[doc_id],
+                'image': None,
+                'tokens': caption_cost,
+            }
+
+            needs_image = caption is None or images < self.min_images or \
+                caption_coverage(question, caption) < self.caption_sufficient
+            if needs_image and images < self.max_images:
+                width, height = image_size(item['location'])
+                if max_side and max(width, height) > max_side:
+                    width, height = (max(1, round(side * max_side / max(width, height))) for side in (width, height))
+                for detail in ('high', 'low'):
+                    cost = image_tokens(width, height, detail)
+                    if self.fits(tokens + caption_cost + cost, images + 1):
+                        item['image'] = detail
+                        item['tokens'] += cost
+                        images += 1
+                        break
+            if caption is None and item['image'] is None:
+                skipped += 1
+                continue
+            tokens += item['tokens']
+            evidence.append(item)
+
+        summary = {
+            'tokens': tokens,
+            'images': images,
+            'captions': sum(1 for item in evidence if item['caption'] is not None),
+            'candidates': len(hops),
+            'skipped': skipped,
+            'estimated_latency': self.latency_model.estimate(tokens, images),
+        }
+        return evidence, summary
+
+
+def read_image_size(path):
+    # PIL reads the header only
+    with Image.open(path) as image:
+        return image.size
@@ -0,0 +1,142 @@
+import base64
+import os
+import threading
+from functools import cached_property
+
+import cv2
+
+from profiling import stage
+
+MIME_TYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+
+EXTENSIONS = {
+    'jpeg': '.jpg',
+    'webp': '.webp',
+    'png': '.png',
+}
+# every extension a frame may have been written with, including split_video_into_frames' PNGs
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+class EncodedFrame:
+    """An encoded frame kept in memory; the base64 payload is computed once."""
+
+    def __init__(self, name, data, mime_type, source_bytes=None):
+        self.name = name
+        self.data = data
+        self.mime_type = mime_type
+        # size of the original file when encoded from one; None for decoded frames
+        self.source_bytes = source_bytes
+
+    @cached_property
+    def base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    @property
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    def save(self, output_dir):
+        path = os.path.join(output_dir, self.name)
+        with open(path, 'wb') as image_file:
+            image_file.write(self.data)
+        # a copy of the same frame in another format would be indexed under the same doc id
+        stem, extension = os.path.splitext(path)
+        for other in FRAME_EXTENSIONS:
+            if other != extension and os.path.exists(stem + other):
+                os.remove(stem + other)
+        return path
+
+
+class FrameEncoder:
+    """Encode decoded frames straight to JPEG/WebP bytes, downscaled to `max_side` pixels.
+
+    Files encoded through `encode_file` are cached by path until they are
+    rewritten, so query-time callers only pay for each frame version once.
+    """
+
+    def __init__(self, image_format='jpeg', max_side=768, quality=85):
+        if image_format not in MIME_TYPES:
+            raise ValueError("Invalid image format: {}".format(image_format))
+        self.image_format = image_format
+        self.max_side = max_side
+        self.quality = quality
+        self.file_cache = {}
+        self.lock = threading.Lock()
+        # source and encoded sizes are only compared for frames with a known source size
+        self.source_bytes = 0
+        self.compared_bytes = 0
+        self.encoded_bytes = 0
+        self.count = 0
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.image_format]
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.image_format]
+
+    def resize(self, frame):
+        height, width = frame.shape[:2]
+        scale = self.max_side / max(height, width) if self.max_side else 1.0
+        if scale >= 1.0:
+            return frame
+        return cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
+
+    def encode(self, frame, name, source_bytes=None):
+        with stage('frame_encode', items=1, format=self.image_format) as span:
+            frame = self.resize(frame)
+            if self.image_format == 'jpeg':
+                params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            elif self.image_format == 'webp':
+                params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+            else:
+                params = []
+
+            ret, buffer = cv2.imencode(self.extension, frame, params)
+            if not ret:
+                raise ValueError("Failed to encode frame {}".format(name))
+            span.add(nbytes=buffer.nbytes)
+
+        encoded = EncodedFrame(name, buffer.tobytes(), self.mime_type, source_bytes=source_bytes)
+        with self.lock:
+            self.count += 1
+            self.encoded_bytes += len(encoded.data)
+            if source_bytes:
+                self.source_bytes += source_bytes
+                self.compared_bytes += len(encoded.data)
+        return encoded
+
+    def encode_file(self, image_path):
+        # one entry per path, replaced when the file is rewritten, so memory follows the frame count
+        stat = os.stat(image_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.file_cache.get(image_path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+        frame = cv2.imread(image_path)
+        if frame is None:
+            raise ValueError("Failed to read image {}".format(image_path))
+        name = os.path.splitext(os.path.basename(image_path))[0] + self.extension
+        encoded = self.encode(frame, name, source_bytes=stat.st_size)
+
+        with self.lock:
+            self.file_cache[image_path] = (stamp, encoded)
+        return encoded
+
+    def report(self):
+        # base64 inflates every payload by 4/3, so compare the uploaded sizes
+        return {
+            'frames': self.count,
+            'source_base64_bytes': 4 * ((self.source_bytes + 2) // 3) if self.source_bytes else None,
+            'encoded_base64_bytes': 4 * ((self.encoded_bytes + 2) // 3),
+            'ratio': self.compared_bytes / self.source_bytes if self.source_bytes else None,
+        }
@@ -1,15 +1,30 @@
-import openai
 import cv2
+import numpy as np
 import os
 import base64
-import requests
 from loguru import logger
 import json
+import time
+import bisect
+import statistics
+
+from captioning import CaptionClient
+from caption_cache import CaptionCache
+from frame_encoding import EncodedFrame, FrameEncoder
+from profiling import stage
 
 # Example usage
 video_path = "2021-11-15-14-31-02.avi"
 num_frames = 8
+# 'uniform' samples evenly spaced frames, 'scene' keeps the most distinct ones
+sampling = "uniform"
 api_key = ""
+# set to None to always call the API
+caption_cache_path = ".cache/captions.sqlite"
+# frames are captioned from in-memory JPEGs of at most this size
+image_format = "jpeg"
+max_side = 768
+quality = 85
 
 
 # Function to encode the image
@@ -17,76 +32,244 @@ def encode_image(image_path):
   with open(image_path, "rb") as image_file:
     return base64.b64encode(image_file.read()).decode('utf-8')
 
-def split_video_into_frames(video_path, num_frames):
+# longer than the keyframe interval of common encoders (x264 defaults to 250)
+MAX_KEYFRAME_INTERVAL = 300
+
+def estimate_keyframe_interval(cap, probe_frames=32, seeks=5):
+    # OpenCV does not expose the GOP size, so estimate it from timings: a seek re-decodes
+    # from the previous keyframe, i.e. it costs about keyframe_interval / 2 sequential grabs.
+    # A single seek is too noisy to choose the decode strategy on, so take the median of several.
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    probe_frames = min(probe_frames, total_frames)
+    if probe_frames < 2:
+        return 1
+
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    start = time.perf_counter()
+    grabbed = 0
+    while grabbed < probe_frames and cap.grab():
+        grabbed += 1
+    grab_time = (time.perf_counter() - start) / max(grabbed, 1)
+
+    seek_times = []
+    for i in range(seeks):
+        start = time.perf_counter()
+        cap.set(cv2.CAP_PROP_POS_FRAMES, min(total_frames - 1, (2 + i) * probe_frames + i * 7))
+        cap.grab()
+        seek_times.append(time.perf_counter() - start)
+    seek_time = statistics.median(seek_times)
+
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return max(1, int(round(2 * seek_time / max(grab_time, 1e-9))))
+
+def iter_video_frames(video_path, frame_indices=None, mode='auto', keyframe_interval=None):
+    """Yield (frame_index, frame) pairs for the requested frame indices in stream order.
+
+    mode='sequential' reads the stream once and only retrieve()s the kept frames,
+    mode='seek' jumps to every frame, and mode='auto' seeks only across gaps wider
+    than the keyframe interval (estimated from the video when not given).
+    """
+    if mode not in ('auto', 'seek', 'sequential'):
+        raise ValueError("Invalid decode mode: {}".format(mode))
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if frame_indices is None:
+            frame_indices = range(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        frame_indices = sorted(set(frame_indices))
+
+        if mode == 'seek':
+            keyframe_interval = 0
+        elif mode == 'sequential':
+            keyframe_interval = float('inf')
+        elif keyframe_interval is None:
+            gaps = [b - a for a, b in zip(frame_indices, frame_indices[1:])]
+            if min(gaps, default=float('inf')) > MAX_KEYFRAME_INTERVAL:
+                # every gap gets seeked whatever the actual interval is, so skip the timing probe
+                keyframe_interval = MAX_KEYFRAME_INTERVAL
+            else:
+                keyframe_interval = estimate_keyframe_interval(cap)
+                logger.debug('estimated keyframe interval: {}', keyframe_interval)
+
+        position = 0
+        for frame_index in frame_indices:
+            with stage('frame_decode', items=1) as span:
+                if frame_index - position > keyframe_interval or frame_index < position:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+                    position = frame_index
+
+                while position < frame_index:
+                    if not cap.grab():
+                        return
+                    position += 1
+
+                ret = cap.grab()
+                position += 1
+                if ret:
+                    ret, frame = cap.retrieve()
+                    span.add(nbytes=frame.nbytes if ret else 0)
+            if not ret:
+                logger.warning('Failed to decode frame {}', frame_index)
+                continue
+
+            yield frame_index, frame
+    finally:
+        cap.release()
+
+def frame_thumbnail(frame, size=(64, 36)):
+    # the downscaled grayscale pixels scene-change scores are computed from
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).ravel()
+
+def scene_change_deltas(thumbnails, bins=32, hist_weight=0.5):
+    # weighted histogram and mean pixel deltas between consecutive rows of a (frames, pixels) uint8 array
+    num_thumbnails, num_pixels = thumbnails.shape
+
+    # per-frame histograms with a single bincount over (frame, bin) offsets
+    binned = thumbnails.astype(np.int32) * bins // 256 + np.arange(num_thumbnails, dtype=np.int32)[:, None] * bins
+    hist = np.bincount(binned.ravel(), minlength=num_thumbnails * bins).reshape(num_thumbnails, bins) / num_pixels
+
+    hist_delta = 0.5 * np.abs(np.diff(hist, axis=0)).sum(axis=1)
+    pixel_delta = np.abs(np.diff(thumbnails.astype(np.int16), axis=0)).mean(axis=1) / 255.0
+    return hist_weight * hist_delta + (1 - hist_weight) * pixel_delta
+
+def score_scene_changes(video_path, step=1, size=(64, 36), bins=32, hist_weight=0.5, chunk_size=1024):
+    """Score how much each analysed frame differs from the previous one.
+
+    The video is read once, every `step`-th frame is downscaled to a grayscale
+    thumbnail and the histogram and mean pixel deltas are computed with NumPy
+    over chunks of `chunk_size` thumbnails, so memory does not grow with the
+    video length. Returns (frame_indices, scores); the first frame scores infinity.
+    """
     cap = cv2.VideoCapture(video_path)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_interval = total_frames // num_frames
+    cap.release()
+
+    frame_indices = []
+    scores = []
+    # every chunk starts with the last thumbnail of the previous one so deltas continue across chunks
+    chunk = []
+    for frame_index, frame in iter_video_frames(video_path, range(0, total_frames, step), mode='sequential'):
+        chunk.append(frame_thumbnail(frame, size))
+        frame_indices.append(frame_index)
+        if len(chunk) > chunk_size:
+            scores.append(scene_change_deltas(np.stack(chunk), bins, hist_weight))
+            chunk = chunk[-1:]
+
+    if not frame_indices:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    if len(chunk) > 1:
+        scores.append(scene_change_deltas(np.stack(chunk), bins, hist_weight))
+
+    return np.asarray(frame_indices), np.concatenate([[np.inf]] + scores)
+
+def select_keyframes(video_path, budget, step=1, min_gap=None):
+    # keep the `budget` highest scoring scene changes, at least `min_gap` frames apart
+    if budget <= 0:
+        return []
+    frame_indices, scores = score_scene_changes(video_path, step=step)
+    if len(frame_indices) == 0:
+        return []
+
+    if min_gap is None:
+        min_gap = max(1, (frame_indices[-1] + 1) // (4 * budget))
+
+    selected = []
+    for candidate in np.argsort(-scores, kind='stable'):
+        frame_index = int(frame_indices[candidate])
+        position = bisect.bisect_left(selected, frame_index)
+        if position > 0 and frame_index - selected[position - 1] < min_gap:
+            continue
+        if position < len(selected) and selected[position] - frame_index < min_gap:
+            continue
+        selected.insert(position, frame_index)
+        if len(selected) == budget:
+            break
+
+    return selected
+
+def sample_frame_indices(video_path, num_frames, sampling='uniform'):
+    # map every sampled frame index to the sample numbers (frame_{i}) it provides
+    samples = {}
+    if sampling == 'uniform':
+        cap = cv2.VideoCapture(video_path)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        frame_interval = total_frames // num_frames
+
+        # several samples can map to the same frame index when num_frames > total_frames
+        for i in range(num_frames):
+            samples.setdefault(i * frame_interval, []).append(i)
+    elif sampling == 'scene':
+        # num_frames is the frame budget, fewer frames are returned for shorter videos
+        keyframes = select_keyframes(video_path, num_frames)
+        num_frames = len(keyframes)
+        for i, frame_index in enumerate(keyframes):
+            samples[frame_index] = [i]
+    else:
+        raise ValueError("Invalid sampling mode: {}".format(sampling))
+
+    return samples, num_frames
+
+def iter_sampled_frames(video_path, num_frames, mode='auto', sampling='uniform'):
+    samples, num_frames = sample_frame_indices(video_path, num_frames, sampling)
+
+    extracted = set()
+    for frame_index, frame in iter_video_frames(video_path, samples.keys(), mode=mode):
+        for i in samples[frame_index]:
+            extracted.add(i)
+            yield i, frame
 
-    frames = []
     for i in range(num_frames):
-        frame_index = i * frame_interval
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        ret, frame = cap.read()
+        if i not in extracted:
+            logger.warning("Failed to extract frame {}", i)
 
-        if ret:
-            frame_path = f"frames/frame_{i}.png"
-            cv2.imwrite(frame_path, frame)
-            frames.append(frame_path)
-        else:
-            print(f"Failed to extract frame {i}.")
+def split_video_into_frames(video_path, num_frames, mode='auto', sampling='uniform'):
+    extracted = {}
+    for i, frame in iter_sampled_frames(video_path, num_frames, mode, sampling):
+        frame_path = f"frames/frame_{i}.png"
+        cv2.imwrite(frame_path, frame)
+        extracted[i] = frame_path
 
-    cap.release()
-    return frames
+    return [extracted[i] for i in sorted(extracted)]
 
-def generate_captions(frames, api_key):
-    openai.api_key = api_key
+def extract_encoded_frames(video_path, num_frames, encoder, mode='auto', sampling='uniform'):
+    # decode and encode in memory, without writing lossless PNGs to disk
+    extracted = {}
+    for i, frame in iter_sampled_frames(video_path, num_frames, mode, sampling):
+        extracted[i] = encoder.encode(frame, f"frame_{i}{encoder.extension}")
 
-    contents = []
-    contents.append({
-        "type": "text",
-        "text": "Generate a caption for the following image:"
-    })
+    logger.info('frame payloads: {}', encoder.report())
+    return [extracted[i] for i in sorted(extracted)]
+
+def save_encoded_frames(frames, output_dir='frames'):
+    os.makedirs(output_dir, exist_ok=True)
+    return [frame.save(output_dir) for frame in frames]
+
+def generate_captions(frames, api_key, max_workers=8, requests_per_minute=None, tokens_per_minute=None,
+                      cache_path=None):
+    # frames are either encoded in memory (EncodedFrame) or paths to image files
+    if frames and isinstance(frames[0], EncodedFrame):
+        base64_images = [frame.base64 for frame in frames]
+        mime_type = frames[0].mime_type
+    else:
+        base64_images = [encode_image(frame_path) for frame_path in frames]
+        mime_type = "image/jpeg"
+
+    cache = CaptionCache(cache_path) if cache_path else None
+    with CaptionClient(api_key, max_workers=max_workers, requests_per_minute=requests_per_minute,
+                       tokens_per_minute=tokens_per_minute, cache=cache) as client:
+        results = client.caption_all(base64_images, mime_type)
+    if cache is not None:
+        logger.info('caption cache: {}', cache.stats())
+        cache.close()
 
     captions = []
-    for frame_path in frames:
-        # Getting the base64 string
-        base64_image = encode_image(frame_path)
-        
-        # contents.append({
-        #     "type": "image_url",
-        #     "image_url": {
-        #         "url": f"data:image/jpeg;base64,{base64_image}"
-        #     }
-        # })
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                "role": "user",
-                "content": [
-                    {
-                    "type": "text",
-                    "text": "What’s in this image?"
-                    },
-                    {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                    }
-                ]
-                }
-            ],
-            "max_tokens": 300
-        }
-        
-        
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        logger.info(response.json()['choices'][0]['message']['content'])
+    for frame, caption in zip(frames, results):
+        logger.debug(caption)
         captions.append({
-            'frame': frame_path,
-            'caption': response.json()['choices'][0]['message']['content']
+            'frame': frame.name if isinstance(frame, EncodedFrame) else frame,
+            'caption': caption
         })
 
     return captions
@@ -101,8 +284,12 @@ def cleanup_frames(frames):
 
 
 
-frames = split_video_into_frames(video_path, num_frames)
-# captions = generate_captions(frames, api_key)
+if __name__ == '__main__':
+    encoder = FrameEncoder(image_format=image_format, max_side=max_side, quality=quality)
+    frames = extract_encoded_frames(video_path, num_frames, encoder, sampling=sampling)
+    # demo.py retrieves from the encoded frames written here
+    frame_paths = save_encoded_frames(frames, 'frames')
+    # captions = generate_captions(frames, api_key, cache_path=caption_cache_path)
 
-# save_captions_to_json(captions, 'captions.json')
-# cleanup_frames(frames)
\ No newline at end of file
+    # save_captions_to_json(captions, 'captions.json')
+    # cleanup_frames(frame_paths)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import unicodedata
+
+
+def normalize_sentence(sentence):
+    # only normalizations that cannot change the parser's tokens
+    return ' '.join(unicodedata.normalize('NFC', sentence).split())
+
+
+class AMRParseCache:
+    """Disk-backed AMR parses keyed by the normalized sentence and the parser model.
+
+    Records hold the tokens, penman text and alignments of a parse with the
+    parser's own variable names, so they can be re-prefixed for any
+    cluster/doc/sentence. Hit/miss counters cover the lifetime of this object.
+    """
+
+    def __init__(self, path, parser_model):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.parser_model = parser_model
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, record TEXT NOT NULL)')
+        self.connection.commit()
+
+    def key(self, sentence):
+        digest = hashlib.sha256(self.parser_model.encode('utf-8'))
+        digest.update(b'\0' + normalize_sentence(sentence).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_many(self, sentences):
+        """Return {sentence: record} for the sentences that are cached."""
+        keys = {self.key(sentence): sentence for sentence in sentences}
+        found = {}
+        with self.lock:
+            key_list = list(keys)
+            # stay below SQLite's limit on bound parameters
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = self.connection.execute(
+                    'SELECT key, record FROM parses WHERE key IN ({})'.format(','.join('?' * len(chunk))),
+                    chunk).fetchall()
+                for key, record in rows:
+                    found[keys[key]] = json.loads(record)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, records):
+        """Store {sentence: record}."""
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO parses (key, record) VALUES (?, ?)',
+                [(self.key(sentence), json.dumps(record)) for sentence, record in records.items()])
+            self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM parses').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import re
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def write_json_atomic(path, data):
+    # a crash mid-write leaves the previous file (or none) behind, never a truncated one
+    with open(path + '.tmp', 'w') as tmp_file:
+        json.dump(data, tmp_file)
+    os.replace(path + '.tmp', path)
+
+
+class CaptionCheckpoints:
+    """Per-caption AMR parse results, stored as one JSON file per caption.
+
+    A checkpoint is only reused while the hash of its sentences and parser
+    model still matches, so changed captions are parsed again.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def load(self, key, caption_hash):
+        try:
+            with open(self.path(key)) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if checkpoint.get('hash') != caption_hash:
+            return None
+        return checkpoint['sentences']
+
+    def save(self, key, caption_hash, sentences):
+        write_json_atomic(self.path(key), {'key': key, 'hash': caption_hash, 'sentences': sentences})
+
+
+class CorefCache:
+    """Coreference clusters per input window, keyed by a hash of the window's tokens."""
+
+    def __init__(self, path):
+        self.path = path
+        self.clusters = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path) as cache_file:
+                self.clusters = json.load(cache_file)
+
+    @staticmethod
+    def key(tokens):
+        return content_hash(tokens)
+
+    def get(self, tokens):
+        clusters = self.clusters.get(self.key(tokens))
+        if clusters is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [[tuple(mention) for mention in cluster] for cluster in clusters]
+
+    def put(self, tokens, clusters):
+        self.clusters[self.key(tokens)] = [[list(mention) for mention in cluster] for cluster in clusters]
+
+    def retain(self, keys):
+        # drop windows that are no longer part of the text
+        self.clusters = {key: value for key, value in self.clusters.items() if key in keys}
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(self.path, self.clusters)
@@ -1,32 +1,83 @@
+import contextlib
+import gc
 import os
-from transition_amr_parser.parse import AMRParser
 import json
 import networkx as nx
 import penman
+from penman import layout as penman_layout
 from penman import transform as penman_transform
+from penman.model import Model
 from penman.models import amr as penman_amr
-from fastcoref import FCoref, LingMessCoref
 import itertools
-from contextlib import contextmanager
-import copy
-import torch
+import bisect
 from loguru import logger
 import traceback
 import sys
 
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import sent_tokenize
-
 import logging
 logging.getLogger('penman').setLevel(logging.ERROR)
 
+# run from the repository root as `python -m kg.construct`
+from .kg_store import write_store
+from .checkpoints import CaptionCheckpoints, CorefCache, content_hash
+from .amr_cache import AMRParseCache, normalize_sentence
+from profiling import stage
+# the AMR parser, FCoref and nltk are imported when first used, so importing this module is cheap
+from resources import load_amr_parser, load_coref_model, sent_tokenize
+
+
+@contextlib.contextmanager
+def paused_gc():
+    # The graph stages allocate many long-lived containers, and every full collection rescans
+    # the whole growing graph, which made them superlinear. Their garbage has no reference
+    # cycles, so it is freed by reference counting while the collector is paused.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class ParsedSentence:
+    """The parts of a parsed IBM AMR graph the KG uses, in a JSON-serializable form."""
+
+    def __init__(self, tokens, nodes, alignments, penman_text):
+        self.tokens = tokens
+        self.nodes = nodes
+        self.alignments = alignments
+        self.penman_text = penman_text
+
+    @classmethod
+    def from_amr(cls, ibm_amr_graph):
+        return cls(list(ibm_amr_graph.tokens), dict(ibm_amr_graph.nodes),
+                   {key: list(value) for key, value in ibm_amr_graph.alignments.items()},
+                   ibm_amr_graph.to_penman(isi=False))
+
+    @classmethod
+    def from_dict(cls, data):
+        # nodes and alignments are stored as item lists so integer node ids survive JSON
+        return cls(list(data['tokens']), {key: value for key, value in data['nodes']},
+                   {key: list(value) for key, value in data['alignments']}, data['penman'])
+
+    def to_dict(self):
+        return {'tokens': self.tokens, 'nodes': list(self.nodes.items()),
+                'alignments': list(self.alignments.items()), 'penman': self.penman_text}
+
+    def to_penman(self, isi=False):
+        return self.penman_text
+
 
 class KGCreator:
-    def __init__(self, BATCH_SIZE=64, parser=None):
+    def __init__(self, BATCH_SIZE=64, parser=None, parse_cache=None, parser_model='AMR3-structbart-L'):
         self.BATCH_SIZE = BATCH_SIZE
         self.SENTENCE_COUNT = 0
+        # without a parser, parser_model is loaded the first time a sentence has to be parsed
         self.parser = parser
+        self.parser_model = parser_model
+        # optional AMRParseCache shared across runs and videos
+        self.parse_cache = parse_cache
 
     @staticmethod
     def get_token_map(original_graph, modified_graph):
@@ -35,82 +86,174 @@ class KGCreator:
             mapping[modified_graph.triples[i][0]] = triple[0]
         return mapping
 
-    def process_sentences(self, sentence_list, multiDocKG, cluster_id, doc_id):
-        batch = []
+    def parse_corpus(self, sentence_lists):
+        """Parse the sentences of many captions in full, length-bucketed batches.
+
+        Repeated sentences are parsed once, and sentences found in the parse
+        cache are not parsed at all. Returns one list of ParsedSentence per
+        input sentence list, in the original sentence order.
+        """
+        occurrences = {}
+        for list_idx, sentence_list in enumerate(sentence_lists):
+            for snt_idx, sentence in enumerate(sentence_list):
+                occurrences.setdefault(normalize_sentence(sentence), []).append((list_idx, snt_idx))
+
+        records = self.parse_cache.get_many(occurrences) if self.parse_cache is not None else {}
+
+        pending = []
+        for sentence in occurrences:
+            if sentence not in records:
+                if self.parser is None:
+                    self.parser = load_amr_parser(self.parser_model)
+                sentence_tokens, _ = self.parser.tokenize(sentence)
+                pending.append((sentence, sentence_tokens))
+
+        # sentences of similar length share a batch, so little work is spent on padding
+        pending.sort(key=lambda item: len(item[1]))
+
+        parsed = {}
+        for start in range(0, len(pending), self.BATCH_SIZE):
+            batch = pending[start:start + self.BATCH_SIZE]
+            with stage('amr_batch', items=len(batch)):
+                annotations_list, decoding_data_list = self.parser.parse_sentences(
+                    [sentence_tokens for _, sentence_tokens in batch])
+                for (sentence, _), decoding_data in zip(batch, decoding_data_list):
+                    parsed[sentence] = ParsedSentence.from_amr(decoding_data.get_amr()).to_dict()
+        if self.parse_cache is not None and parsed:
+            self.parse_cache.put_many(parsed)
+        records.update(parsed)
+
+        logger.info('parsed {} of {} sentences ({} unique)',
+                    len(pending), sum(len(sentence_list) for sentence_list in sentence_lists), len(occurrences))
+
+        # every occurrence gets its own copy, the KG metadata keeps references to it
+        results = [[None] * len(sentence_list) for sentence_list in sentence_lists]
+        for sentence, positions in occurrences.items():
+            for list_idx, snt_idx in positions:
+                results[list_idx][snt_idx] = ParsedSentence.from_dict(records[sentence])
+
+        return results
+
+    def process_sentences(self, sentence_list, multiDocKG, cluster_id, doc_id, amr_graphs=None):
+        if amr_graphs is None:
+            amr_graphs = self.parse_corpus([sentence_list])[0]
 
         existSentenceCount = len(multiDocKG.metadata[doc_id]['sentences'].keys())
         tokens = []
 
-        for sentence_index, sentence in enumerate(sentence_list):
-            sentence_tokens, _ = self.parser.tokenize(sentence)
+        for sentence_index, ibm_amr_graph in enumerate(amr_graphs):
+            actual_sentence_index = sentence_index + existSentenceCount
+
+            tokens.extend(ibm_amr_graph.tokens)
+
+            sentence_amr_penman = ibm_amr_graph.to_penman(isi=False)
+            tree = penman.parse(sentence_amr_penman)
+            tree.reset_variables('{}-{}-{}-'.format(cluster_id, doc_id, actual_sentence_index) + 'z{i}')
+            new_ibm_amr_graph = penman.interpret(tree)
+            multiDocKG.metadata[doc_id]['sentences'][actual_sentence_index] = {
+                # a list of tokens tokenized from the sentence
+                'tokens': ibm_amr_graph.tokens,
+                # a mapping with the key being the token(variable in penman) in the AMR graph from the IBM parser \
+                # and the value being the mapped word in the sentence or the word generated by the IBM parser
+                'nodes': ibm_amr_graph.nodes,
+                # A mapping with the key being the token(variable in penman) in the AMR graph from the IBM parser \
+                # and the value being the index of the token in the sentence
+                'alignments': ibm_amr_graph.alignments,
+                # Get a mapping with the key being the token(variable in penman) in the AMR graph \
+                # and the value being the token in the AMR graph from the IBM parser
+                'token_map': self.get_token_map(penman.decode(sentence_amr_penman), new_ibm_amr_graph),
+            }
+            self.handle_multiple_sentences(cluster_id, doc_id, actual_sentence_index, new_ibm_amr_graph)
+            # only append here, the whole graph is laid out once in finalize(); the sentence's layout
+            # markers come along, so that is a single pass over the triples
+            multiDocKG.triples.extend(new_ibm_amr_graph.triples)
+            multiDocKG.epidata.update(new_ibm_amr_graph.epidata)
 
-            batch.append(sentence_tokens)
-            if len(batch) == self.BATCH_SIZE or sentence_index == len(sentence_list) - 1:
-                annotations_list, decoding_data_list = self.parser.parse_sentences(
-                    batch)
-                batch = []
-                for batch_snt_idx, (annotation, decoding_data) in enumerate(zip(annotations_list, decoding_data_list)):
-                    actual_sentence_index = sentence_index - \
-                        len(annotations_list) + 1 + \
-                        batch_snt_idx + existSentenceCount
-
-                    ibm_amr_graph = decoding_data.get_amr()
-                    
-                    tokens.extend(ibm_amr_graph.tokens)
-                    
-                    sentence_amr_penman = ibm_amr_graph.to_penman(isi=False)
-                    tree = penman.parse(sentence_amr_penman)
-                    tree.reset_variables('{}-{}-{}-'.format(cluster_id, doc_id, actual_sentence_index) + 'z{i}')
-                    new_ibm_amr_graph = penman.interpret(tree)
-                    multiDocKG.metadata[doc_id]['sentences'][actual_sentence_index] = {
-                        # a list of tokens tokenized from the sentence
-                        'tokens': ibm_amr_graph.tokens,
-                        # a mapping with the key being the token(variable in penman) in the AMR graph from the IBM parser \
-                        # and the value being the mapped word in the sentence or the word generated by the IBM parser
-                        'nodes': ibm_amr_graph.nodes,
-                        # A mapping with the key being the token(variable in penman) in the AMR graph from the IBM parser \
-                        # and the value being the index of the token in the sentence
-                        'alignments': ibm_amr_graph.alignments,
-                        # Get a mapping with the key being the token(variable in penman) in the AMR graph \
-                        # and the value being the token in the AMR graph from the IBM parser
-                        'token_map': self.get_token_map(penman.decode(sentence_amr_penman), new_ibm_amr_graph),
-                    }
-                    self.handle_multiple_sentences(cluster_id, doc_id, actual_sentence_index, new_ibm_amr_graph)
-                    multiDocKG.triples.extend(new_ibm_amr_graph.triples)
-                    multiKGtree = penman.configure(multiDocKG)
-                    # multiKGtree = penman_transform.canonicalize_roles(
-                    #     multiKGtree, model=penman_amr.model
-                    # )
-                    penman.layout.rearrange(
-                        multiKGtree, key=penman_amr.model.canonical_order)
-                    multiDocKG = penman.interpret(multiKGtree)
-                    
-        
-                    
-        
         return multiDocKG, tokens, new_ibm_amr_graph
 
     def handle_multiple_sentences(self, cluster_id, doc_id, actual_sentence_index, new_ibm_amr_graph):
-        if ('{}-{}-{}-z0'.format(cluster_id, doc_id, actual_sentence_index), ':instance', 'multi-sentence') in new_ibm_amr_graph.triples:
-            pop_index = new_ibm_amr_graph.triples.index(
-                ('{}-{}-{}-z0'.format(cluster_id, doc_id, actual_sentence_index), ':instance', 'multi-sentence'))
-            pop_source = new_ibm_amr_graph.triples[pop_index][0]
-            new_ibm_amr_graph.triples.pop(pop_index)
-            for triple_idx, triple in enumerate(new_ibm_amr_graph.triples):
+        # hang the sentence under 'origin', keeping the Push/Pop layout markers penman.interpret
+        # left on its triples valid for the whole graph
+        triples, epidata = new_ibm_amr_graph.triples, new_ibm_amr_graph.epidata
+        top_instance = ('{}-{}-{}-z0'.format(cluster_id, doc_id, actual_sentence_index), ':instance', 'multi-sentence')
+        if top_instance in triples:
+            # the multi-sentence top is dropped and its branches move to origin; the top had no
+            # Push, so the markers of its branches already return to origin's context
+            pop_index = triples.index(top_instance)
+            pop_source = triples[pop_index][0]
+            triples.pop(pop_index)
+            epidata.pop(top_instance, None)
+            for triple_idx, triple in enumerate(triples):
                 if triple[0] == pop_source:
                     original_source, original_role, original_target = triple
                     if original_role.startswith(":snt"):
-                        new_ibm_amr_graph.triples[triple_idx] = (
+                        triples[triple_idx] = (
                             "origin", ':snt{}'.format(self.SENTENCE_COUNT), original_target)
                         self.SENTENCE_COUNT += 1
                     else:
-                        new_ibm_amr_graph.triples[triple_idx] = (
+                        triples[triple_idx] = (
                             "origin", original_role, original_target)
+                    epidata[triples[triple_idx]] = epidata.pop(triple, [])
         else:
-            new_ibm_amr_graph.triples.append(
-                ('origin', ':snt{}'.format(self.SENTENCE_COUNT), new_ibm_amr_graph.top))
+            # the :snt edge opens the sentence's top node and its last triple closes it again
+            snt_triple = ('origin', ':snt{}'.format(self.SENTENCE_COUNT), new_ibm_amr_graph.top)
+            triples.insert(0, snt_triple)
+            epidata[snt_triple] = [penman_layout.Push(new_ibm_amr_graph.top)]
+            epidata[triples[-1]] = epidata.get(triples[-1], []) + [penman_layout.POP]
             self.SENTENCE_COUNT += 1
 
+    @staticmethod
+    def create_graph(cluster_id):
+        multiDocKG = penman.graph.Graph()
+        multiDocKG.metadata['cluster_id'] = cluster_id
+        # create a set to store all the document ids
+        multiDocKG.metadata['doc_ids'] = set()
+        # make 'multi-sentence' as the root node of the graph
+        multiDocKG.triples.append(
+            ('origin', ':instance', 'multi-sentence'))
+        return multiDocKG
+
+    @staticmethod
+    def add_document(multiDocKG, doc_id):
+        if doc_id in multiDocKG.metadata['doc_ids']:
+            return multiDocKG
+
+        # Add the document ID to the set
+        multiDocKG.metadata['doc_ids'].add(doc_id)
+
+        multiDocKG.metadata[doc_id] = dict()
+        multiDocKG.metadata[doc_id]['sentences'] = dict()
+        # TODO: to prevent disconnected graphs during entity & event coreference, combine all the sentences from the text and image modalities
+        multiDocKG.metadata[doc_id]['maintext'] = str()
+
+        # to store the seperate text, image, video, audio content
+        multiDocKG.metadata[doc_id]['text'] = str()
+        multiDocKG.metadata[doc_id]['text_triples'] = list()
+        multiDocKG.metadata[doc_id]['image_caption'] = str()
+        multiDocKG.metadata[doc_id]['image_triples'] = list()
+        multiDocKG.metadata[doc_id]['video_caption'] = str()
+        multiDocKG.metadata[doc_id]['video_triples'] = list()
+        multiDocKG.metadata[doc_id]['audio_caption'] = str()
+        multiDocKG.metadata[doc_id]['audio_triples'] = list()
+
+        multiDocKG.metadata[doc_id]['video_filename'] = str()
+        return multiDocKG
+
+    @staticmethod
+    def finalize(multiDocKG):
+        # Sentences are only appended while parsing, so the accumulated graph is laid out
+        # and re-interpreted once here instead of after every sentence (which was O(n^2)).
+        # Every sentence carries its layout markers, so configure never has to improvise
+        # branch sites, which was quadratic in the number of sentences
+        with stage('penman_rebuild', items=len(multiDocKG.triples)), paused_gc():
+            multiKGtree = penman.configure(multiDocKG)
+            # multiKGtree = penman_transform.canonicalize_roles(
+            #     multiKGtree, model=penman_amr.model
+            # )
+            penman.layout.rearrange(
+                multiKGtree, key=penman_amr.model.canonical_order)
+            return penman.interpret(multiKGtree)
+
     def create_maintext(self, multiDocKG, doc_id):
         new_maintext = str()
         for _, value in multiDocKG.metadata[doc_id]['sentences'].items():
@@ -121,9 +264,20 @@ class KGCreator:
         
         return multiDocKG
     
-    def createKGFromSentence(self, sentence_list, multiDocKG, cluster_id, doc_id, modal='text'):
+    def createKGFromCorpus(self, documents, multiDocKG, cluster_id):
+        # documents: (doc_id, modal, sentence_list) in graph order; all their sentences
+        # are parsed together and then added exactly as createKGFromSentence would
+        amr_graph_lists = self.parse_corpus([sentence_list for _, _, sentence_list in documents])
+        for (doc_id, modal, sentence_list), amr_graphs in zip(documents, amr_graph_lists):
+            multiDocKG = self.createKGFromSentence(
+                sentence_list, multiDocKG, cluster_id, doc_id, modal=modal, amr_graphs=amr_graphs)
+        return multiDocKG
+
+    def createKGFromSentence(self, sentence_list, multiDocKG, cluster_id, doc_id, modal='text', amr_graphs=None):
         
-        multiDocKG, tokens, penman_graph = self.process_sentences(sentence_list, multiDocKG, cluster_id, doc_id)
+        with paused_gc():
+            multiDocKG, tokens, penman_graph = self.process_sentences(
+                sentence_list, multiDocKG, cluster_id, doc_id, amr_graphs=amr_graphs)
         
         if modal == 'text':
             for triple in penman_graph.triples:
@@ -147,126 +301,197 @@ class KGCreator:
         return self.create_maintext(multiDocKG, doc_id)
 
 
+class MentionIndex:
+    """Lookup tables for mapping coreference mentions to KG nodes, built once per resolve.
+
+    Token offsets of documents and sentences are kept as cumulative arrays searched
+    with bisect, each sentence gets an inverted token -> nodes map, and the linked
+    node pairs of the KG are kept in a set for O(1) duplicate checks.
+    """
+
+    def __init__(self, kg):
+        # same document order as the text given to the coreference model
+        self.doc_ids = list(kg.metadata['doc_ids'])
+        self.doc_ends = list(itertools.accumulate(
+            len(kg.metadata[doc_id]['maintext'].split(" ")) for doc_id in self.doc_ids))
+
+        self.sentences = {}
+        for doc_id in self.doc_ids:
+            snt_ids = list(kg.metadata[doc_id]['sentences'].keys())
+            snt_ends = list(itertools.accumulate(
+                len(value['tokens']) for value in kg.metadata[doc_id]['sentences'].values()))
+            token_nodes = {}
+            for snt_idx in snt_ids:
+                token_nodes[snt_idx] = self.invert(kg.metadata[doc_id]['sentences'][snt_idx])
+            self.sentences[doc_id] = (snt_ids, snt_ends, token_nodes)
+
+        self.linked = set()
+        for source, _, target in kg.triples:
+            self.linked.add((source, target))
+            self.linked.add((target, source))
+
+    @staticmethod
+    def invert(meta):
+        # token index -> nodes (variables in the KG) aligned to that token
+        token_nodes = {}
+        for node, parser_node in meta['token_map'].items():
+            alignment = meta['alignments'].get(parser_node)
+            if alignment:
+                token_nodes.setdefault(alignment[0], []).append(node)
+        return token_nodes
+
+    def locate(self, token_index):
+        # (doc id, sentence index, token offset of that sentence in the whole text)
+        doc_pos = bisect.bisect_right(self.doc_ends, token_index)
+        if doc_pos == len(self.doc_ends):
+            raise ValueError(
+                f"Word index {token_index} exceeds length of entire text")
+        doc_id = self.doc_ids[doc_pos]
+        doc_offset = self.doc_ends[doc_pos - 1] if doc_pos else 0
+
+        snt_ids, snt_ends, _ = self.sentences[doc_id]
+        snt_pos = bisect.bisect_right(snt_ends, token_index - doc_offset)
+        if snt_pos == len(snt_ends):
+            raise ValueError(
+                f"Token index {token_index - doc_offset} exceeds length of document {doc_id}")
+        snt_offset = snt_ends[snt_pos - 1] if snt_pos else 0
+
+        return doc_id, snt_ids[snt_pos], doc_offset + snt_offset
+
+    def mention_nodes(self, mention_start, mention_end):
+        doc_id, snt_idx, offset = self.locate(mention_start)
+        token_nodes = self.sentences[doc_id][2][snt_idx]
+        nodes = set()
+        for token_index in range(mention_start - offset, mention_end - offset):
+            nodes.update(token_nodes.get(token_index, ()))
+        return doc_id, nodes
+
+    def is_linked(self, m1, m2):
+        return (m1, m2) in self.linked
+
+    def link(self, m1, m2):
+        self.linked.add((m1, m2))
+        self.linked.add((m2, m1))
+
+
 class EntityCoreference:
-    def __init__(self):
-        self.coref_model = FCoref(device='cpu')
-
-    @contextmanager
-    def process_metadata(self, kg, doc_idx, sent_idx):
-        meta = kg.metadata[doc_idx]['sentences'][sent_idx]
-        token_map = meta['token_map']
-        yield meta, token_map
-
-    def adjust_indices(self, index, offset):
-        return index - offset
-
-    def get_nodes(self, meta, token_map, mention_start, mention_end):
-        alignment_token_idx = [
-            k for k, v in meta['alignments'].items() if v[0] in range(mention_start, mention_end)
-        ]
-        return [
-            key for idx in alignment_token_idx for key, val in token_map.items() if idx == val
-        ]
-
-    def get_sentence_index(self, kg, doc_idx, token_index):
-        accumulated_length = 0
-        for snt_idx, value in kg.metadata[doc_idx]['sentences'].items():
-            accumulated_length += len(value['tokens'])
-            if accumulated_length > token_index:
-                return snt_idx, accumulated_length - len(value['tokens'])
-        raise ValueError(
-            f"Token index {token_index} exceeds length of document {doc_idx}")
-
-    def get_doc_index(self, kg, token_index):
-        accumulated_length = 0
-        for doc_id in kg.metadata['doc_ids']:
-            tokens = kg.metadata[doc_id]['maintext'].split(" ")
-            accumulated_length += len(tokens)
-            if accumulated_length > token_index:
-                return doc_id, accumulated_length - len(tokens)
-        raise ValueError(
-            f"Word index {token_index} exceeds length of entire text")
+    def __init__(self, window_size=None, overlap=128, max_tokens_in_batch=100, windows_per_call=8, cache=None):
+        # window_size=None sends the whole text to the model at once; otherwise the text is
+        # split into overlapping windows whose clusters are merged by shared mentions. Windows
+        # start at fixed token offsets: appended text only changes the last windows, but a caption
+        # that changes length shifts, and re-predicts, every window after it
+        if window_size is not None and not 0 <= overlap < window_size:
+            raise ValueError("overlap must be smaller than window_size")
+        self.window_size = window_size
+        self.overlap = overlap
+        self.max_tokens_in_batch = max_tokens_in_batch
+        self.windows_per_call = windows_per_call
+        # optional CorefCache: windows whose tokens did not change are not predicted again
+        self.cache = cache
+        self._coref_model = None
+
+    @property
+    def coref_model(self):
+        # loaded on first use, so fully cached runs never load FCoref
+        if self._coref_model is None:
+            self._coref_model = load_coref_model(device='cpu')
+        return self._coref_model
+
+    @coref_model.setter
+    def coref_model(self, model):
+        self._coref_model = model
+
+    def predict_windows(self, windows):
+        # clusters (in window token offsets) for every window, only running the model on cache misses
+        results = [self.cache.get(window) if self.cache is not None else None for window in windows]
+        missing = [i for i, clusters in enumerate(results) if clusters is None]
+
+        # only windows_per_call windows are held by the model at a time
+        for call_start in range(0, len(missing), self.windows_per_call):
+            window_ids = missing[call_start:call_start + self.windows_per_call]
+            predictions = self.coref_model.predict(
+                texts=[windows[i] for i in window_ids],
+                is_split_into_words=True, max_tokens_in_batch=self.max_tokens_in_batch)
+            for i, prediction in zip(window_ids, predictions):
+                results[i] = prediction.get_clusters(as_strings=False)
+                if self.cache is not None:
+                    self.cache.put(windows[i], results[i])
+
+        if self.cache is not None:
+            self.cache.retain({self.cache.key(window) for window in windows})
+        return results
+
+    def predict_clusters(self, tokens):
+        if self.window_size is None or len(tokens) <= self.window_size:
+            return self.predict_windows([tokens])[0]
+
+        starts = list(range(0, len(tokens) - self.overlap, self.window_size - self.overlap))
+        window_clusters = self.predict_windows([tokens[start:start + self.window_size] for start in starts])
+
+        # union-find over mentions (global token spans): mentions of one window cluster are
+        # joined, and a mention seen in two overlapping windows joins their clusters
+        parent = {}
+
+        def find(mention):
+            while parent[mention] != mention:
+                parent[mention] = parent[parent[mention]]
+                mention = parent[mention]
+            return mention
+
+        for start, clusters in zip(starts, window_clusters):
+            for cluster in clusters:
+                mentions = [(start + mention_start, start + mention_end) for mention_start, mention_end in cluster]
+                for mention in mentions:
+                    parent.setdefault(mention, mention)
+                root = find(mentions[0])
+                for mention in mentions[1:]:
+                    parent[find(mention)] = root
+
+        clusters = {}
+        for mention in parent:
+            clusters.setdefault(find(mention), []).append(mention)
+        return sorted((sorted(cluster) for cluster in clusters.values()), key=lambda cluster: cluster[0])
 
     def resolve(self, kg):
         KG_TEXT = ' '.join(kg.metadata[d]['maintext'] for d in kg.metadata['doc_ids']).strip()
         
-        logger.info(KG_TEXT)
+        logger.debug('Resolving coreference over {} characters of KG text', len(KG_TEXT))
         
         # for doc_id in kg.metadata['doc_ids']:
         #     logger.info('doc id: {}', doc_id)
         #     logger.info('maintext: {}', kg.metadata[doc_id]['maintext'])
         
         tokens = KG_TEXT.split(" ")
-        # TODO: batchtize: max_tokens_in_batch
-        predictions = self.coref_model.predict(
-            texts=[tokens], is_split_into_words=True, max_tokens_in_batch=100)[0]
-        
-        # TODO: remove indexing
-        clusters = predictions.get_clusters(as_strings=False)
+        clusters = self.predict_clusters(tokens)
         # logger.info('Found {} clusters', len(clusters))
-        # logger.info('cluters: {}', predictions.get_clusters()[-9])
-        # logger.info('cluters: {}', predictions.get_clusters(as_strings=False)[-9])
 
+        index = MentionIndex(kg)
         for cluster in clusters:
-            # logger.info("cluster in loop: {}", cluster)
-            for mention1_idx, mention2_idx in itertools.combinations(range(len(cluster)), 2):
-                # logger.info("mention1: {}, results: {}", mention1_idx, cluster[mention1_idx])
-                # logger.info("mention2: {}, results: {}", mention2_idx, cluster[mention2_idx])
-                mention1_start, mention1_end = cluster[mention1_idx]
-                mention2_start, mention2_end = cluster[mention2_idx]
-
-                doc1_idx, doc1_offset = self.get_doc_index(kg, mention1_start)
-                doc2_idx, doc2_offset = self.get_doc_index(kg, mention2_start)
-
-                mention1_start, mention1_end = map(
-                    self.adjust_indices, (mention1_start, mention1_end), (doc1_offset, doc1_offset))
-                mention2_start, mention2_end = map(
-                    self.adjust_indices, (mention2_start, mention2_end), (doc2_offset, doc2_offset))
-
-                sent1_idx, sent1_offset = self.get_sentence_index(
-                    kg, doc1_idx, mention1_start)
-                sent2_idx, sent2_offset = self.get_sentence_index(
-                    kg, doc2_idx, mention2_start)
-
-                mention1_start, mention1_end = map(
-                    self.adjust_indices, (mention1_start, mention1_end), (sent1_offset, sent1_offset))
-                mention2_start, mention2_end = map(
-                    self.adjust_indices, (mention2_start, mention2_end), (sent2_offset, sent2_offset))
-
-                with self.process_metadata(kg, doc1_idx, sent1_idx) as (meta, key_mapping):
-                    mention_nodes_1 = self.get_nodes(
-                        meta, key_mapping, mention1_start, mention1_end)
-
-                with self.process_metadata(kg, doc2_idx, sent2_idx) as (meta, key_mapping):
-                    mention_nodes_2 = self.get_nodes(
-                        meta, key_mapping, mention2_start, mention2_end)
-            
-                # logger.info("mention_nodes1: {}", mention_nodes_1)
-                # logger.info("mention_nodes2: {}", mention_nodes_2)
-                for m1, m2 in itertools.product(set(mention_nodes_1), set(mention_nodes_2)):
+            # resolve every mention once, then link the nodes of each pair of mentions
+            mentions = [index.mention_nodes(mention_start, mention_end) for mention_start, mention_end in cluster]
+            for (doc1_idx, mention_nodes_1), (doc2_idx, mention_nodes_2) in itertools.combinations(mentions, 2):
+                for m1, m2 in itertools.product(mention_nodes_1, mention_nodes_2):
                     if m1 != m2:
-                        triple1 = (m1, ":coref", m2)
-                        triple2 = (m2, ":coref", m1)
-                        if all(triple not in kg.triples for triple in [triple1, triple2]):
-                            # TODO: check if there is a triple with same source and target?
-                            if any(((triple[0] == m1 and triple[2] == m2) or (triple[0] == m2 and triple[2] == m1)) for triple in kg.triples):
-                                continue
-                            kg.triples.extend([triple1, triple2])
+                        # TODO: check if there is a triple with same source and target?
+                        if index.is_linked(m1, m2):
+                            continue
+                        kg.triples.extend([(m1, ":coref", m2), (m2, ":coref", m1)])
+                        index.link(m1, m2)
                             
-                            # TODO: add the coreference metadata
-                            if 'coreferences' not in kg.metadata:
-                                kg.metadata['coreferences'] = dict()
+                        # TODO: add the coreference metadata
+                        if 'coreferences' not in kg.metadata:
+                            kg.metadata['coreferences'] = dict()
                             
-                            if doc1_idx not in kg.metadata['coreferences']:
-                                kg.metadata['coreferences'][doc1_idx] = list()
-                            if doc2_idx not in kg.metadata['coreferences']:
-                                kg.metadata['coreferences'][doc2_idx] = list()
+                        if doc1_idx not in kg.metadata['coreferences']:
+                            kg.metadata['coreferences'][doc1_idx] = list()
+                        if doc2_idx not in kg.metadata['coreferences']:
+                            kg.metadata['coreferences'][doc2_idx] = list()
                             
-                            if doc2_idx not in kg.metadata['coreferences'][doc1_idx]:
-                                kg.metadata['coreferences'][doc1_idx].append(doc2_idx)
+                        if doc2_idx not in kg.metadata['coreferences'][doc1_idx]:
+                            kg.metadata['coreferences'][doc1_idx].append(doc2_idx)
                             
-                            if doc1_idx not in kg.metadata['coreferences'][doc2_idx]:
-                                kg.metadata['coreferences'][doc2_idx].append(doc1_idx)
+                        if doc1_idx not in kg.metadata['coreferences'][doc2_idx]:
+                            kg.metadata['coreferences'][doc2_idx].append(doc1_idx)
 
         return kg
 
@@ -275,6 +500,7 @@ class GraphConverter:
     def __init__(self, graph, no_escape_characters=False):
         self.graph = graph
         self.no_escape_characters = no_escape_characters
+        self.modality_index = {}
 
     def handle_instances(self, G):
         for instance in self.graph.instances():
@@ -324,27 +550,35 @@ class GraphConverter:
                 G.add_edge(attribute.source, attribute_node_id,
                            edge_info=attribute.role)
 
+    def get_modality_index(self, doc_id):
+        # hashed view of the per-document modality triple lists, built on first use
+        if doc_id not in self.modality_index:
+            self.modality_index[doc_id] = [
+                (modal, set(self.graph.metadata[doc_id]['{}_triples'.format(modal)]))
+                for modal in ('video', 'audio', 'image')
+            ]
+        return self.modality_index[doc_id]
+
     def assign_group_id(self, doc_id, instance):
-        group_id = None
-        if (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['video_triples']:
-            group_id = "{}-{}".format(doc_id, "video")
-        elif (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['audio_triples']:
-            group_id = "{}-{}".format(doc_id, "audio")
-        elif (instance.source, ':instance', instance.target) in self.graph.metadata[doc_id]['image_triples']:
-            group_id = "{}-{}".format(doc_id, "image")
-        else:
-            group_id = "{}-{}".format(doc_id, "text")
+        triple = (instance.source, ':instance', instance.target)
+        for modal, triples in self.get_modality_index(doc_id):
+            if triple in triples:
+                return "{}-{}".format(doc_id, modal)
 
-        return group_id
+        return "{}-{}".format(doc_id, "text")
 
     def update_doc_info(self, G, doc_id):
-        G.graph['doc_info'].setdefault(doc_id, {
+        # built once per document, the first time one of its instances is converted
+        if doc_id in G.graph['doc_info']:
+            return
+
+        G.graph['doc_info'][doc_id] = {
             'text': self.graph.metadata[doc_id]['text'] if 'text' in self.graph.metadata[doc_id] else '',
             'image': self.graph.metadata[doc_id]['image_caption'] if 'image_caption' in self.graph.metadata[doc_id] else '',
             'video': self.graph.metadata[doc_id]['video_caption'] if 'video_caption' in self.graph.metadata[doc_id] else '',
             'audio': self.graph.metadata[doc_id]['audio_caption'] if 'audio_caption' in self.graph.metadata[doc_id] else '',
             # 'video_filename': self.graph.metadata[doc_id]['video_filename'] if 'video_filename' in self.graph.metadata[doc_id] else '
-        })
+        }
 
         G.graph['doc_info'][doc_id]['sentences'] = list()
         for _, val in self.graph.metadata[doc_id]['sentences'].items():
@@ -400,76 +634,286 @@ class GraphConverter:
         return G
 
 
+class GraphExporter:
+    """Encode the KG to penman and write its node-link JSON variants in one pass.
+
+    The networkx graph is built once; `graph.json` is written from it as is and
+    `graph_no_quotes.json` with double quotes stripped from node ids, AMR tokens
+    and link endpoints (what GraphConverter(no_escape_characters=True) produced),
+    record by record, without copying or mutating the KG.
+    """
+
+    VARIANTS = {'graph': False, 'graph_no_quotes': True}
+
+    def __init__(self, graph, save_path):
+        self.graph = graph
+        self.save_path = save_path
+
+    def encode_penman(self):
+        # The triples laid out by KGCreator.finalize keep their layout markers, so configuring them
+        # is a single pass. Triples added afterwards (coreference links) have none; penman would
+        # improvise a branch site for each, which is quadratic, so they are attached here the way
+        # penman does it: to the current node while it is their source (or, inverted, their
+        # target), else to their source node. The tree is built without the KG metadata, which
+        # penman cannot format.
+        graph = self.graph
+        laid_out = [triple for triple in graph.triples if triple in graph.epidata]
+        tree = penman_layout.configure(penman.Graph(laid_out, top=graph.top, epidata=graph.epidata))
+        branches = {variable: node_branches for variable, node_branches in tree.nodes()}
+        model = Model()
+        current = None
+        for triple in graph.triples:
+            if triple in graph.epidata:
+                continue
+            if triple[0] != current and triple[2] == current and triple[1] != ':instance':
+                triple = model.invert(triple)
+            elif triple[0] != current:
+                current = triple[0]
+            if current not in branches:
+                # not a node of the laid-out tree; let penman place everything
+                return penman.encode(penman.Graph(graph.triples, top=graph.top), indent=None, compact=True)
+            branches[current].append(triple[1:])
+        return penman.format(penman.Tree(tree.node), indent=None, compact=True)
+
+    @staticmethod
+    def strip_quotes(value):
+        return value.replace('"', '') if isinstance(value, str) else value
+
+    def node_record(self, node, data, no_quotes):
+        record = dict(data, id=node)
+        if no_quotes:
+            record['id'] = self.strip_quotes(node)
+            if 'amr_token' in record:
+                record['amr_token'] = self.strip_quotes(record['amr_token'])
+        return record
+
+    def link_record(self, source, target, data, no_quotes):
+        if no_quotes:
+            source, target = self.strip_quotes(source), self.strip_quotes(target)
+        return dict(data, source=source, target=target)
+
+    @staticmethod
+    def write_record(output, record):
+        output['file'].write(('' if output['first'] else ', ') + json.dumps(record))
+        output['first'] = False
+
+    def unique_records(self, G, no_quotes):
+        # node and link records of one variant, merged the same way as in the JSON files
+        seen_nodes = set()
+        nodes = []
+        for node, data in G.nodes(data=True):
+            record = self.node_record(node, data, no_quotes)
+            if record['id'] not in seen_nodes:
+                seen_nodes.add(record['id'])
+                nodes.append(record)
+
+        def links():
+            seen_links = set()
+            for source, target, data in G.edges(data=True):
+                record = self.link_record(source, target, data, no_quotes)
+                if (record['source'], record['target']) not in seen_links:
+                    seen_links.update(((record['source'], record['target']), (record['target'], record['source'])))
+                    yield record
+
+        return nodes, links()
+
+    def write_stores(self, G, variants):
+        for name in variants:
+            path = os.path.join(self.save_path, '{}.sqlite'.format(name))
+            logger.debug('saving store to: {}', path)
+            nodes, links = self.unique_records(G, self.VARIANTS[name])
+            write_store(path, G.graph, nodes, links, directed=G.is_directed(), multigraph=G.is_multigraph())
+
+    def write_json(self, G, variants):
+        os.makedirs(self.save_path, exist_ok=True)
+        outputs = []
+        for name in variants:
+            path = os.path.join(self.save_path, '{}.json'.format(name))
+            logger.debug('saving file to: {}', path)
+            outputs.append({'file': open(path, 'w'), 'no_quotes': self.VARIANTS[name], 'seen': set(), 'first': True})
+
+        try:
+            # the same layout json.dump(nx.node_link_data(G)) produces, written record by record
+            # to every requested variant in a single walk over the graph
+            header = '{{"directed": {}, "multigraph": {}, "graph": {}, "nodes": ['.format(
+                json.dumps(G.is_directed()), json.dumps(G.is_multigraph()), json.dumps(G.graph))
+            for output in outputs:
+                output['file'].write(header)
+
+            # stripping quotes can merge nodes or links; the first one is kept
+            for node, data in G.nodes(data=True):
+                for output in outputs:
+                    record = self.node_record(node, data, output['no_quotes'])
+                    if output['no_quotes']:
+                        if record['id'] in output['seen']:
+                            continue
+                        output['seen'].add(record['id'])
+                    self.write_record(output, record)
+
+            for output in outputs:
+                output['file'].write('], "links": [')
+                output['seen'] = set()
+                output['first'] = True
+
+            for source, target, data in G.edges(data=True):
+                for output in outputs:
+                    record = self.link_record(source, target, data, output['no_quotes'])
+                    if output['no_quotes']:
+                        if (record['source'], record['target']) in output['seen']:
+                            continue
+                        output['seen'].update(((record['source'], record['target']),
+                                               (record['target'], record['source'])))
+                    self.write_record(output, record)
+
+            for output in outputs:
+                output['file'].write(']}')
+        finally:
+            for output in outputs:
+                output['file'].close()
+
+        return [output['file'].name for output in outputs]
+
+    def export(self, variants=('graph', 'graph_no_quotes'), store_variants=()):
+        for name in tuple(variants) + tuple(store_variants):
+            if name not in self.VARIANTS:
+                raise ValueError("Invalid export variant: {}".format(name))
+
+        try:
+            with stage('penman_encode', items=len(self.graph.triples)), paused_gc():
+                self.graph.metadata['kg_penman'] = self.encode_penman()
+        except Exception as e:
+            logger.error(e)
+            traceback.print_exception(*sys.exc_info())
+
+        with stage('graph_convert', items=len(self.graph.triples)):
+            G = GraphConverter(self.graph).convert()
+
+        with stage('json_dump', items=G.number_of_nodes() + G.number_of_edges()) as span:
+            paths = self.write_json(G, variants)
+            span.add(nbytes=sum(os.path.getsize(path) for path in paths))
+
+        # doc_id-indexed stores for the query path, see kg/kg_store.py
+        with stage('kg_store_write', items=len(store_variants)):
+            self.write_stores(G, store_variants)
+
+        return G
+
+
 class PathProcess():
-    def __init__(self):
+    def __init__(self, captions_path='captions.json', save_path='kg/kg_output', cluster_id='777',
+                 parse_cache_path='kg/.cache/amr_parses.sqlite'):
         super().__init__()
 
         # self.IMAGE_DATA_PATH = '/storage/projects/chiawei/m3dc/image_caption'
-        self.SAVE_PATH = './kg_output'
+        self.CAPTIONS_PATH = captions_path
+        self.SAVE_PATH = save_path
+        self.CLUSTER_ID = cluster_id
+        self.PARSER_MODEL = 'AMR3-structbart-L'
+        # per-caption AMR parses and coreference windows, reused by constructKG(append=True)
+        self.CHECKPOINT_PATH = os.path.join(save_path, 'checkpoints')
+        # captions parsed between two checkpoints
+        self.CHECKPOINT_EVERY = 16
+        # sentence-level AMR parses shared by all videos; None disables the cache
+        self.PARSE_CACHE_PATH = parse_cache_path
+        # tokens per coreference window; None resolves the whole text at once
+        self.COREF_WINDOW_SIZE = None
+        # window size used by append=True when COREF_WINDOW_SIZE is None, so that appended captions
+        # only re-predict the last windows; full builds keep full-text results
+        self.APPEND_COREF_WINDOW_SIZE = 512
+        # which of graph.json / graph_no_quotes.json to write
+        self.EXPORT_VARIANTS = ('graph', 'graph_no_quotes')
+        # which variants to also write as SQLite KG stores (kg/kg_store.py)
+        self.EXPORT_STORE_VARIANTS = ('graph_no_quotes',)
 
         # self.kg_creator = KGCreator(BATCH_SIZE=32, parser=AMRParser.from_pretrained('AMR3-structbart-L'))
         # self.entity_coreference = EntityCoreference()
         # self.event_coreference = EventCoref()
 
-    def constructKG(self):
+    def parse_captions(self, kg_creator, documents, append):
+        """Return the ParsedSentence lists of all documents, parsing only new or changed captions.
+
+        Parses are checkpointed every CHECKPOINT_EVERY captions, so an interrupted
+        run resumes from the last checkpoint when run again with append=True.
+        """
+        checkpoints = CaptionCheckpoints(self.CHECKPOINT_PATH)
+
+        parsed = [None] * len(documents)
+        hashes = []
+        for i, (key, doc_id, modal, sentence_list) in enumerate(documents):
+            hashes.append(content_hash(self.PARSER_MODEL, modal, sentence_list))
+            if append:
+                records = checkpoints.load(key, hashes[i])
+                if records is not None:
+                    parsed[i] = [ParsedSentence.from_dict(record) for record in records]
+
+        pending = [i for i, sentences in enumerate(parsed) if sentences is None]
+        logger.info('{} captions to parse, {} reused from checkpoints', len(pending), len(documents) - len(pending))
+
+        for chunk_start in range(0, len(pending), self.CHECKPOINT_EVERY):
+            chunk = pending[chunk_start:chunk_start + self.CHECKPOINT_EVERY]
+            # parse the sentences of many frames together so the parser sees full batches
+            results = kg_creator.parse_corpus([documents[i][3] for i in chunk])
+            for i, sentences in zip(chunk, results):
+                parsed[i] = sentences
+                checkpoints.save(documents[i][0], hashes[i], [sentence.to_dict() for sentence in sentences])
+
+        return parsed
+
+    def constructKG(self, append=False, kg_creator=None, entity_coreference=None):
+        # kg_creator and entity_coreference can be shared across videos so their models are loaded once
         
-        kg_creator = KGCreator(
-            BATCH_SIZE=32, parser=AMRParser.from_pretrained('AMR3-structbart-L'))
+        # the parser is only loaded if some sentence is neither checkpointed nor in the parse cache
+        if kg_creator is None:
+            parse_cache = AMRParseCache(self.PARSE_CACHE_PATH, self.PARSER_MODEL) if self.PARSE_CACHE_PATH else None
+            kg_creator = KGCreator(BATCH_SIZE=32, parse_cache=parse_cache, parser_model=self.PARSER_MODEL)
+        parse_cache = kg_creator.parse_cache
+        # :snt roles are numbered per graph
+        kg_creator.SENTENCE_COUNT = 0
         
-        entity_coreference = EntityCoreference()
+        coref_cache = CorefCache(os.path.join(self.CHECKPOINT_PATH, 'coref.json'))
+        if not append:
+            # a full build predicts every window again, and leaves the cache for later appends
+            coref_cache.clusters = {}
+        if entity_coreference is None:
+            window_size = self.COREF_WINDOW_SIZE
+            if window_size is None and append:
+                window_size = self.APPEND_COREF_WINDOW_SIZE
+            entity_coreference = EntityCoreference(window_size=window_size)
+        entity_coreference.cache = coref_cache
         # event_coreference = EventCoref()
         
         # for root, dirs, filenames in os.walk(os.path.join(TEXT_DATA_PATH)):
             
         # logger.info("Start constructing KG in {}", root)
-        multiDocKG = penman.graph.Graph()
-        multiDocKG.metadata['cluster_id'] = str()
-        # create a set to store all the document ids
-        multiDocKG.metadata['doc_ids'] = set()
-        # make 'multi-sentence' as the root node of the graph
-        multiDocKG.triples.append(
-            ('origin', ':instance', 'multi-sentence'))
-
         to_be_removed_ids = set()
         # logger.info('root = {}', root)
-        cluster_id = '777'
-        multiDocKG.metadata['cluster_id'] = cluster_id
+        cluster_id = self.CLUSTER_ID
+        multiDocKG = kg_creator.create_graph(cluster_id)
         # cluster_id = int(cluster_id)
         
-        frames = json.load(open(os.path.join('../', 'captions.json')))
+        frames = json.load(open(self.CAPTIONS_PATH))
+        documents = []
         for frame in frames:
-            doc_id = frame['frame'].split('.')[0].split('_')[1]
+            doc_id = os.path.basename(frame['frame']).split('.')[0].split('_')[1]
             doc_id = int(doc_id)
             logger.info('cluster id: {} doc id: {}',cluster_id, doc_id)
             
-            image_caption = sent_tokenize(frame['caption'])
-                    
-            if doc_id not in multiDocKG.metadata['doc_ids']:
-                # Add the document ID to the set
-                multiDocKG.metadata['doc_ids'].add(doc_id)
-                    
-                multiDocKG.metadata[doc_id] = dict()
-                multiDocKG.metadata[doc_id]['sentences'] = dict()
-                # TODO: to prevent disconnected graphs during entity & event coreference, combine all the sentences from the text and image modalities
-                multiDocKG.metadata[doc_id]['maintext'] = str()
-                
-                # to store the seperate text, image, video, audio content
-                multiDocKG.metadata[doc_id]['text'] = str()
-                multiDocKG.metadata[doc_id]['text_triples'] = list()
-                multiDocKG.metadata[doc_id]['image_caption'] = str()
-                multiDocKG.metadata[doc_id]['image_triples'] = list()
-                multiDocKG.metadata[doc_id]['video_caption'] = str()
-                multiDocKG.metadata[doc_id]['video_triples'] = list()
-                multiDocKG.metadata[doc_id]['audio_caption'] = str()
-                multiDocKG.metadata[doc_id]['audio_triples'] = list()
-                
-                multiDocKG.metadata[doc_id]['video_filename'] = str()
-
-            multiDocKG = kg_creator.createKGFromSentence(image_caption, multiDocKG, cluster_id, doc_id, modal='image')
-            
-            if len(multiDocKG.metadata['doc_ids']) == len(to_be_removed_ids):
-                logger.debug("Skip cluster: {}, document or image not exist", cluster_id)
-                continue
+            with stage('sentence_tokenize', items=1, nbytes=len(frame['caption'])):
+                image_caption = sent_tokenize(frame['caption'])
+
+            multiDocKG = kg_creator.add_document(multiDocKG, doc_id)
+            documents.append((frame['frame'], doc_id, 'image', image_caption))
+
+        parsed = self.parse_captions(kg_creator, documents, append)
+
+        # assembling the graph from parses is linear, so it is redone rather than patched
+        for (_, doc_id, modal, sentence_list), amr_graphs in zip(documents, parsed):
+            multiDocKG = kg_creator.createKGFromSentence(
+                sentence_list, multiDocKG, cluster_id, doc_id, modal=modal, amr_graphs=amr_graphs)
+
+        multiDocKG = kg_creator.finalize(multiDocKG)
+        if parse_cache is not None:
+            logger.info('AMR parse cache: {}', parse_cache.stats())
 
         for doc_id in to_be_removed_ids:
             if doc_id in multiDocKG.metadata['doc_ids']:
@@ -479,7 +923,10 @@ class PathProcess():
         if len(multiDocKG.metadata['doc_ids']) != 0:
             # entity coreference
             logger.debug("Start processing entity coreference")
-            multiDocKG = entity_coreference.resolve(multiDocKG)
+            with stage('coref', items=len(multiDocKG.metadata['doc_ids'])):
+                multiDocKG = entity_coreference.resolve(multiDocKG)
+            logger.info('coreference windows: {} reused, {} predicted', coref_cache.hits, coref_cache.misses)
+            coref_cache.save()
             
             # logger.info("Finish processing entity coreference")
             
@@ -487,32 +934,24 @@ class PathProcess():
             # logger.debug("Start processing event coreference")
             # multiDocKG = event_coreference.resolve(multiDocKG)
 
-            # TODO: unknown issue with penman, so we need to copy the graph and remove the metadata to encode the graph into penman
-            tempKG = copy.deepcopy(multiDocKG)
-            tempKG.metadata = {}
-
-            try:
-                multiDocKG.metadata['kg_penman'] = penman.encode(tempKG, indent=None, compact=True)
-            except Exception as e:
-                logger.error(e)
-                traceback.print_exception(*sys.exc_info())
-                # continue
-
-            G = GraphConverter(multiDocKG).convert()
-            d = nx.json_graph.node_link_data(G)
-
-            logger.debug('saving file to: {}', os.path.join(self.SAVE_PATH, cluster_id, 'graph.json'))
-            os.makedirs(os.path.join(self.SAVE_PATH), exist_ok=True)
-            json.dump(d, open(os.path.join(self.SAVE_PATH, 'graph.json'), 'w'))
-
-            # TODO: post-processing for json
-            G = GraphConverter(multiDocKG, no_escape_characters=True).convert()
-            d = nx.json_graph.node_link_data(G)
-            logger.debug('saving file to: {}', os.path.join(self.SAVE_PATH, cluster_id, 'graph_no_quotes.json'))
-            json.dump(d, open(os.path.join(self.SAVE_PATH, 'graph_no_quotes.json'), 'w'))
+            GraphExporter(multiDocKG, self.SAVE_PATH).export(self.EXPORT_VARIANTS, self.EXPORT_STORE_VARIANTS)
             
         logger.debug("Finish processing cluster: {}", cluster_id)
-    
-            
-PathProcess().constructKG()
+        return multiDocKG
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--captions', default='captions.json')
+    parser.add_argument('--save-path', default='kg/kg_output')
+    parser.add_argument('--cluster-id', default='777')
+    parser.add_argument('--parse-cache', default='kg/.cache/amr_parses.sqlite',
+                        help="sentence-level AMR parse cache, '' to disable")
+    parser.add_argument('--append', action='store_true',
+                        help='reuse checkpointed parses and only parse new or changed captions')
+    args = parser.parse_args()
+
+    PathProcess(args.captions, args.save_path, args.cluster_id, args.parse_cache).constructKG(append=args.append)
 
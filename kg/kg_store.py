@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE doc_info (doc_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE coreferences (doc_id TEXT PRIMARY KEY, docs TEXT NOT NULL);
+CREATE TABLE nodes (id TEXT PRIMARY KEY, doc_id TEXT, data TEXT NOT NULL);
+CREATE TABLE links (source TEXT NOT NULL, target TEXT NOT NULL, source_doc TEXT, target_doc TEXT, data TEXT NOT NULL);
+'''
+
+# created after the bulk insert, which is faster than maintaining them row by row
+INDEXES = '''
+CREATE INDEX nodes_doc_id ON nodes (doc_id);
+CREATE INDEX links_source_doc ON links (source_doc);
+CREATE INDEX links_target_doc ON links (target_doc);
+'''
+
+
+def node_doc_id(node_id, data):
+    # KG nodes carry their document in sim_group; the 'origin' root belongs to none
+    sim_group = data.get('sim_group')
+    return None if sim_group in (None, -1) else str(sim_group)
+
+
+def write_store(path, graph, nodes, links, directed=False, multigraph=False):
+    """Write a KG store from the graph attributes and iterables of node-link records.
+
+    Node records are dicts with an 'id', link records dicts with 'source' and
+    'target', as in networkx's node-link format.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('directed', json.dumps(directed)),
+            ('multigraph', json.dumps(multigraph)),
+            ('kg_penman', graph.get('kg_penman', '')),
+            ('graph', json.dumps({key: value for key, value in graph.items()
+                                  if key not in ('kg_penman', 'doc_info', 'coreferences')})),
+        ])
+        connection.executemany('INSERT INTO doc_info VALUES (?, ?)', (
+            (str(doc_id), json.dumps(info)) for doc_id, info in graph.get('doc_info', {}).items()))
+        connection.executemany('INSERT INTO coreferences VALUES (?, ?)', (
+            (str(doc_id), json.dumps(docs)) for doc_id, docs in graph.get('coreferences', {}).items()))
+
+        node_docs = {}
+
+        def node_rows():
+            for record in nodes:
+                data = {key: value for key, value in record.items() if key != 'id'}
+                doc_id = node_doc_id(record['id'], data)
+                node_docs[record['id']] = doc_id
+                yield record['id'], doc_id, json.dumps(data)
+
+        connection.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)', node_rows())
+        connection.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?)', (
+            (record['source'], record['target'], node_docs.get(record['source']), node_docs.get(record['target']),
+             json.dumps({key: value for key, value in record.items() if key not in ('source', 'target')}))
+            for record in links))
+        connection.executescript(INDEXES)
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_path, path)
+
+
+def convert_node_link_json(json_path, store_path=None):
+    store_path = store_path or os.path.splitext(json_path)[0] + '.sqlite'
+    with open(json_path, 'r') as kg_file:
+        data = json.load(kg_file)
+    write_store(store_path, data['graph'], data['nodes'], data.get('links', data.get('edges', [])),
+                directed=data.get('directed', False), multigraph=data.get('multigraph', False))
+    return store_path
+
+
+class KGStore:
+    """Read-only, doc_id-indexed access to a KG written by `write_store`.
+
+    Opening the store reads nothing; every accessor fetches only the records it
+    returns. Connections are per thread, so one store can serve concurrent queries.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.local = threading.local()
+        # every thread's connection, so close() can release them all
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            # closed from whichever thread calls close(), never while in use
+            connection = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True, check_same_thread=False)
+            with self.connections_lock:
+                self.connections.append(connection)
+            self.local.connection = connection
+        return self.local.connection
+
+    def close(self):
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            self.local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def doc_info(self, doc_id):
+        row = self.connection.execute('SELECT data FROM doc_info WHERE doc_id = ?', (str(doc_id),)).fetchone()
+        if row is None:
+            raise KeyError(doc_id)
+        return json.loads(row[0])
+
+    def coreferences(self, doc_id):
+        row = self.connection.execute('SELECT docs FROM coreferences WHERE doc_id = ?', (str(doc_id),)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def doc_ids(self):
+        return [row[0] for row in self.connection.execute('SELECT doc_id FROM doc_info')]
+
+    def penman(self):
+        return self.connection.execute("SELECT value FROM meta WHERE key = 'kg_penman'").fetchone()[0]
+
+    def nodes(self, doc_id=None):
+        if doc_id is None:
+            rows = self.connection.execute('SELECT id, data FROM nodes')
+        else:
+            rows = self.connection.execute('SELECT id, data FROM nodes WHERE doc_id = ?', (str(doc_id),))
+        return [dict(json.loads(data), id=node_id) for node_id, data in rows]
+
+    def links(self, doc_id=None):
+        if doc_id is None:
+            rows = self.connection.execute('SELECT source, target, data FROM links')
+        else:
+            rows = self.connection.execute(
+                'SELECT source, target, data FROM links WHERE source_doc = ? '
+                'UNION ALL SELECT source, target, data FROM links WHERE target_doc = ? AND source_doc IS NOT ?',
+                (str(doc_id), str(doc_id), str(doc_id)))
+        return [dict(json.loads(data), source=source, target=target) for source, target, data in rows]
+
+
+class NodeLinkGraph:
+    """The KGStore accessors over an already loaded node-link JSON graph."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def doc_info(self, doc_id):
+        return self.data['graph']['doc_info'][str(doc_id)]
+
+    def coreferences(self, doc_id):
+        return self.data['graph']['coreferences'].get(str(doc_id), [])
+
+    def doc_ids(self):
+        return list(self.data['graph']['doc_info'].keys())
+
+    def penman(self):
+        return self.data['graph']['kg_penman']
+
+    def nodes(self, doc_id=None):
+        return [dict(node) for node in self.data['nodes']
+                if doc_id is None or node_doc_id(node['id'], node) == str(doc_id)]
+
+    def links(self, doc_id=None):
+        links = self.data.get('links', self.data.get('edges', []))
+        if doc_id is None:
+            return [dict(link) for link in links]
+        # same order as KGStore: links leaving the doc's nodes, then those only entering them
+        node_docs = {node['id']: node_doc_id(node['id'], node) for node in self.data['nodes']}
+        doc_id = str(doc_id)
+        return [dict(link) for link in links if node_docs.get(link['source']) == doc_id] + [
+            dict(link) for link in links
+            if node_docs.get(link['target']) == doc_id and node_docs.get(link['source']) != doc_id]
+
+    def close(self):
+        pass
+
+
+def load_graph(path):
+    # prefer an up-to-date .sqlite store next to a node-link .json file
+    if path.endswith('.json'):
+        store_path = os.path.splitext(path)[0] + '.sqlite'
+        if os.path.exists(store_path) and (
+                not os.path.exists(path) or os.path.getmtime(store_path) >= os.path.getmtime(path)):
+            path = store_path
+    if path.endswith('.sqlite'):
+        return KGStore(path)
+
+    with open(path, 'r') as kg_file:
+        return NodeLinkGraph(json.load(kg_file))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert node-link KG JSON files to KG stores')
+    parser.add_argument('json_paths', nargs='+')
+    args = parser.parse_args()
+
+    for json_path in args.json_paths:
+        print(convert_node_link_json(json_path))
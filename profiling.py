@@ -0,0 +1,183 @@
+import atexit
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+# VIDEOAGENT_PROFILE=<dir> turns profiling on for any entry point and writes
+# <dir>/profile.json and <dir>/trace.json when the process exits
+PROFILE_ENV = 'VIDEOAGENT_PROFILE'
+
+
+def peak_rss_mb():
+    # high-water mark of the whole process; ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+class Span:
+    """One timed run of a stage; `add` counts items and payload bytes while it is open."""
+
+    def __init__(self, profiler, name, items, nbytes, args):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+        self.bytes = nbytes
+        self.args = args
+
+    def add(self, items=0, nbytes=0):
+        self.items += items
+        self.bytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.cpu_start = time.thread_time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.profiler.record({
+            'name': self.name,
+            'start_ns': self.start,
+            'wall_ns': end - self.start,
+            'cpu_ns': time.thread_time_ns() - self.cpu_start,
+            'items': self.items,
+            'bytes': self.bytes,
+            'peak_rss_mb': peak_rss_mb(),
+            'tid': threading.get_ident(),
+            'error': exc_info[0].__name__ if exc_info[0] else None,
+            'args': self.args,
+        })
+        return False
+
+
+class NullSpan:
+    # returned while profiling is off, so instrumented code costs one call and a with block
+
+    def add(self, items=0, nbytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    """Collects stage spans from all threads and exports a JSON summary and a Chrome trace.
+
+    CPU time is per thread (the span's own thread), peak RSS is the process
+    high-water mark when the span ends.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.origin_ns = time.perf_counter_ns()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.spans = []
+            self.origin_ns = time.perf_counter_ns()
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            stages.setdefault(span['name'], []).append(span)
+
+        summary = {}
+        for name, stage_spans in stages.items():
+            walls = sorted(span['wall_ns'] / 1e9 for span in stage_spans)
+            wall = sum(walls)
+            items = sum(span['items'] for span in stage_spans)
+            summary[name] = {
+                'calls': len(stage_spans),
+                'errors': sum(1 for span in stage_spans if span['error']),
+                'wall_s': round(wall, 6),
+                'cpu_s': round(sum(span['cpu_ns'] for span in stage_spans) / 1e9, 6),
+                'mean_s': round(wall / len(walls), 6),
+                'p50_s': round(walls[len(walls) // 2], 6),
+                'p95_s': round(walls[min(len(walls) - 1, int(len(walls) * 0.95))], 6),
+                'max_s': round(walls[-1], 6),
+                'items': items,
+                'items_per_s': round(items / wall, 3) if wall else None,
+                'bytes': sum(span['bytes'] for span in stage_spans),
+                'peak_rss_mb': round(max(span['peak_rss_mb'] for span in stage_spans), 1),
+            }
+        return summary
+
+    def trace_events(self):
+        # Chrome trace "complete" events, viewable in chrome://tracing or ui.perfetto.dev
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        return [{
+            'name': span['name'],
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': (span['start_ns'] - self.origin_ns) / 1000,
+            'dur': span['wall_ns'] / 1000,
+            'pid': pid,
+            'tid': span['tid'],
+            'args': dict(span['args'], items=span['items'], bytes=span['bytes'], cpu_ms=span['cpu_ns'] / 1e6,
+                         error=span['error']),
+        } for span in spans]
+
+    def export(self, summary_path=None, trace_path=None):
+        if summary_path:
+            with open(summary_path, 'w') as summary_file:
+                json.dump(self.summary(), summary_file, indent=4)
+        if trace_path:
+            with open(trace_path, 'w') as trace_file:
+                json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, trace_file)
+
+
+PROFILER = Profiler()
+
+
+def stage(name, items=0, nbytes=0, **args):
+    """Time a pipeline stage: `with stage('amr_batch', items=len(batch)) as span: ...`"""
+    if not PROFILER.enabled:
+        return NULL_SPAN
+    return Span(PROFILER, name, items, nbytes, args)
+
+
+def enable():
+    PROFILER.enable()
+
+
+def export(summary_path=None, trace_path=None):
+    PROFILER.export(summary_path, trace_path)
+
+
+def export_on_exit(directory):
+    os.makedirs(directory, exist_ok=True)
+    # worker processes (e.g. batch.py decoding) write their own files next to the parent's
+    suffix = '-{}'.format(os.getpid()) if multiprocessing.parent_process() is not None else ''
+    atexit.register(export, os.path.join(directory, 'profile{}.json'.format(suffix)),
+                    os.path.join(directory, 'trace{}.json'.format(suffix)))
+
+
+if os.environ.get(PROFILE_ENV):
+    enable()
+    export_on_exit(os.environ[PROFILE_ENV])
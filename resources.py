@@ -0,0 +1,116 @@
+# Local-first loading of the models and data files the pipeline needs: CLIP, FCoref's
+# weights (Hugging Face hub cache), the AMR parser checkpoint and nltk's punkt tables.
+# Cached copies are used without any network request; a missing resource is downloaded
+# unless VIDEOAGENT_OFFLINE=1 (or HF_HUB_OFFLINE=1) is set, in which case loading fails
+# with a pointer to `python resources.py fetch`. Run that on a machine with network
+# access and copy the Hugging Face cache, the AMR parser cache and VIDEOAGENT_CACHE to
+# air-gapped workers.
+import argparse
+import os
+
+from loguru import logger
+
+CACHE_DIR = os.environ.get('VIDEOAGENT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'videoagent'))
+NLTK_DATA = os.path.join(CACHE_DIR, 'nltk_data')
+# sent_tokenize's tables since nltk 3.8.2; older releases read 'punkt'
+PUNKT = 'punkt_tab'
+COREF_MODEL = 'biu-nlp/f-coref'
+
+_punkt_ready = False
+
+
+def offline():
+    return any(os.environ.get(name, '') not in ('', '0') for name in ('VIDEOAGENT_OFFLINE', 'HF_HUB_OFFLINE'))
+
+
+def missing(name):
+    return OSError('{} is not in the local cache and offline mode is on; run `python resources.py fetch` '
+                   'where the network is reachable and copy the caches over'.format(name))
+
+
+def pretrained(cls, name, **kwargs):
+    """`cls.from_pretrained(name)` for a transformers class, from the local cache if possible."""
+    try:
+        return cls.from_pretrained(name, local_files_only=True, **kwargs)
+    except OSError:
+        if offline():
+            raise missing(name) from None
+    logger.info('Downloading {}', name)
+    return cls.from_pretrained(name, **kwargs)
+
+
+def hub_path(repo_id):
+    # local snapshot directory of a Hugging Face hub repo, for loaders without local_files_only
+    from huggingface_hub import snapshot_download
+    from huggingface_hub.errors import LocalEntryNotFoundError
+
+    try:
+        return snapshot_download(repo_id, local_files_only=True)
+    except LocalEntryNotFoundError:
+        if offline():
+            raise missing(repo_id) from None
+    logger.info('Downloading {}', repo_id)
+    return snapshot_download(repo_id)
+
+
+def load_coref_model(device='cpu'):
+    from fastcoref import FCoref
+
+    return FCoref(model_name_or_path=hub_path(COREF_MODEL), device=device)
+
+
+def load_amr_parser(model_name):
+    # the parser keeps downloaded checkpoints in its own cache and reuses them offline
+    from transition_amr_parser.parse import AMRParser
+
+    return AMRParser.from_pretrained(model_name)
+
+
+def ensure_punkt():
+    global _punkt_ready
+    if _punkt_ready:
+        return
+    import nltk
+
+    if NLTK_DATA not in nltk.data.path:
+        nltk.data.path.append(NLTK_DATA)
+    try:
+        nltk.data.find('tokenizers/' + PUNKT)
+    except LookupError:
+        if offline():
+            raise missing('nltk ' + PUNKT) from None
+        logger.info('Downloading nltk {} to {}', PUNKT, NLTK_DATA)
+        if not nltk.download(PUNKT, download_dir=NLTK_DATA, quiet=True):
+            raise OSError('Could not download nltk {} to {}'.format(PUNKT, NLTK_DATA))
+    _punkt_ready = True
+
+
+def sent_tokenize(text):
+    # nltk is imported and its tables located on the first call only
+    ensure_punkt()
+    from nltk.tokenize import sent_tokenize as nltk_sent_tokenize
+
+    return nltk_sent_tokenize(text)
+
+
+def fetch(clip_model, parser_model):
+    from transformers import CLIPModel, CLIPProcessor
+
+    for cls in (CLIPModel, CLIPProcessor):
+        pretrained(cls, clip_model)
+    print('CLIP:', clip_model)
+    print('coreference:', hub_path(COREF_MODEL))
+    ensure_punkt()
+    print('nltk:', NLTK_DATA)
+    load_amr_parser(parser_model)
+    print('AMR parser:', parser_model)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate the local caches for offline runs')
+    parser.add_argument('command', choices=['fetch'])
+    parser.add_argument('--clip-model', default='openai/clip-vit-base-patch32')
+    parser.add_argument('--parser-model', default='AMR3-structbart-L')
+    args = parser.parse_args()
+
+    fetch(args.clip_model, args.parser_model)
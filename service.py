@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+from clip_index import CLIP_MODEL, FrameIndex, top_k_scores
+from evidence import EvidenceSelector, caption_text, read_image_size, text_tokens
+from frame_encoding import FrameEncoder
+from kg.kg_store import load_graph
+from profiling import stage
+
+SYSTEM_PROMPT = '''You are an AI assistant tasked with analyzing the video frames and captions that will be provided in order to answer the given question. Carefully examine each image and its associated caption. Based on the information given in the images and captions, provide a clear answer to the question. If the images and captions do not contain enough information to conclusively answer the question, indicate that the answer is unclear given the limited information available. Do not make assumptions or inferences beyond what is explicitly stated or shown. You should also elaborate where the evidence is found.'''
+
+
+class QueryService:
+    """Answers questions about a processed video with warm models and a resident KG.
+
+    CLIP, the frame index, the knowledge graph and the OpenAI client are
+    loaded once; `answer` is safe to call from several threads and reports
+    per-stage latency for every question. The captions and frames sent to
+    the LLM are chosen by `selector` (see evidence.py) within its token and
+    latency budget. Unless `model` is given, CLIP is loaded with
+    `clip_index.load_clip_model(clip_model, **clip_options)` by `load_models`
+    or the first question that needs it.
+    """
+
+    def __init__(self, api_key, frames_dir='frames', kg_path='kg/kg_output/graph_no_quotes.json',
+                 clip_model=CLIP_MODEL, llm_model="gpt-4-turbo", max_tokens=300, top_k=1,
+                 model=None, processor=None, encoder=None, client=None, selector=None, clip_options=None):
+        self.frames_dir = frames_dir
+        self.kg_path = kg_path
+        self.llm_model = llm_model
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        # Images sent to the LLM are re-encoded in memory as downscaled JPEGs
+        self.encoder = encoder or FrameEncoder(image_format="jpeg", max_side=768, quality=85)
+        if client is None:
+            import openai
+
+            client = openai.Client(api_key=api_key)
+        self.client = client
+        self.selector = selector or EvidenceSelector()
+        self.lock = threading.Lock()
+        # questions still reading each KG, so refresh() closes a replaced one only once they are done
+        self.kg_readers = {}
+        self.kg = None
+
+        start = time.perf_counter()
+        self.frame_index = FrameIndex(frames_dir, model=model, processor=processor, model_name=clip_model,
+                                      model_options=clip_options)
+        self.refresh()
+        logger.info('Query service ready in {:.2f}s', time.perf_counter() - start)
+
+    def load_models(self):
+        # load CLIP now rather than on the first question
+        start = time.perf_counter()
+        self.frame_index.load_model()
+        logger.info('CLIP loaded in {:.2f}s', time.perf_counter() - start)
+
+    def refresh(self):
+        # pick up new frames or a rebuilt KG without restarting the service
+        with self.lock:
+            self.frame_index.build()
+            self.frame_locations = {}
+            for entry in self.frame_index.entries:
+                self.frame_locations[entry['id'].split('_')[1]] = entry['path']
+            # a KG store next to the JSON file is opened instead, reading only the queried docs
+            old_kg, self.kg = self.kg, load_graph(self.kg_path)
+            close_old_kg = old_kg is not None and not self.kg_readers.get(old_kg)
+        if close_old_kg:
+            old_kg.close()
+
+    def snapshot(self, hold_kg=False):
+        # refresh() replaces these under the lock, so a question reads them once, together;
+        # with hold_kg the KG stays open until release_kg
+        with self.lock:
+            if hold_kg:
+                self.kg_readers[self.kg] = self.kg_readers.get(self.kg, 0) + 1
+            return {'entries': self.frame_index.entries, 'embeddings': self.frame_index.embeddings,
+                    'kg': self.kg, 'frame_locations': self.frame_locations}
+
+    def release_kg(self, kg):
+        with self.lock:
+            readers = self.kg_readers.pop(kg) - 1
+            if readers:
+                self.kg_readers[kg] = readers
+                return
+            if kg is self.kg:
+                return
+        kg.close()
+
+    def retrieve(self, question, state=None):
+        state = state or self.snapshot()
+        # Score the whole question and each of its parts against all frames in one call
+        question_parts = [part.strip() + '?' for part in question.split('?') if part.strip()]
+        queries = [question] + question_parts if len(question_parts) > 1 else [question]
+        scores = self.frame_index.score_many(queries, state['embeddings'])
+        entries = state['entries']
+        rankings = [[(entries[col], float(scores[row, col])) for col in cols]
+                    for row, cols in enumerate(top_k_scores(scores, self.top_k))]
+
+        retrieved_doc_ids = []
+        for query, ranking in zip(queries, rankings):
+            for entry, score in ranking:
+                logger.info('{} -> {} ({:.2f})', query, entry['id'], score)
+                if entry['id'].split('_')[1] not in retrieved_doc_ids:
+                    retrieved_doc_ids.append(entry['id'].split('_')[1])
+
+        # best score of every frame over the question and its parts, for ranking KG neighbours too
+        frame_scores = dict(zip((entry['id'].split('_')[1] for entry in entries), scores.max(axis=0).tolist()))
+        return rankings, retrieved_doc_ids, frame_scores
+
+    def select_evidence(self, question, retrieved_doc_ids, frame_scores, state=None):
+        state = state or self.snapshot()
+        base_tokens = text_tokens(SYSTEM_PROMPT) + text_tokens(question)
+        return self.selector.select(question, state['kg'], retrieved_doc_ids, frame_scores, state['frame_locations'],
+                                    read_image_size, base_tokens=base_tokens, max_side=self.encoder.max_side)
+
+    def build_messages(self, question, images):
+        messages = [
+            {
+                'role': 'system',
+                'content': [
+                    {
+                        'type': 'text',
+                        'text': SYSTEM_PROMPT
+                    }
+                ]
+            },
+            {
+                'role': 'user',
+                'content': [
+                    {
+                        'type': 'text',
+                        'text': question,
+                    }
+                ]
+            }
+        ]
+
+        # Add the selected captions, then the frames whose captions were not enough
+        for image in images:
+            messages[1]['content'].append({
+                "type": "text",
+                "text": caption_text(image['frame_id'], image['caption'])
+            })
+
+        for image in images:
+            if not image['image']:
+                continue
+            messages[1]['content'].append(
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": self.encoder.encode_file(image['location']).data_url,
+                        "detail": image['image']
+                    }
+                }
+            )
+
+        return messages
+
+    def answer(self, question):
+        latency = {}
+        start = time.perf_counter()
+
+        state = self.snapshot(hold_kg=True)
+        try:
+            rankings, retrieved_doc_ids, frame_scores = self.retrieve(question, state)
+            latency['retrieval'] = time.perf_counter() - start
+
+            stage_start = time.perf_counter()
+            images, evidence = self.select_evidence(question, retrieved_doc_ids, frame_scores, state)
+        finally:
+            self.release_kg(state['kg'])
+        messages = self.build_messages(question, images)
+        latency['evidence'] = time.perf_counter() - stage_start
+        logger.info('image payloads: {}', self.encoder.report())
+
+        stage_start = time.perf_counter()
+        payload_bytes = sum(len(part['text'] if part['type'] == 'text' else part['image_url']['url'])
+                            for message in messages for part in message['content'])
+        with stage('llm_call', items=1, nbytes=payload_bytes, model=self.llm_model):
+            response = self.client.chat.completions.create(
+                model=self.llm_model,
+                messages=messages,
+                max_tokens=self.max_tokens
+            )
+        latency['llm'] = time.perf_counter() - stage_start
+        latency['total'] = time.perf_counter() - start
+        with self.lock:
+            self.selector.latency_model.observe(evidence['tokens'], evidence['images'], latency['llm'])
+
+        # an empty frames directory ranks no frames
+        best_entry, best_score = rankings[0][0] if rankings[0] else (None, None)
+        return {
+            'question': question,
+            'answer': response.choices[0].message.content,
+            'best_frame': os.path.basename(best_entry['path']) if best_entry else None,
+            'best_score': best_score,
+            'frames': [str(image['frame_id']) for image in images],
+            'images': [str(image['frame_id']) for image in images if image['image']],
+            'evidence': evidence,
+            'latency': latency,
+        }
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path == '/refresh':
+            self.server.service.refresh()
+            self.send_json(200, {'status': 'ok'})
+            return
+        if self.path != '/query':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            question = request['question']
+        except (ValueError, KeyError):
+            self.send_json(400, {'error': 'expected a JSON body with a "question"'})
+            return
+
+        try:
+            self.send_json(200, self.server.service.answer(question))
+        except Exception as e:
+            logger.exception('Failed to answer: {}', question)
+            self.send_json(500, {'error': str(e)})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(service, host='127.0.0.1', port=8000):
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    service.load_models()
+    server.service = service
+    logger.info('Serving questions on http://{}:{}/query', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', ''))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--top-k', type=int, default=1)
+    parser.add_argument('--frames-dir', default='frames')
+    parser.add_argument('--kg-path', default='kg/kg_output/graph_no_quotes.json')
+    parser.add_argument('--token-budget', type=int, default=4000, help='estimated prompt tokens per question')
+    parser.add_argument('--latency-budget', type=float, help='estimated LLM seconds per question')
+    parser.add_argument('--max-images', type=int, default=4)
+    parser.add_argument('--cpu-optimized', action='store_true',
+                        help='int8 CLIP with pinned threads for CPU-only hosts, see clip_index.CPUCLIPModel')
+    parser.add_argument('--threads', type=int, help='intra-op threads for --cpu-optimized')
+    parser.add_argument('--interop-threads', type=int, help='inter-op threads for --cpu-optimized')
+    parser.add_argument('--trace', action='store_true', help='trace the CLIP towers for --cpu-optimized')
+    args = parser.parse_args()
+
+    selector = EvidenceSelector(max_tokens=args.token_budget, max_latency=args.latency_budget,
+                                max_images=args.max_images)
+    clip_options = dict(cpu_optimized=True, threads=args.threads, interop_threads=args.interop_threads,
+                        trace=args.trace) if args.cpu_optimized else None
+    serve(QueryService(args.api_key, frames_dir=args.frames_dir, kg_path=args.kg_path, top_k=args.top_k,
+                       selector=selector, clip_options=clip_options),
+          args.host, args.port)
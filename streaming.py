@@ -0,0 +1,337 @@
+import argparse
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from batch import KGStage, VideoJob
+from caption_cache import CaptionCache
+from captioning import CaptionClient
+from frame_encoding import FrameEncoder
+from frames import frame_thumbnail
+
+
+class FrameRing:
+    """Bounded buffer between the stream reader and the sampler.
+
+    A live source cannot be paused, so when the buffer is full the oldest
+    frame is dropped (`drop_oldest=True`); for files the reader blocks
+    instead. Either way at most `capacity` decoded frames are held.
+    """
+
+    def __init__(self, capacity=64, drop_oldest=True):
+        self.capacity = capacity
+        self.drop_oldest = drop_oldest
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            while len(self.items) >= self.capacity and not self.drop_oldest and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return False
+            if len(self.items) >= self.capacity:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        # returns None once the ring is closed and drained
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def iter_capture(source, follow=False, poll_interval=0.5, idle_timeout=10.0):
+    """Yield (frame_index, timestamp, frame) from a camera index, URL or video file.
+
+    The frame count is never needed. With `follow=True` the end of a file is
+    treated as "no data yet": the file is re-opened at the current position
+    until no new frame has arrived for `idle_timeout` seconds.
+    """
+    cap = cv2.VideoCapture(source)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_index = 0
+    last_frame_time = time.monotonic()
+    try:
+        while True:
+            ret, frame = cap.read()
+            if ret:
+                last_frame_time = time.monotonic()
+                position = cap.get(cv2.CAP_PROP_POS_MSEC)
+                # cameras and some streams report no position
+                timestamp = position / 1000.0 if position > 0 else frame_index / fps
+                yield frame_index, timestamp, frame
+                frame_index += 1
+                continue
+            if not follow or time.monotonic() - last_frame_time > idle_timeout:
+                return
+            time.sleep(poll_interval)
+            cap.release()
+            cap = cv2.VideoCapture(source)
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    finally:
+        cap.release()
+
+
+def iter_source(source, fps=30.0, follow=False):
+    # anything that is not a capture source is an iterable of frames, e.g. a local generator
+    if isinstance(source, (int, str)):
+        return iter_capture(source, follow=follow)
+    return ((frame_index, frame_index / fps, frame) for frame_index, frame in enumerate(source))
+
+
+def read_into_ring(frames, ring):
+    try:
+        for item in frames:
+            if not ring.put(item):
+                break
+    except Exception:
+        logger.exception('stream reader failed')
+    finally:
+        ring.close()
+
+
+class StreamSampler:
+    """Decide which stream frames to keep, by elapsed stream time and/or visual change.
+
+    A frame is kept when `interval` seconds have passed since the last kept
+    frame, or when its scene-change score against the last kept frame (the
+    same histogram/pixel delta as `frames.score_scene_changes`) reaches
+    `change_threshold` and at least `min_interval` seconds have passed.
+    """
+
+    def __init__(self, interval=None, change_threshold=None, min_interval=0.0, size=(64, 36), bins=32,
+                 hist_weight=0.5):
+        if interval is None and change_threshold is None:
+            raise ValueError("Set interval, change_threshold or both")
+        self.interval = interval
+        self.change_threshold = change_threshold
+        self.min_interval = min_interval
+        self.size = size
+        self.bins = bins
+        self.hist_weight = hist_weight
+        self.last_time = None
+        self.last_thumbnail = None
+        self.last_hist = None
+
+    def histogram(self, thumbnail):
+        return np.bincount(thumbnail.astype(np.int64) * self.bins // 256, minlength=self.bins) / thumbnail.size
+
+    def keep(self, timestamp, frame):
+        if self.last_time is not None:
+            elapsed = timestamp - self.last_time
+            due = self.interval is not None and elapsed >= self.interval
+            if not due and (self.change_threshold is None or elapsed < self.min_interval):
+                return False
+
+        thumbnail = hist = None
+        if self.change_threshold is not None:
+            thumbnail = frame_thumbnail(frame, self.size)
+            hist = self.histogram(thumbnail)
+            if self.last_time is not None and not due:
+                hist_delta = 0.5 * np.abs(hist - self.last_hist).sum()
+                pixel_delta = np.abs(thumbnail.astype(np.int16) - self.last_thumbnail).mean() / 255.0
+                if self.hist_weight * hist_delta + (1 - self.hist_weight) * pixel_delta < self.change_threshold:
+                    return False
+
+        self.last_time = timestamp
+        self.last_thumbnail = thumbnail
+        self.last_hist = hist
+        return True
+
+
+def sample_stream(ring, sampler):
+    # yield the kept (frame_index, timestamp, frame) items as the reader fills the ring
+    while True:
+        item = ring.get()
+        if item is None:
+            return
+        frame_index, timestamp, frame = item
+        if sampler.keep(timestamp, frame):
+            yield item
+
+
+class StreamPipeline:
+    """Caption sampled stream frames and keep the KG up to date while the stream runs.
+
+    The stream is split into segments of about `segment_frames` captioned
+    frames, each a folder `output_dir/<cluster_id>_<n>` in the batch.py layout
+    with its own cluster ID. Frames are encoded and captioned in batches of
+    `caption_batch`; every `kg_every` new captions the KG of the current
+    segment is rebuilt in append mode, which only parses the new captions, so
+    an update costs at most one segment however long the stream runs. `run` is
+    a generator of progress events, so the caller sets the pace: while a batch
+    is being captioned the ring fills up, and then the reader blocks or drops
+    frames. A restarted pipeline continues the last segment and its frame
+    numbering.
+    """
+
+    def __init__(self, output_dir='stream_output', cluster_id='stream', api_key='', caption_client=None,
+                 encoder=None, caption_batch=8, kg_every=32, kg_stage=None, segment_frames=512):
+        self.output_dir = output_dir
+        self.cluster_id = cluster_id
+        self.client = caption_client or CaptionClient(api_key, cache=CaptionCache('.cache/captions.sqlite'))
+        self.encoder = encoder or FrameEncoder(image_format="jpeg", max_side=768, quality=85)
+        self.caption_batch = caption_batch
+        self.kg_every = kg_every
+        # None disables KG updates; the stage loads the AMR parser and FCoref once
+        self.kg_stage = kg_stage
+        self.segment_frames = segment_frames
+        self.since_kg = 0
+        self.caption_count = 0
+        # frame names continue after the frames of an earlier run, so doc ids stay unique
+        self.next_frame = 0
+
+        segments = self.segments()
+        for segment in reversed(segments):
+            captions = self.load_captions(self.segment_job(segment))
+            if captions:
+                self.next_frame = max(int(os.path.splitext(caption['frame'])[0].split('_')[-1])
+                                      for caption in captions) + 1
+                break
+        self.open_segment(segments[-1] if segments else 0)
+
+    def segments(self):
+        pattern = re.compile(re.escape(self.cluster_id) + r'_(\d+)')
+        matches = (pattern.fullmatch(name) for name in os.listdir(self.output_dir)) \
+            if os.path.isdir(self.output_dir) else ()
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def segment_job(self, segment):
+        name = '{}_{}'.format(self.cluster_id, segment)
+        return VideoJob(None, name, os.path.join(self.output_dir, name))
+
+    @staticmethod
+    def load_captions(job):
+        if not os.path.exists(job.captions_path):
+            return []
+        with open(job.captions_path) as captions_file:
+            return json.load(captions_file)
+
+    def open_segment(self, segment):
+        self.segment = segment
+        self.job = self.segment_job(segment)
+        os.makedirs(self.job.frames_dir, exist_ok=True)
+        self.captions = self.load_captions(self.job)
+
+    def caption(self, frames):
+        results = self.client.caption_all([frame.base64 for frame in frames], frames[0].mime_type)
+        for frame, caption in zip(frames, results):
+            frame.save(self.job.frames_dir)
+            self.captions.append({'frame': frame.name, 'caption': caption})
+        self.caption_count += len(frames)
+        # captions.json is replaced atomically, readers never see a partial file
+        with open(self.job.captions_path + '.tmp', 'w') as captions_file:
+            json.dump(self.captions, captions_file, indent=4)
+        os.replace(self.job.captions_path + '.tmp', self.job.captions_path)
+
+    def update_kg(self):
+        start = time.perf_counter()
+        try:
+            self.kg_stage.process(self.job)
+        except Exception:
+            # a failed update is retried with the next batch, the stream keeps running
+            logger.exception('KG update failed')
+            return None
+        self.since_kg = 0
+        return time.perf_counter() - start
+
+    def process_batch(self, frames, ring, final=False):
+        kg_seconds = []
+        if frames and len(self.captions) >= self.segment_frames:
+            # the full segment gets its last KG update, later frames go to a new one
+            if self.kg_stage is not None and self.since_kg:
+                kg_seconds.append(self.update_kg())
+                if self.since_kg:
+                    logger.warning('{} is closed without the KG of its last {} captions', self.job.cluster_id,
+                                   self.since_kg)
+            self.since_kg = 0
+            self.open_segment(self.segment + 1)
+
+        start = time.perf_counter()
+        if frames:
+            self.caption(frames)
+            self.since_kg += len(frames)
+        caption_seconds = time.perf_counter() - start
+        if self.kg_stage is not None and self.since_kg and (self.since_kg >= self.kg_every or final):
+            kg_seconds.append(self.update_kg())
+        kg_seconds = [seconds for seconds in kg_seconds if seconds is not None]
+        return {'captioned': len(frames), 'captions': self.caption_count, 'segment': self.job.cluster_id,
+                'caption_seconds': caption_seconds, 'dropped': ring.dropped, 'buffered': len(ring.items),
+                'kg_seconds': sum(kg_seconds) if kg_seconds else None}
+
+    def run(self, source, sampler, ring_capacity=64, drop_oldest=None, fps=30.0, follow=False):
+        """Process `source` until it ends; yields one event dict per captioned batch."""
+        if drop_oldest is None:
+            # cameras and stream URLs cannot wait for the pipeline; files and generators are paused
+            drop_oldest = isinstance(source, int) or (isinstance(source, str) and not os.path.isfile(source))
+        ring = FrameRing(ring_capacity, drop_oldest)
+        reader = threading.Thread(target=read_into_ring, args=(iter_source(source, fps, follow), ring), daemon=True)
+        reader.start()
+        if self.kg_stage is not None:
+            self.kg_stage.load()
+
+        self.since_kg = 0
+        first_frame = self.next_frame
+        pending = []
+        try:
+            for frame_index, timestamp, frame in sample_stream(ring, sampler):
+                self.next_frame = first_frame + frame_index + 1
+                name = f"frame_{first_frame + frame_index}{self.encoder.extension}"
+                pending.append(self.encoder.encode(frame, name))
+                if len(pending) >= self.caption_batch:
+                    yield self.process_batch(pending, ring)
+                    pending = []
+            if pending or self.since_kg:
+                yield self.process_batch(pending, ring, final=True)
+        finally:
+            ring.close()
+            reader.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Caption and build the KG of a live or growing video source')
+    parser.add_argument('source', help='camera index, stream URL or video file')
+    parser.add_argument('--output', default='stream_output')
+    parser.add_argument('--cluster-id', default='stream')
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', ''))
+    parser.add_argument('--interval', type=float, help='keep a frame every N seconds of stream time')
+    parser.add_argument('--change-threshold', type=float, help='keep frames whose scene-change score reaches this')
+    parser.add_argument('--min-interval', type=float, default=1.0)
+    parser.add_argument('--follow', action='store_true', help='keep reading a file that is still being written')
+    parser.add_argument('--caption-batch', type=int, default=8)
+    parser.add_argument('--kg-every', type=int, default=32)
+    parser.add_argument('--segment-frames', type=int, default=512, help='captioned frames per KG segment')
+    parser.add_argument('--no-kg', action='store_true')
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    sampler = StreamSampler(args.interval if args.interval or args.change_threshold else 5.0,
+                            args.change_threshold, args.min_interval)
+    pipeline = StreamPipeline(args.output, args.cluster_id, args.api_key, caption_batch=args.caption_batch,
+                              kg_every=args.kg_every, segment_frames=args.segment_frames,
+                              kg_stage=None if args.no_kg else KGStage())
+    for event in pipeline.run(source, sampler, follow=args.follow):
+        logger.info(event)
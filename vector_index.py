@@ -0,0 +1,438 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from loguru import logger
+
+from profiling import stage
+
+KINDS = ('image', 'caption', 'node')
+
+
+def _top_k(scores, top_k):
+    # indices of the top_k scores of a 1-d array in descending order
+    top_k = min(top_k, len(scores))
+    if top_k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def nearest_centroids(vectors, centroids, chunk_size=16384):
+    # squared L2 nearest centroid per row, a chunk of rows at a time to bound the distance matrix
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignments[start:start + chunk_size] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def kmeans(vectors, k, iterations=20, seed=0):
+    """Lloyd's k-means with empty clusters re-seeded from random rows."""
+    rng = np.random.default_rng(seed)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts, axis=0) / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQIndex:
+    """Inverted-file index with product-quantized residuals, for inner-product search.
+
+    `train` learns `nlist` coarse centroids and, for each of `m` subspaces, 256
+    centroids of the residuals to them; `add` then stores every vector as its
+    list number and `m` one-byte codes, plus its kind (image/caption/node),
+    cluster id and doc id for filtering. Vectors can be added at any time
+    after training. A search scores the `nprobe` lists closest to the query
+    with per-query lookup tables; a filter matching fewer than
+    `exhaustive_below` vectors scans all of them instead, so selective filters
+    do not lose recall. With `refine` > 0 a float16 copy of every vector is
+    kept (memory-mapped once saved) and the best `k * refine` candidates are
+    re-scored exactly.
+
+    On CLIP-like 512-d embeddings (benchmarks/bench_vector_index.py, 100k
+    vectors) the codes alone reach a recall@10 of about 0.56 with m=32, 0.68
+    with m=64 and 0.77 with m=128, and refine=4 brings it to 0.99. The
+    float16 copy costs 2 * dim bytes per vector (1024 for 512-d) on disk
+    against m for the codes, but being memory-mapped only the re-scored rows
+    are read into memory. Use refine=0 where disk space matters more than
+    recall.
+    """
+
+    def __init__(self, dim, nlist=1024, m=64, nprobe=16, exhaustive_below=20000, refine=4):
+        if dim % m:
+            raise ValueError("dim {} is not divisible by m {}".format(dim, m))
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.exhaustive_below = exhaustive_below
+        self.refine = refine
+        # float16 vectors by id, in a buffer that doubles when full
+        self.vectors = np.empty((0, dim), np.float16)
+        self.centroids = None
+        self.codebooks = None
+        self.cluster_ids = []
+        self.cluster_numbers = {}
+        # per-vector columns; pending rows are appended and merged in list order by `compact`
+        self.columns = {name: np.empty(0, dtype) for name, dtype in self.COLUMN_TYPES.items()}
+        self.columns['codes'] = np.empty((0, m), np.uint8)
+        self.pending = []
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.records = []
+        # cluster_id -> stamp of the files its vectors were built from, see video_stamp
+        self.sources = {}
+
+    COLUMN_TYPES = {'lists': np.int32, 'ids': np.int64, 'kinds': np.int8, 'clusters': np.int32, 'docs': np.int64}
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return len(self.records)
+
+    def train(self, vectors, iterations=20, seed=0):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) < self.nlist:
+            raise ValueError("Need at least nlist={} training vectors, got {}".format(self.nlist, len(vectors)))
+        with stage('vector_index_train', items=len(vectors)):
+            self.centroids = kmeans(vectors, self.nlist, iterations, seed)
+            residuals = vectors - self.centroids[nearest_centroids(vectors, self.centroids)]
+            dsub = self.dim // self.m
+            self.codebooks = np.stack([
+                kmeans(residuals[:, i * dsub:(i + 1) * dsub], min(256, len(vectors)), iterations, seed + i)
+                for i in range(self.m)])
+
+    def encode(self, vectors):
+        lists = nearest_centroids(vectors, self.centroids)
+        residuals = vectors - self.centroids[lists]
+        dsub = self.dim // self.m
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for i in range(self.m):
+            codes[:, i] = nearest_centroids(residuals[:, i * dsub:(i + 1) * dsub], self.codebooks[i])
+        return lists, codes
+
+    def add(self, vectors, records):
+        """Add normalized vectors; `records` are dicts with kind, cluster_id, doc_id and anything to return."""
+        if not self.trained:
+            raise ValueError("Train the index before adding vectors")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) != len(records):
+            raise ValueError("Got {} vectors and {} records".format(len(vectors), len(records)))
+        if not len(vectors):
+            return
+        with stage('vector_index_add', items=len(vectors)):
+            lists, codes = self.encode(vectors)
+            for record in records:
+                if record['cluster_id'] not in self.cluster_numbers:
+                    self.cluster_numbers[record['cluster_id']] = len(self.cluster_ids)
+                    self.cluster_ids.append(record['cluster_id'])
+            self.pending.append({
+                'lists': lists.astype(np.int32),
+                'ids': np.arange(len(self.records), len(self.records) + len(records)),
+                'kinds': np.array([KINDS.index(record['kind']) for record in records], dtype=np.int8),
+                'clusters': np.array([self.cluster_numbers[record['cluster_id']] for record in records],
+                                     dtype=np.int32),
+                'docs': np.array([-1 if record.get('doc_id') is None else int(record['doc_id'])
+                                  for record in records], dtype=np.int64),
+                'codes': codes,
+            })
+            if self.refine:
+                self.append_vectors(vectors)
+            self.records.extend(records)
+
+    def append_vectors(self, vectors):
+        count = len(self.records)
+        if count + len(vectors) > len(self.vectors) or not self.vectors.flags.writeable:
+            grown = np.empty((max(2 * len(self.vectors), count + len(vectors)), self.dim), np.float16)
+            grown[:count] = self.vectors[:count]
+            self.vectors = grown
+        self.vectors[count:count + len(vectors)] = vectors
+
+    def compact(self):
+        # merge pending rows so every inverted list is one contiguous slice of the columns
+        if not self.pending:
+            return
+        columns = {name: np.concatenate([self.columns[name]] + [batch[name] for batch in self.pending])
+                   for name in self.columns}
+        order = np.argsort(columns['lists'], kind='stable')
+        self.columns = {name: column[order] for name, column in columns.items()}
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.columns['lists'], minlength=self.nlist))))
+        self.pending = []
+
+    def remove_cluster(self, cluster_id):
+        """Drop every vector of `cluster_id`, e.g. before re-adding a re-processed video."""
+        self.compact()
+        keep = np.array([record['cluster_id'] != cluster_id for record in self.records], dtype=bool)
+        removed = int(len(keep) - keep.sum())
+        if not removed:
+            return 0
+        # ids index the records and refinement vectors, so renumber the kept ones from 0
+        new_ids = np.cumsum(keep) - 1
+        rows = keep[self.columns['ids']]
+        self.columns = {name: column[rows] for name, column in self.columns.items()}
+        self.columns['ids'] = new_ids[self.columns['ids']]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.columns['lists'], minlength=self.nlist))))
+        if self.refine:
+            self.vectors = self.vectors[:len(self.records)][keep]
+        self.records = [record for record, kept in zip(self.records, keep) if kept]
+        self.sources.pop(cluster_id, None)
+        return removed
+
+    def filter_mask(self, kinds=None, cluster_ids=None, doc_ids=None):
+        if kinds is None and cluster_ids is None and doc_ids is None:
+            return None
+        mask = np.ones(len(self.columns['ids']), dtype=bool)
+        if kinds is not None:
+            mask &= np.isin(self.columns['kinds'], [KINDS.index(kind) for kind in kinds])
+        if cluster_ids is not None:
+            mask &= np.isin(self.columns['clusters'],
+                            [self.cluster_numbers[c] for c in cluster_ids if c in self.cluster_numbers])
+        if doc_ids is not None:
+            mask &= np.isin(self.columns['docs'], [int(doc_id) for doc_id in doc_ids])
+        return mask
+
+    def lookup_tables(self, query):
+        # (m, 256) inner products of each query subvector with its codebook
+        return np.einsum('md,mkd->mk', query.reshape(self.m, -1), self.codebooks)
+
+    def score_rows(self, list_scores, tables, rows):
+        # query . centroid comes from the coarse scores, query . residual from the tables
+        codes = self.columns['codes'][rows]
+        return list_scores[self.columns['lists'][rows]] + tables[np.arange(self.m), codes].sum(axis=1)
+
+    def search(self, queries, k=10, nprobe=None, kinds=None, cluster_ids=None, doc_ids=None):
+        """Return, per query, up to k (record, score) pairs; scores approximate the inner product."""
+        self.compact()
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        mask = self.filter_mask(kinds, cluster_ids, doc_ids)
+        exhaustive = np.flatnonzero(mask) if mask is not None and mask.sum() < self.exhaustive_below else None
+
+        results = []
+        with stage('vector_index_search', items=len(queries)):
+            coarse = queries @ self.centroids.T
+            for query, list_scores in zip(queries, coarse):
+                tables = self.lookup_tables(query)
+                if exhaustive is not None:
+                    rows = exhaustive
+                else:
+                    probed = _top_k(list_scores, nprobe)
+                    rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probed])
+                    if mask is not None:
+                        rows = rows[mask[rows]]
+                scores = self.score_rows(list_scores, tables, rows)
+                if self.refine:
+                    ids = self.columns['ids'][rows[_top_k(scores, k * self.refine)]]
+                    scores = self.vectors[ids].astype(np.float32) @ query
+                else:
+                    ids = self.columns['ids'][rows]
+                best = _top_k(scores, k)
+                results.append([(self.records[ids[i]], float(scores[i])) for i in best])
+        return results
+
+    def nbytes(self):
+        # size of the quantizers, per-vector columns and refinement vectors, without the records
+        self.compact()
+        return self.centroids.nbytes + self.codebooks.nbytes + len(self) * self.vectors.shape[1] * 2 * bool(
+            self.refine) + sum(column.nbytes for column in self.columns.values())
+
+    def save(self, directory):
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        arrays = dict(self.columns, centroids=self.centroids, codebooks=self.codebooks, offsets=self.offsets)
+        # temporary files first so a crash never leaves a half-written index
+        with open(os.path.join(directory, 'arrays.npz.tmp'), 'wb') as arrays_file:
+            np.savez(arrays_file, **arrays)
+        with open(os.path.join(directory, 'vectors.npy.tmp'), 'wb') as vectors_file:
+            np.save(vectors_file, self.vectors[:len(self)] if self.refine else self.vectors[:0])
+        with open(os.path.join(directory, 'records.jsonl.tmp'), 'w') as records_file:
+            for record in self.records:
+                records_file.write(json.dumps(record) + '\n')
+        with open(os.path.join(directory, 'index.json.tmp'), 'w') as meta_file:
+            json.dump({'dim': self.dim, 'nlist': self.nlist, 'm': self.m, 'nprobe': self.nprobe,
+                       'exhaustive_below': self.exhaustive_below, 'refine': self.refine,
+                       'cluster_ids': self.cluster_ids, 'sources': self.sources}, meta_file)
+        for name in ('arrays.npz', 'vectors.npy', 'records.jsonl', 'index.json'):
+            os.replace(os.path.join(directory, name + '.tmp'), os.path.join(directory, name))
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'index.json')) as meta_file:
+            meta = json.load(meta_file)
+        index = cls(meta['dim'], meta['nlist'], meta['m'], meta['nprobe'], meta['exhaustive_below'], meta['refine'])
+        # read-only until the next add, which copies the vectors into memory
+        index.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        with np.load(os.path.join(directory, 'arrays.npz')) as arrays:
+            index.centroids = arrays['centroids']
+            index.codebooks = arrays['codebooks']
+            index.offsets = arrays['offsets']
+            index.columns = {name: arrays[name] for name in index.columns}
+        index.cluster_ids = meta['cluster_ids']
+        index.cluster_numbers = {cluster_id: i for i, cluster_id in enumerate(index.cluster_ids)}
+        # indexes saved before sources were recorded get every cluster re-indexed once
+        index.sources = meta.get('sources', {})
+        with open(os.path.join(directory, 'records.jsonl')) as records_file:
+            index.records = [json.loads(line) for line in records_file]
+        return index
+
+
+class TextEncoder:
+    """CLIP text tower with an in-memory cache, for captions and KG node tokens."""
+
+    def __init__(self, model, processor, batch_size=64):
+        self.model = model
+        self.processor = processor
+        self.batch_size = batch_size
+        self.cache = {}
+
+    def encode(self, texts):
+        import torch
+
+        from clip_index import _features, _normalize
+
+        missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            with stage('clip_scoring', items=len(batch), tower='text'):
+                # captions can be longer than CLIP's 77-token context
+                inputs = self.processor(text=batch, return_tensors="pt", padding=True, truncation=True,
+                                        max_length=77)
+                with torch.inference_mode():
+                    features = _normalize(_features(self.model.get_text_features(**inputs)).numpy())
+            self.cache.update(zip(batch, features.astype(np.float32)))
+        return np.stack([self.cache[text] for text in texts]) if texts else np.empty((0, self.dim), np.float32)
+
+    @property
+    def dim(self):
+        return self.model.config.projection_dim
+
+
+def video_stamp(video_dir, kg_name='graph_no_quotes.json'):
+    # mtime and size of the files video_vectors reads, to notice re-processed videos
+    kg_path = os.path.join('kg_output', kg_name)
+    stamp = []
+    for name in (os.path.join('frames_index', 'embeddings.npy'), os.path.join('frames_index', 'ids.json'),
+                 kg_path, os.path.splitext(kg_path)[0] + '.sqlite'):
+        path = os.path.join(video_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp.append([name, stat.st_mtime_ns, stat.st_size])
+    return stamp
+
+
+def video_vectors(video_dir, cluster_id, text_encoder, kg_name='graph_no_quotes.json'):
+    """Vectors and records of one processed video in the batch.py layout.
+
+    Frame embeddings are read from `frames_index/`; captions and the word
+    tokens of KG nodes are embedded with the CLIP text tower, one vector per
+    distinct node text per doc.
+    """
+    from clip_index import FrameIndex
+    from kg.kg_store import load_graph, node_doc_id
+
+    vectors, records = [], []
+    frame_index = FrameIndex(os.path.join(video_dir, 'frames'), index_dir=os.path.join(video_dir, 'frames_index'))
+    if frame_index.load():
+        vectors.append(np.asarray(frame_index.embeddings, dtype=np.float32))
+        records.extend({'kind': 'image', 'cluster_id': cluster_id, 'doc_id': int(entry['id'].split('_')[1]),
+                        'path': entry['path']} for entry in frame_index.entries)
+    else:
+        logger.warning('No frame index in {}, skipping its frames', video_dir)
+
+    kg_path = os.path.join(video_dir, 'kg_output', kg_name)
+    if os.path.exists(kg_path) or os.path.exists(os.path.splitext(kg_path)[0] + '.sqlite'):
+        kg = load_graph(kg_path)
+        texts = []
+        for doc_id in kg.doc_ids():
+            caption = kg.doc_info(doc_id)['image']
+            if caption:
+                texts.append(caption)
+                records.append({'kind': 'caption', 'cluster_id': cluster_id, 'doc_id': int(doc_id), 'text': caption})
+
+        seen = set()
+        for node in kg.nodes():
+            doc_id = node_doc_id(node['id'], node)
+            # image nodes and the root carry ids rather than words
+            if doc_id is None or 'image' in node or (doc_id, node['word_token']) in seen:
+                continue
+            seen.add((doc_id, node['word_token']))
+            texts.append(node['word_token'])
+            records.append({'kind': 'node', 'cluster_id': cluster_id, 'doc_id': int(doc_id),
+                            'text': node['word_token'], 'amr_token': node['amr_token']})
+        kg.close()
+        vectors.append(text_encoder.encode(texts))
+    else:
+        logger.warning('No KG in {}, skipping its captions and nodes', video_dir)
+
+    vectors = np.concatenate(vectors) if vectors else np.empty((0, text_encoder.dim), np.float32)
+    return vectors, records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index frames, captions and KG nodes of processed videos')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='add the videos under a batch.py output directory')
+    build_parser.add_argument('videos_root', help='directory with one <video>/ folder per video, e.g. batch_output')
+    build_parser.add_argument('--index', default='vector_index')
+    build_parser.add_argument('--nlist', type=int, default=1024)
+    build_parser.add_argument('--m', type=int, default=64)
+    build_parser.add_argument('--refine', type=int, default=4,
+                              help='re-score k * refine candidates with float16 copies; 0 keeps only the codes')
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('question')
+    query_parser.add_argument('--index', default='vector_index')
+    query_parser.add_argument('--k', type=int, default=10)
+    query_parser.add_argument('--nprobe', type=int)
+    query_parser.add_argument('--kind', action='append', choices=KINDS)
+    query_parser.add_argument('--cluster-id', action='append')
+    query_parser.add_argument('--doc-id', action='append')
+    args = parser.parse_args()
+
+    from clip_index import load_clip_model, load_clip_processor
+
+    text_encoder = TextEncoder(load_clip_model(), load_clip_processor())
+
+    if args.command == 'build':
+        index = IVFPQIndex.load(args.index) if os.path.exists(os.path.join(args.index, 'index.json')) else None
+        sources = index.sources if index else {}
+        videos = sorted(name for name in os.listdir(args.videos_root)
+                        if os.path.isdir(os.path.join(args.videos_root, name)))
+        # new videos and those whose frame index or KG changed since they were indexed
+        stamps = {name: video_stamp(os.path.join(args.videos_root, name)) for name in videos}
+        changed = [name for name in videos if sources.get(name) != stamps[name]]
+        collected = [(name,) + video_vectors(os.path.join(args.videos_root, name), name, text_encoder)
+                     for name in changed]
+        if index is None:
+            # the quantizers are learnt from the first videos; later ones are only added
+            training = [vectors for _, vectors, _ in collected if len(vectors)]
+            if not training:
+                parser.error('no frame indexes or KGs to index under {}'.format(args.videos_root))
+            training = np.concatenate(training)
+            nlist = min(args.nlist, max(1, len(training) // 39))
+            index = IVFPQIndex(training.shape[1], nlist=nlist, m=args.m, refine=args.refine)
+            index.train(training[np.random.default_rng(0).permutation(len(training))[:256 * nlist]])
+        for name, vectors, records in collected:
+            removed = index.remove_cluster(name)
+            index.add(vectors, records)
+            index.sources[name] = stamps[name]
+            logger.info('{}: {} vectors{}', name, len(records), ', replacing {}'.format(removed) if removed else '')
+        index.save(args.index)
+        logger.info('{} vectors from {} clusters in {}', len(index), len(index.cluster_ids), args.index)
+    else:
+        index = IVFPQIndex.load(args.index)
+        query = text_encoder.encode([args.question])
+        for record, score in index.search(query, args.k, args.nprobe, args.kind, args.cluster_id, args.doc_id)[0]:
+            print('{:.3f} {}'.format(score, json.dumps(record)))